@@ -0,0 +1,62 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from cmdserver.jvcsim import JvcSimulator
+
+MACROS = {
+    'scope': ['PictureMode.PictureMode.User1', 'Anamorphic.Anamorphic.A', 'InstallationMode.InstallationMode.TWO'],
+    'flat': ['PictureMode.PictureMode.Natural', 'Anamorphic.Anamorphic.Off', 'InstallationMode.InstallationMode.ONE'],
+}
+
+
+def make_config(sim: JvcSimulator, **kwargs):
+    """ a minimal cmdserver config pointing at the simulator """
+    values = {
+        'pj_ip': sim.address[0],
+        'pj_port': sim.port,
+        'pj_password': None,
+        'pj_macros': MACROS,
+        'pj_polling': {},
+        'pj_verify': {},
+        'commands': {},
+        'command_workers': 4,
+        'mqtt': None,
+        'metrics': {},
+        'version': 'benchmark',
+    }
+    values.update(kwargs)
+    return SimpleNamespace(**values)
+
+
+def pytest_collection_modifyitems(config, items):
+    """ the functional tests still run without pytest-benchmark, only those which measure something are skipped """
+    if not config.pluginmanager.hasplugin('benchmark'):
+        skip = pytest.mark.skip(reason='pytest-benchmark is not installed')
+        for item in items:
+            if 'benchmark' in getattr(item, 'fixturenames', ()):
+                item.add_marker(skip)
+
+
+@pytest.fixture(scope='session')
+def reactor():
+    """ runs the twisted reactor in the background for the whole session, it cannot be restarted once stopped """
+    from twisted.internet import reactor
+    t = threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False}, name='reactor', daemon=True)
+    t.start()
+    yield reactor
+    reactor.callFromThread(reactor.stop)
+    t.join(timeout=5)
+
+
+@pytest.fixture(scope='module')
+def simulator():
+    with JvcSimulator() as sim:
+        yield sim
+
+
+def on_reactor(reactor, fn, *args, **kwargs):
+    """ creates objects which schedule work with the reactor on the reactor thread """
+    from twisted.internet import threads
+    return threads.blockingCallFromThread(reactor, lambda: fn(*args, **kwargs))
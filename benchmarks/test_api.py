@@ -0,0 +1,79 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cmdserver.main import create_app
+from conftest import make_config, on_reactor
+
+REQUESTS_PER_CLIENT = 10
+
+
+@pytest.fixture(scope='module')
+def app(reactor, simulator):
+    return on_reactor(reactor, create_app, make_config(simulator))
+
+
+def hammer(app, clients: int, url: str):
+    """ issues REQUESTS_PER_CLIENT GETs from each of the clients concurrently """
+    def run_client():
+        client = app.test_client()
+        return [client.get(url).status_code for _ in range(REQUESTS_PER_CLIENT)]
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        return [code for codes in pool.map(lambda _: run_client(), range(clients)) for code in codes]
+
+
+@pytest.mark.parametrize('clients', [1, 4, 16])
+def test_get_cached(benchmark, app, clients):
+    codes = benchmark(hammer, app, clients, '/api/1/pj/PictureMode')
+    assert set(codes) == {200}
+
+
+@pytest.mark.parametrize('clients', [1, 4, 16])
+def test_get_fresh(benchmark, app, clients):
+    codes = benchmark(hammer, app, clients, '/api/1/pj/PictureMode?fresh=true')
+    assert set(codes) == {200}
+
+
+@pytest.mark.parametrize('clients', [1, 4])
+def test_put_and_wait(benchmark, app, clients):
+    def put_all():
+        def run_client():
+            client = app.test_client()
+            return [client.put('/api/1/pj?wait=true&verify=never', json=['scope', 'flat']).status_code
+                    for _ in range(REQUESTS_PER_CLIENT)]
+
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            return [code for codes in pool.map(lambda _: run_client(), range(clients)) for code in codes]
+
+    assert set(benchmark.pedantic(put_all, rounds=3, iterations=1)) == {200}
+
+
+def test_negative_values_are_not_errors(app):
+    client = app.test_client()
+    assert client.put('/api/1/pj?wait=true&verify=never', json=['Contrast.Numeric.-1']).status_code == 200
+    for fresh in ['true', 'false']:
+        r = client.get(f'/api/1/pj/Contrast?fresh={fresh}')
+        assert r.status_code == 200
+        assert r.json == -1
+
+
+def test_commands_are_synchronous_unless_async_is_requested(reactor, simulator):
+    import sys
+    commands = {
+        'ok': {'exe': sys.executable, 'args': ['-c', 'pass']},
+        'bad': {'exe': sys.executable, 'args': ['-c', 'raise SystemExit(3)']},
+    }
+    client = on_reactor(reactor, create_app, make_config(simulator, commands=commands)).test_client()
+    assert client.put('/api/1/command/ok').status_code == 200
+    r = client.put('/api/1/command/bad')
+    assert r.status_code == 500
+    assert r.get_json() == {'errorCode': 3}
+    assert client.put('/api/1/command/missing').status_code == 404
+    r = client.put('/api/1/command/ok?async=true')
+    assert r.status_code == 202
+    job_id = r.get_json()['id']
+    lines = client.put('/api/1/command/ok?stream=true').get_data(as_text=True).splitlines()
+    assert json.loads(lines[-1])['state'] == 'complete'
+    assert client.get(f'/api/1/command/job/{job_id}').get_json()['id'] == job_id
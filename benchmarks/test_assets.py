@@ -0,0 +1,66 @@
+import gzip
+
+import pytest
+import requests
+
+from cmdserver.assets import AssetStore, AssetResource
+from conftest import on_reactor
+
+BUNDLE = b'function hello() { return "world"; }\n' * 1000
+
+
+@pytest.fixture(scope='module')
+def ui(reactor, tmp_path_factory):
+    root = tmp_path_factory.mktemp('ui')
+    (root / 'static' / 'js').mkdir(parents=True)
+    (root / 'static' / 'js' / 'main.abc123.js').write_bytes(BUNDLE)
+    (root / 'index.html').write_bytes(b'<html><body>cmdserver</body></html>')
+    store = AssetStore(str(root))
+
+    def listen():
+        from twisted.web import server
+        from twisted.web.resource import Resource
+
+        class Root(Resource):
+            def getChild(self, path, request):
+                return AssetResource(store)
+
+        return reactor.listenTCP(0, server.Site(Root()), interface='127.0.0.1')
+
+    port = on_reactor(reactor, listen)
+    yield f'http://127.0.0.1:{port.getHost().port}', root, store
+    on_reactor(reactor, port.stopListening)
+
+
+def test_serves_precompressed_with_etag(ui):
+    url, _, _ = ui
+    r = requests.get(f'{url}/static/js/main.abc123.js', headers={'Accept-Encoding': 'gzip'}, stream=True)
+    assert r.status_code == 200
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in r.headers['Cache-Control']
+    assert gzip.decompress(r.raw.read()) == BUNDLE
+    cached = requests.get(f'{url}/static/js/main.abc123.js', headers={'If-None-Match': r.headers['ETag']})
+    assert cached.status_code == 304
+
+
+def test_unknown_routes_get_index(ui):
+    url, _, _ = ui
+    r = requests.get(f'{url}/some/react/route')
+    assert r.status_code == 200
+    assert r.headers['Cache-Control'] == 'no-cache'
+    assert b'cmdserver' in r.content
+    assert requests.get(f'{url}/static/missing.js').status_code == 404
+
+
+def test_reload_if_changed(ui):
+    url, root, store = ui
+    (root / 'index.html').write_bytes(b'<html><body>changed!</body></html>')
+    store.reload_if_changed()
+    assert b'changed!' in requests.get(url + '/').content
+
+
+def test_get_bundle(benchmark, ui):
+    url, _, _ = ui
+    session = requests.Session()
+    r = benchmark(session.get, f'{url}/static/js/main.abc123.js')
+    assert r.status_code == 200
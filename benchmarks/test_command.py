@@ -0,0 +1,198 @@
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from cmdserver.commandcontroller import CommandController, TooBusy
+
+LAUNCHES = 8
+
+
+@pytest.fixture(scope='module')
+def controller():
+    commands = {
+        'quick': {'exe': sys.executable, 'args': ['-c', 'pass']},
+        'slow': {'exe': sys.executable, 'args': ['-c', 'import time; time.sleep(5)'], 'timeout': 0.5,
+                 'concurrency': 1},
+    }
+    return CommandController(SimpleNamespace(commands=commands, command_workers=4))
+
+
+def test_execute_serially(benchmark, controller):
+    results = benchmark.pedantic(lambda: [controller.execute('quick') for _ in range(LAUNCHES)], rounds=3)
+    assert {r[0] for r in results} == {0}
+
+
+def test_submit_concurrently(benchmark, controller):
+    def submit_all():
+        jobs = [controller.submit('quick') for _ in range(LAUNCHES)]
+        for job in jobs:
+            job.wait()
+        return jobs
+
+    jobs = benchmark.pedantic(submit_all, rounds=3)
+    assert {job.return_code for job in jobs} == {0}
+
+
+def test_timeout_and_concurrency_limit(controller):
+    job = controller.submit('slow')
+    with pytest.raises(TooBusy):
+        controller.submit('slow')
+    assert job.wait(timeout=5)
+    assert job.error == 'Timed out after 0.5s'
+    assert controller.get_job(job.id) is job
+
+
+HELPER = '''
+import json, sys
+for line in sys.stdin:
+    request = json.loads(line)
+    print('noise', flush=True)
+    print(json.dumps({'id': request['id'], 'returnCode': 0, 'output': ' '.join(request['args'])}), flush=True)
+'''
+
+
+@pytest.fixture(scope='module')
+def resident():
+    commands = {
+        'defaults': {'exe': sys.executable, 'resident': {'args': ['-c', HELPER], 'size': 2}},
+        'quick': {'args': ['-c', 'pass']},
+        'oneshot': {'args': ['-c', 'pass'], 'resident': False},
+    }
+    controller = CommandController(SimpleNamespace(commands=commands, command_workers=4))
+    yield controller
+    controller.shutdown()
+
+
+@pytest.mark.parametrize('command', ['oneshot', 'quick'])
+def test_resident_helper(benchmark, resident, command):
+    results = benchmark.pedantic(lambda: [resident.execute(command) for _ in range(LAUNCHES)], rounds=3)
+    assert {r[0] for r in results} == {0}
+    if command == 'quick':
+        assert {r[1] for r in results} == {'-c pass'}
+
+
+@pytest.fixture(scope='module')
+def remotes():
+    from pytest_httpserver import HTTPServer
+    servers = [HTTPServer(), HTTPServer()]
+    for s in servers:
+        s.expect_request('/api/1/command/relay', method='PUT').respond_with_data('')
+        s.expect_request('/api/1/command/broken', method='PUT').respond_with_json({'errorCode': 1}, status=500)
+        s.start()
+    yield servers
+    for s in servers:
+        s.stop()
+
+
+def test_remote_fan_out(benchmark, remotes):
+    commands = {
+        'defaults': {'remote_prefix': remotes[0].url_for('/api/1/command'), 'remote_timeout': [1, 2]},
+        'relay': {'remote': [s.url_for('/api/1/command') for s in remotes]},
+        'broken': {'remote': True},
+    }
+    controller = CommandController(SimpleNamespace(commands=commands, command_workers=4))
+    results = benchmark.pedantic(lambda: [controller.execute('relay') for _ in range(LAUNCHES)], rounds=3)
+    assert {r[0] for r in results} == {0}
+    for s in remotes:
+        assert {r.headers.get('Idempotency-Key') is not None for r, _ in s.log} == {True}
+        assert {r.args.get('wait') for r, _ in s.log} == {'true'}
+    assert controller.execute('broken')[0] == 2
+
+
+def test_remote_values_which_are_not_urls_select_the_remote_prefix(remotes):
+    remotes[0].expect_request('/api/1/command/flagged', method='PUT').respond_with_data('')
+    commands = {
+        'defaults': {'remote_prefix': remotes[0].url_for('/api/1/command')},
+        'flagged': {'remote': 'yes'},
+    }
+    controller = CommandController(SimpleNamespace(commands=commands, command_workers=1))
+    assert controller.execute('flagged')[0] == 0
+
+
+def test_remote_read_timeout_is_not_retried(remotes):
+    import time
+    from werkzeug import Response
+
+    calls = []
+
+    def slow(request):
+        calls.append(request.headers.get('Idempotency-Key'))
+        time.sleep(1)
+        return Response('')
+
+    remotes[1].expect_request('/api/1/command/slow', method='PUT').respond_with_handler(slow)
+    commands = {
+        'defaults': {'remote_timeout': [1, 0.2], 'remote_retries': 2},
+        'slow': {'remote': remotes[1].url_for('/api/1/command')},
+    }
+    controller = CommandController(SimpleNamespace(commands=commands, command_workers=4))
+    job = controller.submit('slow')
+    assert job.wait(timeout=5)
+    assert job.error.startswith('Timed out - ')
+    assert len(calls) == 1
+
+
+def test_duplicates_are_coalesced():
+    commands = {
+        'defaults': {'exe': sys.executable, 'idempotencyWindow': 5},
+        'tap': {'args': ['-c', 'pass'], 'dedupe': 0.5},
+        'keyed': {'args': ['-c', 'pass']},
+    }
+    controller = CommandController(SimpleNamespace(commands=commands, command_workers=4))
+    first = controller.submit('tap')
+    assert controller.submit('tap') is first
+    first.wait()
+    assert controller.submit('tap') is first
+    keyed = controller.submit('keyed', idempotency_key='abc')
+    keyed.wait()
+    assert controller.submit('keyed', idempotency_key='abc') is keyed
+    assert controller.submit('keyed') is not keyed
+    assert controller.submit('tap', idempotency_key='abc').command_id == 'tap'
+
+
+def test_waiting_for_a_dead_pool_falls_back(tmp_path):
+    import os
+    import threading
+    from cmdserver.cmdhelper import HelperPool, HelperFailed, HelperExited
+
+    # a helper which dies on its first request and cannot be respawned as its exe has gone
+    exe = tmp_path / 'helper'
+    exe.write_text(f'#!{sys.executable}\nimport sys, time\nsys.stdin.readline()\ntime.sleep(0.5)\n')
+    os.chmod(exe, 0o755)
+    pool = HelperPool(str(exe), [], size=1)
+    pool.start()
+    exe.unlink()
+    errors = []
+
+    def call():
+        try:
+            pool.call('cmd', [])
+        except (HelperFailed, HelperExited) as e:
+            errors.append(e)
+
+    callers = [threading.Thread(target=call, daemon=True) for _ in range(2)]
+    for c in callers:
+        c.start()
+    for c in callers:
+        c.join(timeout=5)
+    # the request which was accepted fails outright while the one which was never delivered can fall back
+    assert sorted(type(e).__name__ for e in errors) == ['HelperExited', 'HelperFailed']
+
+
+def test_a_helper_which_exits_mid_request_is_not_launched_again(tmp_path):
+    runs = tmp_path / 'runs'
+    helper = f"import sys; sys.stdin.readline(); open({str(runs)!r}, 'a').write('helper\\n'); sys.exit(1)"
+    commands = {
+        'defaults': {'exe': sys.executable, 'resident': {'args': ['-c', helper]}},
+        'once': {'args': ['-c', f"open({str(runs)!r}, 'a').write('oneshot\\n')"]},
+    }
+    controller = CommandController(SimpleNamespace(commands=commands, command_workers=1))
+    try:
+        job = controller.submit('once')
+        assert job.wait(timeout=5)
+        assert job.return_code == -1
+        assert 'before responding' in job.error
+        assert runs.read_text() == 'helper\n'
+    finally:
+        controller.shutdown()
@@ -0,0 +1,49 @@
+import pytest
+
+from cmdserver.jvc import CommandExecutor
+from cmdserver.jvccommands import Command, PictureMode, PowerState, Null
+
+
+@pytest.fixture
+def executor(simulator):
+    with CommandExecutor(simulator.address[0], port=simulator.port) as e:
+        yield e
+
+
+def test_get_power(benchmark, executor):
+    assert benchmark(executor.get, Command.Power) == PowerState.LampOn
+
+
+def test_get_numeric(benchmark, executor):
+    assert benchmark(executor.get, Command.Contrast) == 0
+
+
+def test_get_gamma_table(benchmark, executor):
+    assert len(benchmark(executor.get, Command.GammaRed)) == 256
+
+
+def test_set_without_verify(benchmark, executor):
+    benchmark(executor.set, Command.PictureMode, PictureMode.User1, verify=False)
+
+
+def test_set_with_verify(benchmark, executor):
+    benchmark(executor.set, Command.PictureMode, PictureMode.Natural, verify=True)
+
+
+def test_set_gamma_table(benchmark, executor):
+    table = list(range(0, 65536, 256))
+    benchmark(executor.set, Command.GammaRed, table, verify=False)
+    assert executor.get(Command.GammaRed) == table
+
+
+def test_keepalive(benchmark, executor):
+    benchmark(executor.set, Command.Null, Null.Null)
+
+
+def test_handshake(benchmark, simulator):
+    def connect_and_get():
+        with CommandExecutor(simulator.address[0], port=simulator.port) as e:
+            return e.get(Command.Power)
+
+    # the client waits for the socket timeout between connections so keep the number of rounds low
+    assert benchmark.pedantic(connect_and_get, rounds=3, iterations=1) == PowerState.LampOn
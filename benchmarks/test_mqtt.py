@@ -0,0 +1,185 @@
+import json
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import cmdserver.mqtt
+from cmdserver.mqtt import MQTT
+from conftest import make_config, on_reactor
+
+
+class RecordingClient:
+    """
+    stands in for the paho client so publishes can be observed without a broker, the broker's side of the conversation
+    is played by calling the callbacks which MQTT installs on the client.
+    """
+
+    def __init__(self):
+        self.published = []
+        self.rc = 0
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.on_publish = None
+
+    def __getattr__(self, item):
+        return lambda *args, **kwargs: None
+
+    def publish(self, topic, qos=0, payload=None, retain=False):
+        self.published.append((topic, payload, retain))
+        return SimpleNamespace(rc=self.rc, mid=len(self.published))
+
+    def connected(self):
+        self.on_connect(self, None, None, 0)
+
+    def receive(self, topic: str, payload: bytes):
+        self.on_message(self, None, SimpleNamespace(topic=topic, payload=payload))
+
+    def ack(self):
+        for mid in range(1, len(self.published) + 1):
+            self.on_publish(self, None, mid)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    recording = RecordingClient()
+    monkeypatch.setattr(cmdserver.mqtt.mqtt, 'Client', lambda *args, **kwargs: recording)
+    return recording
+
+
+@pytest.fixture
+def offline(client):
+    return MQTT('127.0.0.1', queue_limit=4, max_in_flight=2)
+
+
+@pytest.fixture
+def mqtt(client):
+    m = MQTT('127.0.0.1', max_in_flight=1000)
+    client.connected()
+    return m
+
+
+def test_unchanged_values_are_not_republished(mqtt, client):
+    mqtt.state('pj', 'LampOn')
+    mqtt.attribute('pj', 'pictureMode', 'Natural')
+    mqtt.attribute('pj', 'anamorphicMode', 'Off')
+    mqtt.state('pj', 'LampOn')
+    mqtt.attribute('pj', 'pictureMode', 'User1')
+    mqtt.attribute('pj', 'anamorphicMode', 'Off')
+    mqtt.event('pj', 'x')
+    mqtt.event('pj', 'x')
+    assert client.published == [
+        ('cmdserver/pj/state', 'LampOn', True),
+        ('cmdserver/pj/attributes/pictureMode', 'Natural', True),
+        ('cmdserver/pj/attributes/anamorphicMode', 'Off', True),
+        ('cmdserver/pj/attributes/pictureMode', 'User1', True),
+        ('cmdserver/pj/event', 'x', False),
+        ('cmdserver/pj/event', 'x', False),
+    ]
+
+
+def wait_for_result(client: RecordingClient, topic: str):
+    import time
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        results = [json.loads(p) for t, p, _ in client.published if t == topic]
+        if results:
+            return results
+        time.sleep(0.01)
+    raise AssertionError(f'Nothing published to {topic}')
+
+
+def test_command_channel(mqtt, client, reactor, simulator):
+    from cmdserver.commandcontroller import CommandController
+    from cmdserver.mqttcommands import MQTTCommandChannel
+    from cmdserver.pjcontroller import PJController
+    commands = CommandController(SimpleNamespace(commands={'quick': {'exe': sys.executable, 'args': ['-c', 'pass']}},
+                                                 command_workers=1))
+    pj = on_reactor(reactor, PJController, make_config(simulator), None)
+    MQTTCommandChannel(mqtt, pj, commands)
+
+    client.receive('cmdserver/command/quick/run', b'')
+    assert wait_for_result(client, 'cmdserver/command/quick/result')[0]['state'] == 'complete'
+    client.receive('cmdserver/command/missing/run', b'')
+    assert 'error' in wait_for_result(client, 'cmdserver/command/missing/result')[0]
+
+    client.receive('cmdserver/pj/set', json.dumps({'commands': ['scope'], 'verify': 'never'}).encode())
+    assert wait_for_result(client, 'cmdserver/pj/result')[0]['state'] == 'complete'
+
+
+def test_offline_publishes_are_coalesced_and_bounded(offline, client):
+    for i in range(3):
+        offline.attribute('pj', 'pictureMode', f'User{i}')
+    for i in range(5):
+        offline.event('pj', f'e{i}')
+    assert client.published == []
+    client.connected()
+    # retained values coalesce, events do not but the oldest are dropped once the queue is full
+    # only 2 may be in flight until acked
+    assert client.published == [('cmdserver/pj/attributes/pictureMode', 'User2', True),
+                                ('cmdserver/pj/event', 'e2', False)]
+    client.ack()
+    client.ack()
+    assert [p for _, p, _ in client.published] == ['User2', 'e2', 'e3', 'e4']
+
+
+def test_dropped_retained_values_are_published_again(offline, client):
+    for i in range(5):
+        offline.attribute('pj', f'a{i}', 'x')
+    # a0 was dropped so publishing the same value again is not skipped as unchanged
+    offline.attribute('pj', 'a0', 'x')
+    client.connected()
+    for _ in range(3):
+        client.ack()
+    assert [t.split('/')[-1] for t, _, _ in client.published] == ['a2', 'a3', 'a4', 'a0']
+
+
+def test_messages_kept_by_the_client_are_not_requeued(offline, client):
+    client.connected()
+    client.rc = cmdserver.mqtt.mqtt.MQTT_ERR_NO_CONN
+    offline.event('pj', 'a')
+    offline.event('pj', 'b')
+    client.rc = 0
+    client.connected()
+    assert [p for _, p, _ in client.published] == ['a', 'b']
+    # the client resends its copy on reconnect and the acks free both in flight slots
+    client.ack()
+    offline.event('pj', 'c')
+    offline.event('pj', 'd')
+    assert [p for _, p, _ in client.published] == ['a', 'b', 'c', 'd']
+
+
+def test_discovery(mqtt, client):
+    from cmdserver.hass import HomeAssistantDiscovery
+    HomeAssistantDiscovery(mqtt, {'music': {'title': 'Music'}}, '1.0').publish()
+    configs = {t: json.loads(p) for t, p, _ in client.published}
+    node = mqtt.client_id
+    assert configs[f'homeassistant/sensor/{node}/pj_pictureMode/config']['state_topic'] == \
+           'cmdserver/pj/attributes/pictureMode'
+    button = configs[f'homeassistant/button/{node}/command_music/config']
+    assert button['command_topic'] == 'cmdserver/command/music/run'
+    assert button['name'] == 'Music'
+
+
+def test_one_thread_at_a_time_hands_messages_to_the_client(mqtt, client):
+    import threading
+    entered = threading.Event()
+    release = threading.Event()
+    publish = client.publish
+
+    def slow_first_publish(topic, qos=0, payload=None, retain=False):
+        if payload == 'e0':
+            entered.set()
+            release.wait(timeout=5)
+        return publish(topic, qos=qos, payload=payload, retain=retain)
+
+    client.publish = slow_first_publish
+    first = threading.Thread(target=mqtt.event, args=('pj', 'e0'), daemon=True)
+    first.start()
+    assert entered.wait(timeout=5)
+    # queued while e0 is being handed over so it must wait for e0 rather than overtake it
+    mqtt.event('pj', 'e1')
+    release.set()
+    first.join(timeout=5)
+    assert [p for _, p, _ in client.published] == ['e0', 'e1']
@@ -0,0 +1,114 @@
+import pytest
+
+from cmdserver.jvcsim import JvcSimulator
+from cmdserver.pjcontroller import PJController
+from cmdserver.progress import FAILED
+from cmdserver.pjverify import Verify
+from conftest import make_config, on_reactor
+
+
+@pytest.fixture(scope='module')
+def controller(reactor, simulator):
+    pj = on_reactor(reactor, PJController, make_config(simulator), None)
+    assert pj.get('Power', fresh=True) == 'LampOn'
+    return pj
+
+
+def test_get_cached(benchmark, controller):
+    assert benchmark(controller.get, 'PictureMode') is not None
+
+
+def test_get_fresh(benchmark, controller):
+    assert benchmark(controller.get, 'PictureMode', fresh=True) is not None
+
+
+@pytest.mark.parametrize('verify', [Verify.NEVER, Verify.ALWAYS])
+def test_send_macro(benchmark, controller, verify):
+    benchmark(controller.send, ['scope', 'flat'], verify=verify)
+    assert controller.get('PictureMode', fresh=True) == 'Natural'
+
+
+def test_send_macro_with_pause(benchmark, controller):
+    benchmark.pedantic(controller.send, args=(['scope', 'PAUSE0.1', 'flat'],), kwargs={'verify': Verify.NEVER},
+                       rounds=5, iterations=1)
+
+
+def test_refresh_state(benchmark, controller):
+    benchmark(controller.refresh)
+    assert controller.state['pictureMode'] != ''
+
+
+@pytest.mark.parametrize('latency', [0.005, 0.02])
+def test_refresh_state_with_latency(benchmark, reactor, latency):
+    with JvcSimulator(latency=latency) as sim:
+        pj = on_reactor(reactor, PJController, make_config(sim), None)
+        benchmark.pedantic(pj.refresh, rounds=10, iterations=1)
+
+
+def test_recover_from_dropped_connection(benchmark, reactor):
+    with JvcSimulator() as sim:
+        pj = on_reactor(reactor, PJController, make_config(sim), None)
+        assert pj.get('Power', fresh=True) == 'LampOn'
+
+        def drop_then_get():
+            sim.drop_connections()
+            return pj.get('Power', fresh=True)
+
+        # the reconnect backs off for a few seconds so keep the number of rounds low
+        assert benchmark.pedantic(drop_then_get, rounds=3, iterations=1) == 'LampOn'
+
+
+def test_failed_steps_fail_the_execution(reactor):
+    with JvcSimulator(drop_rate=1.0) as sim:
+        pj = on_reactor(reactor, PJController, make_config(sim), None)
+        execution = pj.send(['Contrast.Numeric.1', 'Brightness.Numeric.1'], verify=Verify.NEVER)
+    assert execution.state == FAILED
+    assert execution.to_json()['failedSteps'] == 2
+    assert execution.completed == 2
+    assert execution.error.startswith('2 of 2 steps failed: Contrast.Numeric.1 - ')
+
+
+def test_deferred_verify_reports_a_mismatch(reactor):
+    import time
+    from cmdserver.jvccommands import Command
+    from cmdserver.jvcsim import SimulatedProjector
+    from cmdserver.ws import WsServer
+
+    class Stubborn(SimulatedProjector):
+        """ acks every set but ignores those which change the picture mode """
+
+        def set(self, cmd, value):
+            if cmd != Command.PictureMode:
+                super().set(cmd, value)
+
+    class RecordingWs(WsServer):
+        def __init__(self):
+            super().__init__()
+            self.events = []
+
+        def event(self, source, payload):
+            self.events.append((source, payload))
+
+    ws = RecordingWs()
+    with JvcSimulator(projector=Stubborn()) as sim:
+        pj = on_reactor(reactor, PJController, make_config(sim, pj_verify={'default': 'never'}), None, ws)
+        execution = pj.send(['PictureMode.PictureMode.User1', 'Contrast.Numeric.1'], verify=Verify.DEFERRED)
+        deadline = time.monotonic() + 5
+        while not ws.events and time.monotonic() < deadline:
+            time.sleep(0.05)
+    assert execution.state == 'complete'
+    assert ws.events == [('pj', {'type': 'verifyFailed', 'command': 'PictureMode', 'expected': 'User1',
+                                 'actual': 'Film'})]
+
+
+def test_a_set_discards_values_it_may_have_changed(reactor):
+    from cmdserver.jvccommands import Command, Numeric
+
+    with JvcSimulator() as sim:
+        pj = on_reactor(reactor, PJController, make_config(sim), None)
+        assert pj.get('Contrast') == 0
+        # the projector restores the contrast of the picture mode it switches to
+        sim.projector.set(Command.Contrast, Numeric(5).value)
+        assert pj.get('Contrast') == 0
+        pj.send(['PictureMode.PictureMode.User2'], verify=Verify.NEVER)
+        assert pj.get('Contrast') == 5
@@ -0,0 +1,129 @@
+import json
+import queue
+import time
+from typing import List, Tuple
+
+import pytest
+from autobahn.twisted.resource import WebSocketResource
+from autobahn.twisted.websocket import WebSocketClientFactory, WebSocketClientProtocol, connectWS
+
+from cmdserver.metrics import WS_DROPPED
+from cmdserver.ws import WsServer
+from cmdserver.jvcsim import JvcSimulator
+from cmdserver.pjcontroller import PJController
+from conftest import on_reactor, make_config
+
+
+def listen(reactor, ws: WsServer):
+    from twisted.web import server as web
+    from twisted.web.resource import Resource
+    root = Resource()
+    root.putChild(b'ws', WebSocketResource(ws.factory))
+    return reactor.listenTCP(0, web.Site(root), interface='127.0.0.1')
+
+
+@pytest.fixture(scope='module')
+def server(reactor):
+    ws = WsServer()
+    port = on_reactor(reactor, listen, reactor, ws)
+    yield ws, port.getHost().port
+    on_reactor(reactor, port.stopListening)
+
+
+def connect(reactor, port: int, count: int = 1) -> Tuple[queue.Queue, List[WebSocketClientProtocol]]:
+    """ opens count clients which put every message they receive onto the returned queue """
+    received = queue.Queue()
+    opened = queue.Queue()
+
+    class Client(WebSocketClientProtocol):
+        def onOpen(self):
+            opened.put(self)
+
+        def onMessage(self, payload, is_binary):
+            received.put(json.loads(payload.decode('utf-8')))
+
+    def do_connect():
+        factory = WebSocketClientFactory(f'ws://127.0.0.1:{port}/ws')
+        factory.protocol = Client
+        for _ in range(count):
+            connectWS(factory)
+
+    on_reactor(reactor, do_connect)
+    return received, [opened.get(timeout=5) for _ in range(count)]
+
+
+def test_snapshot_then_deltas(reactor, server):
+    ws, port = server
+    on_reactor(reactor, ws.update, 'pj', power='LampOn', pictureMode='Natural')
+    received, _ = connect(reactor, port)
+    assert received.get(timeout=5) == {'type': 'snapshot', 'pj': {'power': 'LampOn', 'pictureMode': 'Natural'}}
+    ws.update('pj', power='LampOn', pictureMode='User1')
+    assert received.get(timeout=5) == {'type': 'pj', 'pictureMode': 'User1'}
+    ws.event('command', {'id': 'abc', 'state': 'complete'})
+    assert received.get(timeout=5) == {'type': 'command', 'event': {'id': 'abc', 'state': 'complete'}}
+
+
+@pytest.mark.parametrize('clients', [1, 16])
+def test_broadcast(benchmark, reactor, server, clients):
+    ws, port = server
+    connect(reactor, port, count=clients)
+
+    def broadcast_all():
+        for i in range(100):
+            ws.factory.broadcast(json.dumps({'type': 'pj', 'seq': i}))
+
+    benchmark.pedantic(lambda: on_reactor(reactor, broadcast_all), rounds=3)
+
+
+def test_slow_client_is_coalesced_to_latest(reactor, server):
+    ws, port = server
+    slow, (slow_client,) = connect(reactor, port)
+    fast, _ = connect(reactor, port)
+    assert slow.get(timeout=5)['type'] == 'snapshot'
+    assert fast.get(timeout=5)['type'] == 'snapshot'
+    dropped = WS_DROPPED.snapshot().get('', 0)
+    # stop reading so the server's socket buffer fills up
+    on_reactor(reactor, slow_client.transport.pauseProducing)
+    padding = 'x' * 65536
+    for i in range(500):
+        on_reactor(reactor, ws.factory.broadcast, json.dumps({'type': 'pj', 'seq': i, 'padding': padding}))
+    assert [fast.get(timeout=5)['seq'] for _ in range(500)] == list(range(500))
+    assert WS_DROPPED.snapshot()[''] > dropped
+    on_reactor(reactor, slow_client.transport.resumeProducing)
+    messages = []
+    while not messages or messages[-1]['type'] != 'snapshot':
+        messages.append(slow.get(timeout=5))
+    assert len(messages) < 500
+
+
+def test_pj_is_polled_only_while_a_client_is_connected(reactor):
+    with JvcSimulator() as sim:
+        ws = WsServer()
+        port = on_reactor(reactor, listen, reactor, ws)
+        on_reactor(reactor, PJController, make_config(sim, pj_polling={'lampOn': 0.1}), None, ws)
+        time.sleep(0.3)
+        assert sim.commands['Power'] == 0
+        received, (client,) = connect(reactor, port.getHost().port)
+        while received.get(timeout=5).get('power', None) != 'LampOn':
+            pass
+        on_reactor(reactor, client.sendClose)
+        while ws.clients:
+            time.sleep(0.05)
+        time.sleep(0.2)
+        polled = sim.commands['Power']
+        time.sleep(0.3)
+        assert sim.commands['Power'] == polled
+        on_reactor(reactor, port.stopListening)
+
+
+def test_pj_is_not_polled_without_a_pj(reactor, server):
+    def polls():
+        return [c for c in reactor.getDelayedCalls() if c.func.__qualname__ == 'PollScheduler.__fire']
+
+    ws, port = server
+    before = len(on_reactor(reactor, polls))
+    with JvcSimulator() as sim:
+        pj = on_reactor(reactor, PJController, make_config(sim, pj_ip=None), None, ws)
+    connect(reactor, port)
+    assert not pj.enabled
+    assert len(on_reactor(reactor, polls)) == before
@@ -1,7 +1,11 @@
 import logging
 
+from flask import request, Response
 from flask_restx import Resource, Namespace
 
+from cmdserver.commandcontroller import TooBusy
+from cmdserver.progress import stream_progress
+
 logger = logging.getLogger('command')
 
 api = Namespace('1/command', description='Provides ability to execute a configured command')
@@ -14,8 +18,30 @@ class Command(Resource):
         self.__controller = kwargs['command_controller']
 
     def put(self, command):
+        """
+        Launches the command and blocks until it has completed. ?async=true returns the job immediately instead while
+        ?stream=true streams the progress of the job as newline delimited json. Repeated requests with the same
+        Idempotency-Key header are coalesced onto the first.
+        """
         logger.info(f'Executing {command}')
-        result = self.__controller.execute(command)
+        key = request.headers.get('Idempotency-Key', None)
+        stream = request.args.get('stream', 'false').lower() == 'true'
+        try:
+            if not stream and request.args.get('async', 'false').lower() != 'true':
+                return self.__execute(command, key)
+            job = self.__controller.submit(command, idempotency_key=key)
+        except TooBusy as e:
+            logger.info(f'Rejecting {command} - {e}')
+            return {'error': str(e)}, 429
+        if job is None:
+            logger.info(f'Unknown {command}')
+            return None, 404
+        if stream:
+            return Response(stream_progress(job), mimetype='application/x-ndjson')
+        return job.to_json(), 202
+
+    def __execute(self, command, key):
+        result = self.__controller.execute(command, idempotency_key=key)
         if result is None:
             logger.info(f'Unknown {command}')
             return None, 404
@@ -26,3 +52,16 @@ class Command(Resource):
             else:
                 logger.info(f'Executed {command} with unexpected result {result[0]}')
                 return {'errorCode': result[0]}, 500
+
+
+@api.route('/job/<string:job_id>')
+class CommandJobStatus(Resource):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__controller = kwargs['command_controller']
+
+    def get(self, job_id):
+        job = self.__controller.get_job(job_id)
+        if job is None:
+            return None, 404
+        return job.to_json(), 200
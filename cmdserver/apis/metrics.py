@@ -0,0 +1,16 @@
+from flask import Response, request
+from flask_restx import Namespace, Resource
+
+from cmdserver.metrics import REGISTRY
+
+api = Namespace('1/metrics', description='Provides access to latency histograms and counters')
+
+
+@api.route('')
+class Metrics(Resource):
+
+    def get(self):
+        """ renders the metrics in the Prometheus text format, ?format=json returns a summary instead """
+        if request.args.get('format', None) == 'json':
+            return REGISTRY.snapshot(), 200
+        return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,9 +1,12 @@
 import logging
 
-from flask import request
+from flask import request, Response
 from flask_restx import Resource, Namespace
 
 from cmdserver.pjcontroller import PJController
+from cmdserver.pjmacro import InvalidCommand
+from cmdserver.pjverify import Verify
+from cmdserver.progress import FAILED, stream_progress
 
 logger = logging.getLogger('pj')
 
@@ -19,13 +22,16 @@ class PJ(Resource):
 
     def get(self, command):
         if self.__pj_controller.enabled:
-            logger.info(f">> GET {command}")
-            result = self.__pj_controller.get(command)
+            fresh = request.args.get('fresh', 'false').lower() == 'true'
+            logger.info(f">> GET {command}{' (fresh)' if fresh else ''}")
+            try:
+                result = self.__pj_controller.get(command, fresh=fresh)
+            except:
+                logger.info(f"<< GET {command} failed")
+                return None, 500
             logger.info(f"<< GET {command} = {result}")
             if result is None:
                 return None, 404
-            elif result == -1:
-                return None, 500
             else:
                 return result, 200
         else:
@@ -40,14 +46,75 @@ class UpdatePJ(Resource):
         self.__pj_controller: PJController = kwargs['pj_controller']
 
     def put(self):
+        """
+        Schedules the commands and returns the execution id immediately, ?wait=true blocks until the commands have
+        completed while ?stream=true streams the progress of the execution as newline delimited json.
+        ?verify=always|never|deferred overrides the configured verification mode.
+        """
         if self.__pj_controller.enabled:
             payload = request.get_json()
             logger.info(f"Executing {payload}")
-            result = self.__pj_controller.send(payload)
-            if result is None:
-                logger.info(f"Unknown command {payload}")
-                return None, 404
-            else:
-                return None, 200
+            try:
+                verify = Verify(request.args['verify']) if 'verify' in request.args else None
+            except ValueError:
+                return {'error': f"Unknown verify mode {request.args['verify']}"}, 400
+            try:
+                if request.args.get('wait', 'false').lower() == 'true':
+                    execution = self.__pj_controller.send(payload, verify=verify)
+                    if execution.state == FAILED:
+                        return execution.to_json(), 500
+                    return None, 200
+                execution = self.__pj_controller.execute(payload, verify=verify)
+            except InvalidCommand as e:
+                logger.info(f"Rejecting {payload} - {e}")
+                return {'error': str(e)}, 400
+            if request.args.get('stream', 'false').lower() == 'true':
+                return Response(stream_progress(execution), mimetype='application/x-ndjson')
+            return execution.to_json(), 202
+        else:
+            return None, 501
+
+
+@api.route('/execution/<string:execution_id>')
+class PJExecution(Resource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__pj_controller: PJController = kwargs['pj_controller']
+
+    def get(self, execution_id):
+        execution = self.__pj_controller.get_execution(execution_id)
+        if execution is None:
+            return None, 404
+        return execution.to_json(), 200
+
+
+@api.route('/gamma')
+class PJGamma(Resource):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__pj_controller: PJController = kwargs['pj_controller']
+
+    def get(self):
+        """ Downloads the custom gamma table for the red, green and blue channels """
+        if self.__pj_controller.enabled:
+            try:
+                return self.__pj_controller.get_gamma(), 200
+            except:
+                logger.exception('Unable to read gamma tables')
+                return None, 500
+        else:
+            return None, 501
+
+    def put(self):
+        """ Uploads the custom gamma table for each supplied channel, e.g. {"red": [...], "green": [...]} """
+        if self.__pj_controller.enabled:
+            try:
+                verify = Verify(request.args['verify']) if 'verify' in request.args else None
+                execution = self.__pj_controller.set_gamma(request.get_json(), verify=verify)
+            except ValueError as e:
+                return {'error': str(e)}, 400
+            return execution.to_json(), 202
         else:
             return None, 501
@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+from typing import Dict, Optional, Tuple
+
+from twisted.web import resource
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('assets')
+
+# files under static/ have a content hash in their name so can be cached forever
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'application/xml')
+MIN_COMPRESS_SIZE = 256
+
+
+class Asset:
+    """ A file held in memory along with its precompressed variants, each keyed by content-encoding """
+
+    def __init__(self, path: str, content: bytes):
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if self.content_type.startswith('text/') or self.content_type == 'application/javascript':
+            self.content_type += '; charset=utf-8'
+        self.cache_control = IMMUTABLE if path.startswith('static/') else REVALIDATE
+        digest = hashlib.sha256(content).hexdigest()[:32]
+        self.variants: Dict[str, Tuple[bytes, bytes]] = {'identity': (content, f'"{digest}"'.encode())}
+        if len(content) >= MIN_COMPRESS_SIZE and self.content_type.startswith(COMPRESSIBLE):
+            self.__add_variant('gzip', gzip.compress(content, compresslevel=9, mtime=0), digest)
+            if brotli is not None:
+                self.__add_variant('br', brotli.compress(content), digest)
+        self.etags = {etag for _, etag in self.variants.values()}
+
+    def __add_variant(self, encoding: str, content: bytes, digest: str):
+        if len(content) < len(self.variants['identity'][0]):
+            self.variants[encoding] = (content, f'"{digest}-{encoding}"'.encode())
+
+    def select(self, accept_encoding: str) -> Tuple[str, bytes, bytes]:
+        """ :return: the encoding, content and etag of the smallest variant the client accepts. """
+        accepted = {e.split(';')[0].strip().lower() for e in accept_encoding.split(',')} if accept_encoding else set()
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.variants:
+                return (encoding, *self.variants[encoding])
+        return ('identity', *self.variants['identity'])
+
+
+class AssetStore:
+    """
+    Every file under the UI root, loaded into memory once. Paths are relative to the root using / as the separator.
+    """
+
+    def __init__(self, root: str):
+        self.__root = root
+        self.__assets: Dict[str, Asset] = {}
+        self.__signature = None
+        self.reload()
+
+    def __scan(self) -> Dict[str, Tuple[float, int]]:
+        files = {}
+        if os.path.exists(self.__root):
+            for parent, _, names in os.walk(self.__root):
+                for name in names:
+                    full_path = os.path.join(parent, name)
+                    stat = os.stat(full_path)
+                    files[os.path.relpath(full_path, self.__root).replace(os.sep, '/')] = (stat.st_mtime, stat.st_size)
+        return files
+
+    def reload(self):
+        signature = self.__scan()
+        assets = {}
+        for path in signature.keys():
+            with open(os.path.join(self.__root, path), 'rb') as f:
+                assets[path] = Asset(path, f.read())
+        self.__assets = assets
+        self.__signature = signature
+        logger.info(f'Loaded {len(assets)} assets from {self.__root}')
+
+    def reload_if_changed(self):
+        """ rescans the root and reloads everything if any file has been added, removed or modified """
+        try:
+            if self.__scan() != self.__signature:
+                self.reload()
+        except:
+            logger.exception(f'Unable to reload assets from {self.__root}')
+
+    def get(self, path: str) -> Optional[Asset]:
+        return self.__assets.get(path, None)
+
+
+class AssetResource(resource.Resource):
+    """
+    Serves the asset at the request path, anything unknown outside of static/ gets index.html so the react app can
+    handle its own routes.
+    """
+    isLeaf = True
+
+    def __init__(self, store: AssetStore):
+        super().__init__()
+        self.__store = store
+
+    def render_GET(self, request):
+        path = '/'.join(p.decode('utf-8') for p in request.prepath + request.postpath if p)
+        asset = self.__store.get(path)
+        if asset is None and not path.startswith('static/'):
+            asset = self.__store.get('index.html')
+        if asset is None:
+            request.setResponseCode(404)
+            return b''
+        encoding, content, etag = asset.select(request.getHeader('accept-encoding'))
+        request.setHeader(b'vary', b'Accept-Encoding')
+        request.setHeader(b'cache-control', asset.cache_control.encode())
+        request.setHeader(b'etag', etag)
+        if_none_match = request.getHeader('if-none-match')
+        if if_none_match and (if_none_match.strip() == '*' or
+                              any(t.strip().encode() in asset.etags for t in if_none_match.split(','))):
+            request.setResponseCode(304)
+            return b''
+        request.setHeader(b'content-type', asset.content_type.encode())
+        if encoding != 'identity':
+            request.setHeader(b'content-encoding', encoding.encode())
+        request.setHeader(b'content-length', str(len(content)).encode())
+        return content
@@ -0,0 +1,190 @@
+import json
+import logging
+import queue
+import threading
+import time
+from subprocess import PIPE, DEVNULL
+from typing import List, Optional, Tuple
+
+from plumbum import local
+from plumbum.commands.processes import ProcessTimedOut
+
+logger = logging.getLogger('cmdhelper')
+
+LIVENESS_CHECK_INTERVAL = 1.0
+
+
+class HelperFailed(Exception):
+    """Raised when a resident helper cannot handle a request, the caller should fall back to a one shot launch"""
+    pass
+
+
+class HelperExited(Exception):
+    """Raised when a helper exits after accepting a request, the command may have run so must not be launched again"""
+    pass
+
+
+class HelperProcess:
+    """
+    A long lived helper process which handles one request at a time using a json line protocol, each request is
+    written to stdin as {"id": ..., "command": ..., "args": [...]} and answered by a line on stdout of the form
+    {"id": ..., "returnCode": ..., "output": ...}. Any other output is logged and ignored.
+    """
+
+    def __init__(self, name: str, exe: str, args: List[str]):
+        self.__name = name
+        self.__proc = local[exe][args].popen(stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        self.__lines: queue.Queue = queue.Queue()
+        self.__reader = threading.Thread(target=self.__read, name=f'{name}-reader', daemon=True)
+        self.__reader.start()
+        self.__seq = 0
+        self.__killed = False
+        logger.info(f'Started helper {self.__name} [pid: {self.__proc.pid}]')
+
+    @property
+    def alive(self) -> bool:
+        return not self.__killed and self.__proc.poll() is None
+
+    def __read(self):
+        for line in self.__proc.stdout:
+            self.__lines.put(line)
+        self.__lines.put(None)
+
+    def call(self, command_id: str, args: List[str], timeout: Optional[float] = None) -> Tuple[int, str]:
+        """
+        Sends a request to the helper and waits for the response.
+        :raises ProcessTimedOut: if no response arrives within the timeout, the helper is killed.
+        :raises HelperFailed: if the helper cannot be written to, i.e. the request was never delivered.
+        :raises HelperExited: if the helper exits before responding.
+        """
+        self.__seq += 1
+        request_id = f'{self.__proc.pid}-{self.__seq}'
+        try:
+            self.__proc.stdin.write((json.dumps({'id': request_id, 'command': command_id, 'args': args}) + '\n')
+                                    .encode('utf-8'))
+            self.__proc.stdin.flush()
+        except OSError as e:
+            self.kill()
+            raise HelperFailed(f'Unable to write to {self.__name} - {e}')
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            try:
+                line = self.__lines.get(timeout=max(deadline - time.monotonic(), 0) if deadline else None)
+            except queue.Empty:
+                self.kill()
+                raise ProcessTimedOut(f'{self.__name} did not respond within {timeout}s', [command_id])
+            if line is None:
+                raise HelperExited(f'{self.__name} exited with {self.__proc.wait()} before responding')
+            try:
+                response = json.loads(line)
+            except ValueError:
+                response = None
+            if isinstance(response, dict) and response.get('id', None) == request_id:
+                return int(response.get('returnCode', 0)), response.get('output', '')
+            logger.debug(f'{self.__name} << {line!r}')
+
+    def kill(self):
+        if self.alive:
+            logger.info(f'Stopping helper {self.__name} [pid: {self.__proc.pid}]')
+            self.__proc.kill()
+        self.__killed = True
+
+
+class HelperPool:
+    """
+    A fixed size pool of resident helpers for a family of commands sharing the same exe. Helpers are started ahead of
+    use and replaced whenever one exits so that process creation stays off the hot path.
+    """
+
+    def __init__(self, exe: str, args: List[str], size: int = 1):
+        self.__exe = exe
+        self.__args = args
+        self.__size = size
+        self.__idle: queue.Queue = queue.Queue()
+        self.__count = 0
+        self.__live = 0
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """ starts the helpers, failures are logged as each call falls back to a one shot launch anyway """
+        for _ in range(self.__size):
+            helper = self.__spawn()
+            if helper is not None:
+                self.__idle.put(helper)
+
+    def __spawn(self) -> Optional[HelperProcess]:
+        with self.__lock:
+            self.__count += 1
+            name = f'{self.__exe}#{self.__count}'
+        try:
+            helper = HelperProcess(name, self.__exe, self.__args)
+        except Exception:
+            logger.exception(f'Unable to start helper {name}')
+            return None
+        with self.__lock:
+            self.__live += 1
+        return helper
+
+    def call(self, command_id: str, args: List[str], timeout: Optional[float] = None) -> Tuple[int, str]:
+        """
+        Hands the request to an idle helper, waiting for one to become free if necessary.
+        :raises HelperFailed: if no helper is available.
+        :raises HelperExited: if the helper exits while handling the request.
+        """
+        helper = self.__take(timeout)
+        try:
+            return helper.call(command_id, args, timeout=timeout)
+        finally:
+            if not helper.alive:
+                helper.kill()
+                with self.__lock:
+                    self.__live -= 1
+                helper = self.__spawn()
+            if helper is not None:
+                self.__idle.put(helper)
+
+    def __take(self, timeout: Optional[float]) -> HelperProcess:
+        """
+        Waits for an idle helper, rechecking periodically that some helper is still running as the busy ones may die
+        and fail to respawn while we wait.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            if not self.__live:
+                raise HelperFailed(f'No helper is running for {self.__exe}')
+            wait = min(deadline - time.monotonic(), LIVENESS_CHECK_INTERVAL) if deadline else LIVENESS_CHECK_INTERVAL
+            try:
+                return self.__idle.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if deadline and time.monotonic() >= deadline:
+                    raise HelperFailed(f'No helper for {self.__exe} became available within {timeout}s')
+
+    def stop(self):
+        while True:
+            try:
+                self.__idle.get_nowait().kill()
+            except queue.Empty:
+                return
+
+
+class ResidentCommandExecutor:
+    """ Runs a command via a resident helper, falling back to launching the exe if the helper is unavailable """
+
+    def __init__(self, command_id: str, args: List[str], pool: HelperPool, fallback):
+        self.__command_id = command_id
+        self.__args = args
+        self.__pool = pool
+        self.__fallback = fallback
+
+    def __getitem__(self, item):
+        # hack to allow the execute command to work as expected
+        return self
+
+    def run(self, timeout: Optional[float] = None, **kwargs):
+        try:
+            return self.__pool.call(self.__command_id, self.__args, timeout=timeout)
+        except HelperFailed as e:
+            # the request was never delivered, whereas HelperExited propagates as the command may already have run
+            logger.warning(f'Falling back to launching {self.__command_id} - {e}')
+            # launched with exactly the args the helper would have been sent
+            return self.__fallback.run(timeout=timeout, **kwargs)
@@ -1,39 +1,158 @@
+import atexit
 import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
 from plumbum import local
+from plumbum.commands.processes import ProcessTimedOut
 
+from cmdserver.cmdhelper import HelperPool, ResidentCommandExecutor
+from cmdserver.metrics import COMMAND_LAUNCH, COMMAND_COALESCED
+from cmdserver.progress import RUNNING, COMPLETE, FAILED, Tracked, Recent
 
 logger = logging.getLogger('commandcontroller')
 
 
+class TooBusy(Exception):
+    """Raised when a command already has as many jobs in progress as it is allowed"""
+    pass
+
+
+class CommandJob(Tracked):
+    """
+    Tracks a single launch of a command. Progress is updated on a pool thread and may be observed from any thread.
+    """
+
+    def __init__(self, command_id: str):
+        super().__init__()
+        self.command_id = command_id
+        self.return_code: Optional[int] = None
+        self.output: Optional[str] = None
+        self.started_at: Optional[float] = None
+
+    @property
+    def result(self) -> Tuple[int, str]:
+        """ :return: the return code and output in the form returned by the launchers. """
+        return self.return_code, self.output if self.output is not None else self.error
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'command': self.command_id,
+            'state': self.state,
+            'returnCode': self.return_code,
+            'output': self.output,
+            'error': self.error,
+            'createdAt': self.created_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at
+        }
+
+    def running(self):
+        self.state = RUNNING
+        self.started_at = time.time()
+        self._notify()
+
+    def complete(self, return_code: int, output: str):
+        self.return_code = return_code
+        self.output = output
+        self.finished_at = time.time()
+        if return_code == 0:
+            self.state = COMPLETE
+        else:
+            self.error = f'Exited with {return_code}'
+            self.state = FAILED
+        self._notify()
+
+    def failed(self, return_code: int, error: str):
+        self.return_code = return_code
+        self.error = error
+        self.finished_at = time.time()
+        self.state = FAILED
+        self._notify()
+
+
 class CommandController:
 
     def __init__(self, config):
         actual_commands = {commandId: command for commandId, command in config.commands.items() if commandId != 'defaults'}
         defaults = config.commands['defaults'] if 'defaults' in config.commands else None
         self.__commands = {command_id: self.__add_defaults(command_id, command, defaults) for command_id, command in actual_commands.items()}
+        self.__helpers: Dict[Tuple[str, Tuple[str, ...]], HelperPool] = {}
         self.__launchers = {command_id: self.__get_launcher(command_id, command, defaults) for command_id, command in actual_commands.items()}
+        self.__pool = ThreadPoolExecutor(max_workers=config.command_workers, thread_name_prefix='command')
+        for helpers in self.__helpers.values():
+            self.__pool.submit(helpers.start)
+        if self.__helpers:
+            atexit.register(self.shutdown)
+        self.__jobs: Recent[CommandJob] = Recent()
+        self.__in_progress: Dict[str, int] = {command_id: 0 for command_id in self.__commands.keys()}
+        self.__latest: Dict[str, CommandJob] = {}
+        self.__idempotency_window = defaults.get('idempotencyWindow', 60) if defaults is not None else 60
+        self.__keys: Dict[Tuple[str, str], CommandJob] = {}
+        self.__lock = threading.Lock()
+        self.__listeners: List[Callable[[CommandJob], None]] = []
 
     @staticmethod
     def __add_defaults(command_id, command, defaults):
         if 'icon' not in command:
             command['icon'] = command_id + '.ico'
-        if 'zoneId' not in command and 'zoneId' in defaults:
-            command['zoneId'] = defaults['zoneId']
-        if 'volume' not in command and 'volume' in defaults:
-            command['volume'] = defaults['volume']
-        if 'stopAll' not in command and 'stopAll' in defaults:
-            command['stopAll'] = defaults['stopAll']
+        if defaults is not None:
+            for key in ['zoneId', 'volume', 'stopAll', 'timeout', 'concurrency', 'dedupe']:
+                if key not in command and key in defaults:
+                    command[key] = defaults[key]
         return command
 
-    @staticmethod
-    def __get_launcher(command_id, command, defaults):
+    def __get_launcher(self, command_id, command, defaults):
         if 'remote' in command:
-            return RemoteCommandExecutor(f"{defaults['remote_prefix']}/{command_id}")
+            prefixes = self.__remote_prefixes(command['remote'], defaults)
+            timeout = defaults.get('remote_timeout', (2, 10))
+            timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else (timeout, timeout)
+            return RemoteCommandExecutor([f"{p}/{command_id}" for p in prefixes], timeout=timeout,
+                                         retries=defaults.get('remote_retries', 2))
         else:
             exe = defaults['exe'] if defaults is not None and 'exe' in defaults else command['exe']
-            return local[exe][command['args']] if 'args' in command else local[exe]
+            launcher = local[exe][command['args']] if 'args' in command else local[exe]
+            resident = command.get('resident', defaults.get('resident', None) if defaults is not None else None)
+            if resident:
+                return ResidentCommandExecutor(command_id, self.__as_list(command.get('args', [])),
+                                               self.__get_helpers(exe, resident), launcher)
+            return launcher
+
+    @staticmethod
+    def __remote_prefixes(remote, defaults) -> List[str]:
+        """
+        :param remote: the remote item, either a flag or the url (or list of urls) to forward to.
+        :return: the urls the command is forwarded to, the remote_prefix from the defaults unless remote names them.
+        """
+        prefixes = remote if isinstance(remote, list) else [remote]
+        if prefixes and all(is_http_url(p) for p in prefixes):
+            return prefixes
+        return [defaults['remote_prefix']]
+
+    def __get_helpers(self, exe: str, resident) -> HelperPool:
+        """ commands which share the same exe and helper args share a pool of resident helpers """
+        resident = resident if isinstance(resident, dict) else {}
+        args = self.__as_list(resident.get('args', []))
+        key = (exe, tuple(args))
+        if key not in self.__helpers:
+            self.__helpers[key] = HelperPool(exe, args, size=resident.get('size', 1))
+        return self.__helpers[key]
+
+    @staticmethod
+    def __as_list(args) -> List[str]:
+        return [str(a) for a in args] if isinstance(args, list) else [str(args)]
+
+    def shutdown(self):
+        for helpers in self.__helpers.values():
+            helpers.stop()
 
     @property
     def commands(self):
@@ -42,30 +161,166 @@ class CommandController:
     def get_command(self, command_id):
         return self.__commands[command_id] if command_id in self.__commands else None
 
-    def execute(self, command_id):
+    def add_listener(self, listener: Callable[[CommandJob], None]):
+        """ registers a callback which is passed each job whenever it starts or finishes, called on a pool thread """
+        self.__listeners.append(listener)
+
+    def get_job(self, job_id: str) -> Optional[CommandJob]:
+        return self.__jobs.get(job_id)
+
+    def submit(self, command_id, idempotency_key: Optional[str] = None) -> Optional[CommandJob]:
+        """
+        Queues the command for launch on the command pool without waiting for it to complete. A repeat of a recent
+        launch of the same command, i.e. one with the same idempotency key or one within its dedupe window, is
+        coalesced onto the job which is already in flight or has just completed.
+        :param command_id: the command.
+        :param idempotency_key: a client supplied key identifying the request.
+        :return: the job tracking the launch, None if the command is unknown.
+        :raises TooBusy: if the command already has the configured number of jobs pending or running.
+        """
         command = self.get_command(command_id)
-        if command is not None:
-            result = self.__launchers[command_id]['executor'].run(retcode=None)
+        if command is None:
+            return None
+        limit = command.get('concurrency', None)
+        with self.__lock:
+            now = time.time()
+            self.__keys = {k: j for k, j in self.__keys.items() if self.__is_recent(j, self.__idempotency_window, now)}
+            job = self.__keys.get((command_id, idempotency_key), None) if idempotency_key else None
+            if job is None and command.get('dedupe', None):
+                latest = self.__latest.get(command_id, None)
+                if latest is not None and self.__is_recent(latest, command['dedupe'], now):
+                    job = latest
+            if job is not None:
+                logger.info(f'Coalescing {command_id} onto {job.id}')
+                COMMAND_COALESCED.inc(command=command_id)
+                return job
+            if limit and self.__in_progress[command_id] >= limit:
+                raise TooBusy(f'{command_id} already has {self.__in_progress[command_id]} jobs in progress')
+            self.__in_progress[command_id] += 1
+            job = self.__latest[command_id] = CommandJob(command_id)
+            if idempotency_key:
+                self.__keys[(command_id, idempotency_key)] = job
+        self.__jobs.add(job)
+        self.__pool.submit(self.__run, job, command.get('timeout', None))
+        return job
+
+    @staticmethod
+    def __is_recent(job: CommandJob, window: float, now: float) -> bool:
+        """ :return: true if the job is in flight or finished within the window. """
+        return not job.done or now - job.finished_at <= window
+
+    def execute(self, command_id, idempotency_key: Optional[str] = None):
+        """ Launches the command and blocks until it completes, :return: the return code and output. """
+        job = self.submit(command_id, idempotency_key=idempotency_key)
+        if job is None:
+            return None
+        job.wait()
+        return job.result
+
+    def __run(self, job: CommandJob, timeout: Optional[float]):
+        command_id = job.command_id
+        try:
+            job.running()
+            self.__notify(job)
+            with COMMAND_LAUNCH.time(command=command_id):
+                result = self.__launchers[command_id]['executor'].run(retcode=None, timeout=timeout)
             logger.info(f"Executed command {command_id}, result is {result[0]}")
             logger.info('Command output: ')
             logger.info(result[1])
-            return result
-        return None
+            job.complete(result[0], result[1])
+        except (ProcessTimedOut, requests.ReadTimeout) as e:
+            # remote commands without a timeout of their own are bounded by the remote_timeout instead
+            error = f'Timed out after {timeout}s' if timeout else f'Timed out - {e}'
+            logger.warning(f"Command {command_id} did not complete - {error}")
+            job.failed(-1, error)
+        except Exception as e:
+            logger.exception(f"Unable to execute command {command_id}")
+            job.failed(-1, str(e))
+        finally:
+            with self.__lock:
+                self.__in_progress[command_id] -= 1
+        self.__notify(job)
+
+    def __notify(self, job: CommandJob):
+        for listener in self.__listeners:
+            try:
+                listener(job)
+            except:
+                logger.exception(f'Listener failed to handle {job.id}')
 
 
 class RemoteCommandExecutor:
+    """
+    Forwards a command to one or more remote cmdservers, requests to the same host share a keep-alive session and
+    multiple remotes are called in parallel.
+    """
 
-    def __init__(self, address: str):
-        self.__address = address
-        logger.info(f"Created RemoteCommandExecutor for {self.__address}")
+    def __init__(self, addresses: List[str], timeout: Tuple[float, float] = (2, 10), retries: int = 2):
+        self.__addresses = addresses
+        self.__timeout = timeout
+        self.__retries = retries
+        logger.info(f"Created RemoteCommandExecutor for {', '.join(self.__addresses)}")
 
     def __getitem__(self, item):
         # hack to allow the execute command to work as expected
         return self
 
-    def run(self, **kwargs):
-        r = requests.put(self.__address)
-        if r.status_code == 200:
-            return [0, '']
+    def run(self, timeout: Optional[float] = None, **kwargs):
+        # a retried request may arrive twice so the key lets the remote discard the duplicate
+        key = uuid.uuid4().hex
+        timeout = (self.__timeout[0], timeout) if timeout else self.__timeout
+        if len(self.__addresses) == 1:
+            results = [self.__put(self.__addresses[0], timeout, key)]
         else:
-            return [2, f"{r.status_code} - {r.text}"]
+            results = list(FAN_OUT.map(lambda a: self.__put(a, timeout, key), self.__addresses))
+        failures = [r for r in results if r]
+        if failures:
+            return [2, '\n'.join(failures)]
+        return [0, '']
+
+    def __put(self, address: str, timeout: Tuple[float, float], key: str) -> Optional[str]:
+        """ :return: None if the remote executed the command, a description of the failure otherwise. """
+        try:
+            # wait for the remote to run the command so that its result is passed back
+            r = get_session(address, self.__retries).put(address, params={'wait': 'true'}, timeout=timeout,
+                                                         headers={'Idempotency-Key': key})
+        except requests.ReadTimeout:
+            # the remote may still be running the command so this is a timeout rather than a failure to forward
+            raise
+        except requests.RequestException as e:
+            logger.warning(f"Unable to forward to {address} - {e}")
+            return f"{address} - {e}"
+        if r.ok:
+            return None
+        return f"{r.status_code} - {r.text}"
+
+
+def is_http_url(value) -> bool:
+    if not isinstance(value, str):
+        return False
+    url = urlsplit(value)
+    return url.scheme in ('http', 'https') and bool(url.netloc)
+
+
+FAN_OUT = ThreadPoolExecutor(max_workers=8, thread_name_prefix='remote')
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(address: str, retries: int) -> requests.Session:
+    """
+    :return: the shared session for the host in the address, connect failures are retried with a short backoff.
+    """
+    host = urlsplit(address)
+    key = f'{host.scheme}://{host.netloc}'
+    with _sessions_lock:
+        session = _sessions.get(key, None)
+        if session is None:
+            session = _sessions[key] = requests.Session()
+            # only retry when the request cannot have reached the remote, a read error after the PUT was sent
+            # surfaces as is rather than risking a second launch
+            retry = Retry(total=retries, connect=retries, read=False, status=0, backoff_factor=0.1,
+                          allowed_methods=None)
+            session.mount(f'{key}/', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry))
+        return session
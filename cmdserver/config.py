@@ -17,12 +17,18 @@ class Config:
         self.iconPath = self.config.get('iconPath')
         self.__port = self.config.get('port', default_port)
         self.commands = self.config.get('commands', {})
+        self.command_workers = self.config.get('commandWorkers', 4)
         self.pj_macros = self.config.get('pjmacros', {})
         self.pj_ip = self.config.get('pjip', None)
         self.pj_password = self.config.get('pjPassword', None)
+        self.pj_port = self.config.get('pjPort', 20554)
+        self.pj_polling = self.config.get('pjPolling', {})
+        self.pj_verify = self.config.get('pjVerify', {})
         self.playingNowExe = self.config.get('playingNowExe', None)
         self.webappPath = self.config.get('webappPath', None)
         self.mqtt = self.config.get('mqtt', {})
+        self.metrics = self.config.get('metrics', {})
+        self.ws_queue_limit = self.config.get('wsQueueLimit', 64)
 
     @staticmethod
     def ensure_dir_exists(dir):
@@ -1,6 +1,109 @@
-from threading import Timer
+from collections import Counter
+from typing import Callable, Optional
 
-# from https://gist.github.com/walkermatt/2871026
+from twisted.python import threadable
+
+# totals across every Debouncer, keyed by scheduled, cancelled and fired
+COUNTERS = Counter()
+
+
+class Debouncer:
+    """
+    Postpones calls to fn until wait seconds have elapsed since the last time it was invoked. Calls are scheduled on
+    the reactor so a reschedule just moves the existing DelayedCall rather than starting a new thread, the most recent
+    arguments are used when fn is finally called.
+    """
+
+    def __init__(self, fn: Callable, wait: float, clock=None):
+        self.__fn = fn
+        self.__wait = wait
+        self.__clock = clock
+        self.__call = None
+        self.__args = ()
+        self.__kwargs = {}
+        self.__counters = Counter()
+
+    @property
+    def pending(self) -> bool:
+        return self.__call is not None and self.__call.active()
+
+    @property
+    def counters(self) -> Counter:
+        return self.__counters
+
+    def __call__(self, *args, **kwargs):
+        if threadable.isInIOThread():
+            self.__schedule(args, kwargs)
+        else:
+            self.__reactor.callFromThread(self.__schedule, args, kwargs)
+
+    def cancel(self):
+        if threadable.isInIOThread():
+            self.__cancel()
+        else:
+            self.__reactor.callFromThread(self.__cancel)
+
+    @property
+    def __reactor(self):
+        if self.__clock is None:
+            from twisted.internet import reactor
+            self.__clock = reactor
+        return self.__clock
+
+    def __schedule(self, args, kwargs):
+        self.__args = args
+        self.__kwargs = kwargs
+        if self.pending:
+            self.__count('cancelled')
+            self.__call.reset(self.__wait)
+        else:
+            self.__call = self.__reactor.callLater(self.__wait, self.__fire)
+        self.__count('scheduled')
+
+    def __cancel(self):
+        if self.pending:
+            self.__call.cancel()
+            self.__count('cancelled')
+        self.__call = None
+
+    def __fire(self):
+        self.__call = None
+        args, kwargs = self.__args, self.__kwargs
+        self.__args = ()
+        self.__kwargs = {}
+        self.__count('fired')
+        self.__fn(*args, **kwargs)
+
+    def __count(self, key: str):
+        self.__counters[key] += 1
+        COUNTERS[key] += 1
+
+
+class _Debounced:
+    """ Binds a Debouncer to each instance when used on a method, or shares one when used on a plain function """
+
+    def __init__(self, fn: Callable, wait: float):
+        self.__fn = fn
+        self.__wait = wait
+        self.__name = fn.__name__
+        self.__shared: Optional[Debouncer] = None
+
+    def __set_name__(self, owner, name):
+        self.__name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        key = f'_debounced_{self.__name}'
+        debouncer = instance.__dict__.get(key, None)
+        if debouncer is None:
+            debouncer = instance.__dict__[key] = Debouncer(self.__fn.__get__(instance, owner), self.__wait)
+        return debouncer
+
+    def __call__(self, *args, **kwargs):
+        if self.__shared is None:
+            self.__shared = Debouncer(self.__fn, self.__wait)
+        self.__shared(*args, **kwargs)
 
 
 def debounce(wait):
@@ -8,14 +111,5 @@ def debounce(wait):
         execution until after wait seconds
         have elapsed since the last time it was invoked. """
     def decorator(fn):
-        def debounced(*args, **kwargs):
-            def call_it():
-                fn(*args, **kwargs)
-            try:
-                debounced.t.cancel()
-            except AttributeError:
-                pass
-            debounced.t = Timer(wait, call_it)
-            debounced.t.start()
-        return debounced
+        return _Debounced(fn, wait)
     return decorator
@@ -0,0 +1,69 @@
+import json
+import logging
+from typing import Dict, Any
+
+from cmdserver.mqtt import MQTT
+
+logger = logging.getLogger('hass')
+
+# attribute published on cmdserver/pj/attributes/<attribute> -> entity name
+PJ_SENSORS = {
+    'pictureMode': 'Picture Mode',
+    'anamorphicMode': 'Anamorphic',
+    'installationMode': 'Installation Mode',
+    'model': 'Model',
+    'sourceInfo': 'Source',
+}
+
+
+class HomeAssistantDiscovery:
+    """
+    Publishes Home Assistant MQTT discovery configs so each PJ value appears as its own sensor, backed by its own
+    retained topic, and each configured command appears as a button which publishes to cmdserver/command/<id>/run.
+    """
+
+    def __init__(self, mqtt: MQTT, commands: Dict[str, Dict[str, Any]], version: str, prefix: str = 'homeassistant'):
+        self.__mqtt = mqtt
+        self.__commands = commands
+        self.__prefix = prefix
+        self.__node = mqtt.client_id
+        self.__device = {
+            'identifiers': [self.__node],
+            'name': self.__node,
+            'manufacturer': '3ll3d00d',
+            'model': 'cmdserver',
+            'sw_version': version,
+        }
+
+    def publish(self):
+        logger.info(f'Publishing discovery configs to {self.__prefix}')
+        self.__publish('sensor', 'pj_power', {
+            'name': 'Power',
+            'state_topic': 'cmdserver/pj/state',
+            'icon': 'mdi:projector',
+        })
+        for attribute, name in PJ_SENSORS.items():
+            config = {
+                'name': name,
+                'state_topic': f'cmdserver/pj/attributes/{attribute}',
+            }
+            if attribute == 'model':
+                config['entity_category'] = 'diagnostic'
+            self.__publish('sensor', f'pj_{attribute}', config)
+        for command_id, command in self.__commands.items():
+            self.__publish('button', f'command_{command_id}', {
+                'name': command.get('title', command_id),
+                'command_topic': f'cmdserver/command/{command_id}/run',
+                'payload_press': '{}',
+            }, pj=False)
+
+    def __publish(self, component: str, object_id: str, config: Dict[str, Any], pj: bool = True):
+        payload = {
+            **config,
+            'unique_id': f'{self.__node}_{object_id}',
+            'object_id': f'{self.__node}_{object_id}',
+            'device': self.__device,
+        }
+        if pj:
+            payload['availability_topic'] = 'cmdserver/pj/available'
+        self.__mqtt.discovery(self.__prefix, component, object_id, json.dumps(payload))
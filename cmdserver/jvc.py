@@ -7,6 +7,7 @@ import select
 import time
 
 from cmdserver.jvccommands import WriteOnly, BinaryData, ReadOnly, NoVerify
+from cmdserver.metrics import PJ_CONNECT, PJ_CONNECT_WAIT, PJ_HANDSHAKE, PJ_ACK_TIME, PJ_RESPONSE, PJ_ERRORS
 
 PJ_ACK = b'PJACK'
 
@@ -62,23 +63,37 @@ UNIT_ID = b'\x89\x01'
 END = b'\x0a'
 
 
+def auth_suffix(password):
+    """Computes the suffix appended to PJREQ during the handshake"""
+    if password is None:
+        return b''
+    import hashlib
+    import struct
+    m = hashlib.sha256(password.encode())
+    m.update(b'JVCKWPJ')
+    p = m.hexdigest()
+    return b'_' + struct.pack(f"{max(10, len(p))}s", p.encode())
+
+
 class Protocol:
     """JVC projector protocol, understands how to send commands and handle the responses"""
-    def __init__(self, host, password=None):
-        self.conn = Connection(host=host, password=password)
+    def __init__(self, host, port=DEFAULT_PORT, password=None):
+        self.conn = Connection(host=host, port=port, password=password)
         self.reconnect = False
 
     def __enter__(self):
         self.conn.__enter__()
+        self.reconnect = False
         return self
 
     def __exit__(self, exception, value, traceback):
         self.conn.__exit__(exception, value, traceback)
 
-    def __cmd(self, cmdtype, cmd, sendrawdata=None, acktimeout=2):
+    def __cmd(self, cmdtype, cmd, sendrawdata=None, acktimeout=2, name=None):
         """Send command and optional raw data and wait for acks"""
         logger.debug(f"  > Cmd:{cmdtype} {cmdtype.value+cmd}")
         assert cmdtype == Header.operation or cmdtype == Header.reference
+        name = name if name else cmd[:2].decode('ascii', errors='replace')
 
         retry_count = 1
 
@@ -95,9 +110,11 @@ class Protocol:
                     raise
             except CommandNack:
                 self.reconnect = True
+                PJ_ERRORS.inc(command=name, error='nack')
                 raise
             except:
                 self.reconnect = True
+                PJ_ERRORS.inc(command=name, error='error')
                 logger.exception(f"Unexpected exception for Cmd:{cmdtype} {cmdtype.value+cmd}")
                 raise
 
@@ -105,7 +122,8 @@ class Protocol:
             if self.reconnect:
                 self.conn.reconnect()
                 self.reconnect = False
-            do_send(lambda: self.__send_cmd(acktimeout, cmd, cmdtype))
+            with PJ_ACK_TIME.time(command=name):
+                do_send(lambda: self.__send_cmd(acktimeout, cmd, cmdtype))
             do_send(lambda: self.__send_raw_data(cmd, cmdtype, sendrawdata))
             break
 
@@ -128,7 +146,8 @@ class Protocol:
     def cmd_ref(self, cmd, **kwargs):
         """Send reference command and retrieve response"""
         self.__cmd(Header.reference, cmd, **kwargs)
-        data = self.conn.recv()
+        with PJ_RESPONSE.time(command=kwargs.get('name', None) or cmd[:2].decode('ascii', errors='replace')):
+            data = self.conn.recv()
         header = Header.response.value + UNIT_ID + cmd[:2]
         if not data.startswith(header):
             raise Exception('Expected response header', header, data)
@@ -138,13 +157,16 @@ class Protocol:
         logger.debug(f"  < Response: {res}")
         return res
 
-    def cmd_ref_bin(self, cmd, **kwargs):
-        """Send command and retrieve binary response"""
+    def cmd_ref_bin(self, cmd, length=None, **kwargs):
+        """Send command and retrieve binary response, reading exactly length bytes if it is known"""
         self.__cmd(Header.reference, cmd, **kwargs)
+        name = kwargs.get('name', None) or cmd[:2].decode('ascii', errors='replace')
         try:
-            res = self.conn.recv(timeout=10)
+            with PJ_RESPONSE.time(command=name):
+                res = self.conn.recv(timeout=10) if length is None else self.conn.recv_exactly(length, timeout=10)
         except Timeout:
             self.reconnect = True
+            PJ_ERRORS.inc(command=name, error='timeout')
             raise
         logger.debug(f"  < Response:{res}")
         return res
@@ -159,15 +181,9 @@ class Connection:
         self.__socket_timeout = socket_timeout
         if password is not None:
             logger.info(f"Connecting to {host}:{port} using password: {password}")
-            import hashlib
-            import struct
-            m = hashlib.sha256(password.encode())
-            m.update(b'JVCKWPJ')
-            p = m.hexdigest()
-            self._auth_suffix = b'_' + struct.pack(f"{max(10, len(p))}s", p.encode())
         else:
             logger.info(f"Connecting to {host}:{port} (no password)")
-            self._auth_suffix = b''
+        self._auth_suffix = auth_suffix(password)
         self.__close_time = 0.0
 
     def connect(self):
@@ -179,13 +195,16 @@ class Connection:
             if to_wait > 0:
                 close_time_fmt = datetime.fromtimestamp(self.__close_time).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
                 logger.info(f"Waiting {to_wait:.3f}s to reopen socket [closed at: {close_time_fmt}]")
-                time.sleep(to_wait)
+                with PJ_CONNECT_WAIT.time(client='sync'):
+                    time.sleep(to_wait)
             try:
                 logger.info(f"Connecting to {self.__host}:{self.__port} with timeout of {self.__socket_timeout}s")
                 self.__socket.settimeout(self.__socket_timeout)
-                self.__socket.connect((self.__host, self.__port))
+                with PJ_CONNECT.time(client='sync'):
+                    self.__socket.connect((self.__host, self.__port))
                 logger.info(f"Connected to {self.__host}:{self.__port}")
-                self.__init_pj()
+                with PJ_HANDSHAKE.time(client='sync'):
+                    self.__init_pj()
             except socket.timeout:
                 raise Timeout(f"Connection failed on timeout [{self.__host}:{self.__port}]")
             except Exception as err:
@@ -254,6 +273,23 @@ class Connection:
         logger.debug(f"< Received:{data}")
         return data
 
+    def recv_exactly(self, length, timeout=10):
+        """Receive exactly length bytes, which may arrive in several segments, within timeout seconds"""
+        buf = bytearray(length)
+        view = memoryview(buf)
+        received = 0
+        deadline = time.time() + timeout
+        while received < length:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.__socket], [], [], remaining)[0]:
+                raise Timeout(f"{timeout} second timeout expired after {received}/{length} bytes")
+            n = self.__socket.recv_into(view[received:])
+            if not n:
+                raise Closed('Connection closed by projector')
+            received += n
+        logger.debug(f"< Received {length} bytes")
+        return bytes(buf)
+
     def expect(self, expected, timeout=1):
         """Receive data and compare it against expected data"""
         try:
@@ -268,8 +304,8 @@ class Connection:
 
 class CommandExecutor:
     """ Provides ability to execute specific commands """
-    def __init__(self, host, password=None):
-        self.conn = Protocol(host, password=password)
+    def __init__(self, host, port=DEFAULT_PORT, password=None):
+        self.conn = Protocol(host, port=port, password=password)
 
     def __enter__(self):
         self.conn.__enter__()
@@ -291,7 +327,10 @@ class CommandExecutor:
         cmdcode, valtype = cmd.value
         if issubclass(valtype, WriteOnly):
             raise TypeError('{} is a write only command'.format(cmd.name))
-        response = self.conn.cmd_ref_bin(cmdcode) if issubclass(valtype, BinaryData) else self.conn.cmd_ref(cmdcode)
+        if issubclass(valtype, BinaryData):
+            response = self.conn.cmd_ref_bin(cmdcode, length=valtype.SIZE, name=cmd.name)
+        else:
+            response = self.conn.cmd_ref(cmdcode, name=cmd.name)
         return valtype(response)
 
     def set(self, cmd, val, verify=True):
@@ -301,9 +340,9 @@ class CommandExecutor:
         val = valtype(val)
         assert(isinstance(val, valtype)), '{} is not {}'.format(val, valtype)
         if issubclass(valtype, BinaryData):
-            self.conn.cmd_op(cmdcode, sendrawdata=val.value)
+            self.conn.cmd_op(cmdcode, sendrawdata=val.value, name=cmd.name)
         else:
-            self.conn.cmd_op(cmdcode+val.value, acktimeout=5)
+            self.conn.cmd_op(cmdcode+val.value, acktimeout=5, name=cmd.name)
 
         if not verify or issubclass(valtype, NoVerify):
             return
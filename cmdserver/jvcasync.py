@@ -0,0 +1,439 @@
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional, List, Deque
+
+from twisted.internet import defer, protocol, task
+from twisted.python.failure import Failure
+
+from cmdserver.jvc import Header, UNIT_ID, END, PJ_OK, PJ_REQ, PJ_ACK, DEFAULT_PORT, BadData, Closed, Timeout, \
+    CommandNack, auth_suffix
+from cmdserver.jvccommands import WriteOnly, BinaryData, ReadOnly, NoVerify, Command
+from cmdserver.metrics import PJ_CONNECT, PJ_CONNECT_WAIT, PJ_HANDSHAKE, PJ_ACK_TIME, PJ_RESPONSE, PJ_ERRORS
+
+logger = logging.getLogger('jvcasync')
+
+ACK = 'ack'
+DATA_ACK = 'data_ack'
+RESPONSE = 'response'
+
+
+@dataclass
+class Request:
+    """A single command on the wire along with the Deferred that fires with its response"""
+    header: Header
+    cmd: bytes
+    raw_data: Optional[bytes] = None
+    response_length: Optional[int] = None
+    ack_timeout: float = 2
+    response_timeout: float = 2
+    stage: str = ACK
+    name: Optional[str] = None
+    sent_at: float = 0.0
+    acked_at: float = 0.0
+    deferred: defer.Deferred = field(default_factory=defer.Deferred)
+
+    def __post_init__(self):
+        if self.name is None:
+            self.name = self.cmd[:2].decode('ascii', errors='replace')
+
+    @property
+    def ack(self) -> bytes:
+        return Header.ack.value + UNIT_ID + self.cmd[:2] + END
+
+    @property
+    def response_header(self) -> bytes:
+        return Header.response.value + UNIT_ID + self.cmd[:2]
+
+
+class JvcProtocol(protocol.Protocol):
+    """
+    Non blocking implementation of the JVC wire format. Commands are queued and written in batches, a batch is usually a
+    single command but reference commands may be pipelined, in which case the acks and responses are matched to the
+    outstanding commands by their two byte prefix. Each command returns a Deferred which fires with the response (if
+    any) once the projector has acknowledged it.
+    """
+
+    def __init__(self, auth: bytes = b'', keepalive_interval: float = 2.0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.__clock = clock
+        self.__auth = auth
+        self.__keepalive_interval = keepalive_interval
+        self.__buffer = bytearray()
+        self.__handshake: Optional[bytes] = PJ_OK
+        self.__queue: Deque[List[Request]] = deque()
+        self.__in_flight: List[Request] = []
+        self.__timer = None
+        self.__keepalive = None
+        self.__last_used = 0.0
+        self.__connected_at = 0.0
+        self.ready = defer.Deferred()
+
+    def connectionMade(self):
+        logger.debug('>> Protocol init')
+        self.__connected_at = time.perf_counter()
+        self.__start_timer(2, 'handshake')
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        logger.info(f'Connection to projector lost [{reason.getErrorMessage()}]')
+        self.__cancel_timer()
+        if self.__keepalive is not None and self.__keepalive.running:
+            self.__keepalive.stop()
+        err = Closed(reason.getErrorMessage())
+        if not self.ready.called:
+            self.ready.errback(Failure(err))
+        pending = self.__in_flight
+        for batch in self.__queue:
+            pending.extend(batch)
+        self.__in_flight = []
+        self.__queue.clear()
+        for r in pending:
+            PJ_ERRORS.inc(command=r.name, error='closed')
+            r.deferred.errback(Failure(err))
+
+    def request(self, header: Header, cmd: bytes, raw_data: Optional[bytes] = None,
+                response_length: Optional[int] = None, ack_timeout: float = 2,
+                response_timeout: float = 2, name: Optional[str] = None) -> defer.Deferred:
+        """
+        Queues a command for sending.
+        :param header: operation or reference.
+        :param cmd: the command code plus any argument.
+        :param raw_data: binary data sent after the command is acknowledged.
+        :param response_length: the length of a binary response, if None the response is an @ header line.
+        :param name: the command name used to label metrics, defaults to the two byte prefix.
+        :return: a Deferred which fires with the response (reference) or None (operation).
+        """
+        assert header == Header.operation or header == Header.reference
+        req = Request(header, cmd, raw_data=raw_data, response_length=response_length, ack_timeout=ack_timeout,
+                      response_timeout=response_timeout, name=name)
+        self.__queue.append([req])
+        self.__send_next()
+        return req.deferred
+
+    def request_many(self, cmds: List[bytes], response_timeout: float = 2,
+                     names: Optional[List[str]] = None) -> List[defer.Deferred]:
+        """
+        Queues a batch of reference commands which are written to the projector in one go.
+        :param cmds: the command codes.
+        :param names: the command names used to label metrics.
+        :return: a Deferred per command which fires with the response.
+        """
+        names = names if names else [None] * len(cmds)
+        batch = [Request(Header.reference, cmd, response_timeout=response_timeout, name=name)
+                 for cmd, name in zip(cmds, names)]
+        if batch:
+            self.__queue.append(batch)
+            self.__send_next()
+        return [r.deferred for r in batch]
+
+    def dataReceived(self, data):
+        self.__buffer.extend(data)
+        try:
+            if self.__handshake is not None:
+                self.__process_handshake()
+            if self.__handshake is None:
+                self.__process_responses()
+        except BadData as e:
+            logger.error(f'Protocol error, dropping connection: {e}')
+            self.__fail_in_flight(e)
+            self.transport.loseConnection()
+
+    def __process_handshake(self):
+        while self.__handshake is not None and len(self.__buffer) >= len(self.__handshake):
+            token = self.__consume(len(self.__handshake))
+            if token != self.__handshake:
+                raise BadData(self.__handshake, token)
+            if token == PJ_OK:
+                self.__handshake = PJ_ACK
+                self.transport.write(PJ_REQ + self.__auth)
+            else:
+                self.__handshake = None
+                self.__cancel_timer()
+                PJ_HANDSHAKE.observe(time.perf_counter() - self.__connected_at, client='async')
+                logger.debug('<< Protocol init')
+                self.__last_used = self.__clock.seconds()
+                if self.__keepalive_interval:
+                    self.__keepalive = task.LoopingCall(self.__ping)
+                    self.__keepalive.clock = self.__clock
+                    self.__keepalive.start(self.__keepalive_interval / 2, now=False)
+                self.ready.callback(self)
+                self.__send_next()
+
+    def __process_responses(self):
+        while self.__in_flight:
+            head = self.__in_flight[0]
+            if head.stage == RESPONSE and head.response_length is not None:
+                if len(self.__buffer) < head.response_length:
+                    return
+                res = self.__consume(head.response_length)
+                logger.debug(f"  < Response: {res}")
+                self.__complete(head, res)
+                continue
+            idx = self.__buffer.find(END)
+            if idx == -1:
+                return
+            frame = self.__consume(idx + 1)
+            if frame[:1] == Header.ack.value:
+                self.__on_ack(frame)
+            else:
+                self.__on_response(frame)
+        if self.__buffer:
+            logger.warning(f'Discarding unexpected data {bytes(self.__buffer)}')
+            self.__buffer.clear()
+
+    def __on_ack(self, frame: bytes):
+        req = next((r for r in self.__in_flight if r.stage != RESPONSE and r.ack == frame), None)
+        if req is None:
+            raise BadData(self.__in_flight[0].ack, frame)
+        if req.stage == ACK:
+            req.acked_at = time.perf_counter()
+            PJ_ACK_TIME.observe(req.acked_at - req.sent_at, command=req.name)
+        if req.stage == ACK and req.raw_data is not None:
+            req.stage = DATA_ACK
+            self.transport.write(req.raw_data)
+            self.__start_timer(20, f'data ack {req.cmd}')
+        elif req.header == Header.reference:
+            req.stage = RESPONSE
+            self.__restart_timer()
+        else:
+            self.__complete(req, None)
+
+    def __on_response(self, frame: bytes):
+        req = next((r for r in self.__in_flight if r.stage == RESPONSE and frame.startswith(r.response_header)), None)
+        if req is None:
+            raise BadData(self.__in_flight[0].response_header, frame)
+        res = frame[len(req.response_header):-1]
+        logger.debug(f"  < Response: {res}")
+        self.__complete(req, res)
+
+    def __consume(self, length: int) -> bytes:
+        with memoryview(self.__buffer) as view:
+            data = bytes(view[:length])
+        del self.__buffer[:length]
+        return data
+
+    def __send_next(self):
+        if not self.__in_flight and self.__handshake is None and self.__queue:
+            batch = self.__queue.popleft()
+            self.__in_flight = batch
+            data = b''.join(r.header.value + UNIT_ID + r.cmd + END for r in batch)
+            now = time.perf_counter()
+            for r in batch:
+                r.sent_at = now
+            logger.debug(f"  > Cmd:{batch[0].header} {data}")
+            self.transport.write(data)
+            self.__restart_timer()
+
+    def __complete(self, req: Request, result):
+        self.__in_flight.remove(req)
+        if req.stage == RESPONSE:
+            PJ_RESPONSE.observe(time.perf_counter() - req.acked_at, command=req.name)
+        self.__last_used = self.__clock.seconds()
+        req.deferred.callback(result)
+        if self.__in_flight:
+            self.__restart_timer()
+        else:
+            self.__cancel_timer()
+            self.__send_next()
+
+    def __fail_in_flight(self, err: Exception):
+        self.__cancel_timer()
+        in_flight = self.__in_flight
+        self.__in_flight = []
+        error = 'nack' if isinstance(err, CommandNack) else 'timeout' if isinstance(err, Timeout) else 'error'
+        for req in in_flight:
+            PJ_ERRORS.inc(command=req.name, error=error)
+            req.deferred.errback(Failure(err))
+
+    def __restart_timer(self):
+        head = self.__in_flight[0]
+        if head.stage == RESPONSE:
+            self.__start_timer(head.response_timeout, f'response {head.cmd}')
+        else:
+            self.__start_timer(head.ack_timeout, f'ack {head.cmd}')
+
+    def __start_timer(self, timeout: float, stage: str):
+        self.__cancel_timer()
+        self.__timer = self.__clock.callLater(timeout, self.__timed_out, timeout, stage)
+
+    def __cancel_timer(self):
+        if self.__timer is not None:
+            if self.__timer.active():
+                self.__timer.cancel()
+            self.__timer = None
+
+    def __timed_out(self, timeout: float, stage: str):
+        self.__timer = None
+        logger.warning(f'Timed out after {timeout}s waiting for {stage}, dropping connection')
+        head = self.__in_flight[0] if self.__in_flight else None
+        if head is not None and head.stage == ACK and head.raw_data is None:
+            self.__fail_in_flight(CommandNack(f'Command not acknowledged [{head.header} {head.cmd}]'))
+        else:
+            self.__fail_in_flight(Timeout(f'{timeout} second timeout expired waiting for {stage}'))
+        self.transport.loseConnection()
+
+    def __ping(self):
+        idle = self.__clock.seconds() - self.__last_used
+        if not self.__in_flight and not self.__queue and idle >= self.__keepalive_interval:
+            self.request(Header.operation, Command.Null.value[0], name=Command.Null.name).addErrback(
+                lambda f: logger.warning(f'Keepalive failed {f.getErrorMessage()}'))
+
+
+class JvcClientFactory(protocol.ReconnectingClientFactory):
+    """
+    Holds a single session open to the projector and reopens it in the background, with back-off, if it is dropped.
+    """
+    # the projector refuses a new session if one is opened too soon after the last one closed
+    initialDelay = 2.5
+    maxDelay = 30
+
+    def __init__(self, password: Optional[str] = None, keepalive_interval: float = 2.0):
+        self.__auth = auth_suffix(password)
+        self.__keepalive_interval = keepalive_interval
+        self.__protocol: Optional[JvcProtocol] = None
+        self.__waiters = []
+        self.__started_at = 0.0
+        self.__lost_at = None
+
+    def startedConnecting(self, connector):
+        self.__started_at = time.perf_counter()
+        if self.__lost_at is not None:
+            PJ_CONNECT_WAIT.observe(self.__started_at - self.__lost_at, client='async')
+            self.__lost_at = None
+
+    @property
+    def session(self) -> Optional[JvcProtocol]:
+        return self.__protocol
+
+    def buildProtocol(self, addr):
+        PJ_CONNECT.observe(time.perf_counter() - self.__started_at, client='async')
+        p = JvcProtocol(auth=self.__auth, keepalive_interval=self.__keepalive_interval, clock=self.clock)
+        p.factory = self
+        p.ready.addCallbacks(self.__on_ready, lambda f: None)
+        return p
+
+    def __on_ready(self, p: JvcProtocol):
+        logger.info('Projector session is open')
+        self.resetDelay()
+        self.__protocol = p
+        waiters, self.__waiters = self.__waiters, []
+        for d in waiters:
+            if not d.called:
+                d.callback(p)
+
+    def clientConnectionLost(self, connector, reason):
+        self.__protocol = None
+        self.__lost_at = time.perf_counter()
+        super().clientConnectionLost(connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        logger.warning(f'Unable to connect to projector [{reason.getErrorMessage()}]')
+        self.__protocol = None
+        self.__lost_at = time.perf_counter()
+        super().clientConnectionFailed(connector, reason)
+
+    def when_ready(self, timeout: float) -> defer.Deferred:
+        """
+        :param timeout: how long to wait for a session to be opened.
+        :return: a Deferred which fires with the open session.
+        """
+        if self.__protocol is not None:
+            return defer.succeed(self.__protocol)
+        from twisted.internet import reactor
+        d = defer.Deferred()
+        self.__waiters.append(d)
+
+        def on_timeout(result, t):
+            raise Timeout(f'No projector session available after {t}s')
+
+        d.addTimeout(timeout, self.clock or reactor, onTimeoutCancel=on_timeout)
+        return d
+
+
+class AsyncCommandExecutor:
+    """ Provides ability to execute specific commands without blocking the caller, results are delivered via Deferred """
+
+    def __init__(self, host, port=DEFAULT_PORT, password=None, keepalive_interval=2.0, connect_timeout=5.0):
+        self.__host = host
+        self.__port = port
+        self.__connect_timeout = connect_timeout
+        self.__factory = JvcClientFactory(password=password, keepalive_interval=keepalive_interval)
+        self.__connector = None
+
+    @property
+    def connected(self):
+        return self.__factory.session is not None
+
+    def start(self):
+        if self.__connector is None:
+            from twisted.internet import reactor
+            logger.info(f"Connecting to {self.__host}:{self.__port}")
+            self.__connector = reactor.connectTCP(self.__host, self.__port, self.__factory,
+                                                  timeout=self.__connect_timeout)
+
+    def stop(self):
+        self.__factory.stopTrying()
+        if self.__connector is not None:
+            self.__connector.disconnect()
+            self.__connector = None
+
+    @defer.inlineCallbacks
+    def get(self, cmd):
+        """Send reference command and convert response"""
+        if isinstance(cmd.value, bytes):
+            raise NotImplementedError('Get is not implemented for {}'.format(cmd.name))
+        cmdcode, valtype = cmd.value
+        if issubclass(valtype, WriteOnly):
+            raise TypeError('{} is a write only command'.format(cmd.name))
+        session = yield self.__factory.when_ready(self.__connect_timeout)
+        if issubclass(valtype, BinaryData):
+            response = yield session.request(Header.reference, cmdcode, response_length=valtype.SIZE,
+                                             response_timeout=10, name=cmd.name)
+        else:
+            response = yield session.request(Header.reference, cmdcode, name=cmd.name)
+        return valtype(response)
+
+    @defer.inlineCallbacks
+    def get_many(self, cmds: List[Command]):
+        """Send the reference commands as a single pipelined batch and convert the responses, in the same order"""
+        valtypes = []
+        for cmd in cmds:
+            if isinstance(cmd.value, bytes):
+                raise NotImplementedError('Get is not implemented for {}'.format(cmd.name))
+            valtype = cmd.value[1]
+            if issubclass(valtype, WriteOnly):
+                raise TypeError('{} is a write only command'.format(cmd.name))
+            if issubclass(valtype, BinaryData):
+                raise TypeError('{} returns binary data so cannot be batched'.format(cmd.name))
+            valtypes.append(valtype)
+        session = yield self.__factory.when_ready(self.__connect_timeout)
+        try:
+            responses = yield defer.gatherResults(session.request_many([cmd.value[0] for cmd in cmds],
+                                                                       names=[cmd.name for cmd in cmds]),
+                                                  consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
+        return [valtype(response) for valtype, response in zip(valtypes, responses)]
+
+    @defer.inlineCallbacks
+    def set(self, cmd, val, verify=True):
+        """Send operation command"""
+        cmdcode, valtype = cmd.value
+        assert not issubclass(valtype, ReadOnly), '{} is a read only command'.format(cmd)
+        val = valtype(val)
+        assert (isinstance(val, valtype)), '{} is not {}'.format(val, valtype)
+        session = yield self.__factory.when_ready(self.__connect_timeout)
+        if issubclass(valtype, BinaryData):
+            yield session.request(Header.operation, cmdcode, raw_data=val.value, name=cmd.name)
+        else:
+            yield session.request(Header.operation, cmdcode + val.value, ack_timeout=5, name=cmd.name)
+
+        if not verify or issubclass(valtype, NoVerify):
+            return
+
+        verify_val = yield self.get(cmd)
+        if verify_val != val:
+            raise CommandNack('Verify error: ' + cmd.name, val, verify_val)
@@ -1,4 +1,6 @@
 import logging
+import sys
+from array import array
 from enum import Enum
 
 logger = logging.getLogger(__name__)
@@ -37,37 +39,36 @@ class Model(ReadOnly, Enum):
 
 def s8_bytes_to_list(bstr):
     """Convert 8bit signed bytes to list"""
-    return [b if b < 0x80 else b - 0x100 for b in bstr]
-
-
-def num_to_s8(num):
-    """Convert signed number to 8bit (unsigned)"""
-    assert -0x80 <= num < 0x80, '{} out of range'.format(num)
-    return num & 0xff
+    return array('b', bstr).tolist()
 
 
 def list_to_s8_bytes(numlist):
     """Convert list of signed numbers to 8bit bytes"""
-    return bytes(num_to_s8(num) for num in numlist)
+    assert all(-0x80 <= num < 0x80 for num in numlist), '{} out of range'.format(numlist)
+    return array('b', numlist).tobytes()
 
 
-def le16_bytes_to_list(bstr):
-    """Convert 16bit little-endian bytes to list"""
-    i = iter(bstr)
-    return [lb + 256 * next(i) for lb in i]
+def le16_bytes_to_array(bstr):
+    """View 16bit little-endian bytes as an array of unsigned shorts"""
+    a = array('H')
+    a.frombytes(bstr)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
 
 
-def le16_split(table):
-    """Split table entries 16bit little-endian byte pairs"""
-    for val in table:
-        assert not val >> 16
-        yield val % 256
-        yield int(val / 256)
+def le16_bytes_to_list(bstr):
+    """Convert 16bit little-endian bytes to list"""
+    return le16_bytes_to_array(bstr).tolist()
 
 
 def list_to_le16_bytes(table):
     """Convert list to 16bit little-endian bytes"""
-    return bytes(le16_split(table))
+    assert all(0 <= val <= 0xffff for val in table), '{} out of range'.format(table)
+    a = array('H', table)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
 
 
 class Numeric(int):
@@ -76,14 +77,15 @@ class Numeric(int):
     def __new__(cls, value):
         if isinstance(value, bytes):
             assert len(value) == 4, '{} is not 4 bytes'.format(value)
-            cls.value = value
         else:
             assert -0x8000 <= value <= 0x7fff, '{} out of range'.format(value)
-            cls.value = bytes('{:04X}'.format(value & 0xffff), 'ascii')
-        num = int(cls.value, 16)
+            value = bytes('{:04X}'.format(value & 0xffff), 'ascii')
+        num = int(value, 16)
         if num & 0x8000:
             num = num - 0x10000
-        return super(Numeric, cls).__new__(cls, num)
+        obj = super(Numeric, cls).__new__(cls, num)
+        obj.value = value
+        return obj
 
 
 class NumericReadOnly(ReadOnly, Numeric):
@@ -93,10 +95,11 @@ class NumericReadOnly(ReadOnly, Numeric):
 
 class CustomGammaTable(BinaryData, list):
     """Custom gamma table data"""
+    SIZE = 512
 
     def __init__(self, value):
         if isinstance(value, bytes):
-            assert len(value) == 512, '{} is not 512 bytes'.format(value)
+            assert len(value) == self.SIZE, '{} is not {} bytes'.format(value, self.SIZE)
             self.value = value
         else:
             assert len(value) == 256, '{} does not have 256 entries'.format(value)
@@ -107,10 +110,11 @@ class CustomGammaTable(BinaryData, list):
 
 class PanelAlignment(BinaryData, list):
     """Panel Alignment Data"""
+    SIZE = 256
 
     def __init__(self, value):
         if isinstance(value, bytes):
-            assert len(value) == 256, '{} is not 256 bytes'.format(value)
+            assert len(value) == self.SIZE, '{} is not {} bytes'.format(value, self.SIZE)
             self.value = value
         else:
             assert len(value) == 256, '{} does not have 256 entries'.format(value)
@@ -548,7 +552,8 @@ class SourceData(ReadOnly, str):
     """Input Info Source Information"""
 
     def __new__(cls, value):
-        return SourceData.KNOWN_VALUES[value]
+        # newer models report signals which are not in the table, pass those through rather than failing the read
+        return SourceData.KNOWN_VALUES.get(value, value.decode('ascii', errors='replace'))
 
 
 class DeepColorData(ReadOnly, str):
@@ -617,6 +622,13 @@ class AutoToneMappingData(ReadOnly, str):
         return AutoToneMappingData.KNOWN_VALUES[value]
 
 
+class SoftVersionData(ReadOnly, str):
+    """Information Soft Version"""
+
+    def __new__(cls, value):
+        return str.__new__(cls, value.decode('ascii'))
+
+
 class Command(Enum):
     """Command codes (and return types)"""
     Null = b'\0\0', Null  # NULL command
@@ -788,7 +800,7 @@ class Command(Enum):
     InfoDeepColor = b'IFDC', DeepColorData  # Deep Color display
     InfoColorSpace = b'IFXV', ColorSpaceData  # Color space display
     InfoLampTime = b'IFLT', NumericReadOnly  # Lamp Time display
-    InfoSoftVersion = b'IFSV'  # Soft Version Display
+    InfoSoftVersion = b'IFSV', SoftVersionData  # Soft Version Display
     InfoColorimetry = b'IFCM', ColorimetryData  # Colorimetry Display
     InfoHDR = b'IFHR', HDRData
     InfoMaxCLL = b'IFMC', Numeric
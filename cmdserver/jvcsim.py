@@ -0,0 +1,315 @@
+import logging
+import random
+import socket
+import socketserver
+import threading
+import time
+from collections import Counter
+from enum import Enum
+from typing import Dict, Optional, Tuple
+
+from cmdserver.jvc import PJ_OK, PJ_REQ, PJ_ACK, DEFAULT_PORT, UNIT_ID, END, Header, auth_suffix
+from cmdserver.jvccommands import Command, BinaryData, WriteOnly, ReadOnly, Numeric, Model, PowerState, \
+    RemoteCode, SoftVersionData
+
+logger = logging.getLogger('jvcsim')
+
+
+def _load_codes() -> Dict[bytes, Command]:
+    codes = {}
+    for cmd in Command:
+        if isinstance(cmd.value, tuple):
+            codes[cmd.value[0]] = cmd
+        else:
+            # some codes are listed twice (e.g. INML), prefer the command which knows its value type
+            codes.setdefault(cmd.value, cmd)
+    return codes
+
+
+# the commands the simulator understands, keyed by the code sent on the wire
+CODES: Dict[bytes, Command] = _load_codes()
+
+
+def initial_value(cmd: Command) -> Optional[bytes]:
+    """ :return: the encoded value the simulator reports for a command until it is changed, None if it has none. """
+    if not isinstance(cmd.value, tuple):
+        return None
+    valtype = cmd.value[1]
+    if issubclass(valtype, WriteOnly):
+        return None
+    if issubclass(valtype, BinaryData):
+        return bytes(valtype.SIZE)
+    if issubclass(valtype, Enum):
+        return next(iter(valtype)).value
+    if issubclass(valtype, Numeric):
+        return Numeric(0).value
+    if issubclass(valtype, SoftVersionData):
+        return b'1.00'
+    if hasattr(valtype, 'KNOWN_VALUES'):
+        return next(iter(valtype.KNOWN_VALUES))
+    return None
+
+
+class SimulatedProjector:
+    """
+    The state of a simulated projector, i.e. the current value of every command in the Command table. Shared by all
+    connections to the simulator.
+    """
+
+    def __init__(self, model: Model = Model.DLA_N7, power: PowerState = PowerState.LampOn):
+        self.__lock = threading.Lock()
+        self.__values: Dict[Command, bytes] = {}
+        for cmd in Command:
+            val = initial_value(cmd)
+            if val is not None:
+                self.__values[cmd] = val
+        self.__values[Command.Model] = model.value
+        self.__values[Command.Power] = power.value
+
+    def get(self, cmd: Command) -> Optional[bytes]:
+        with self.__lock:
+            return self.__values.get(cmd, None)
+
+    def set(self, cmd: Command, value: bytes):
+        with self.__lock:
+            if cmd == Command.Remote:
+                if value == RemoteCode.On.value:
+                    self.__values[Command.Power] = PowerState.LampOn.value
+                elif value == RemoteCode.Standby.value:
+                    self.__values[Command.Power] = PowerState.Standby.value
+            elif cmd in self.__values:
+                self.__values[cmd] = value
+
+
+class JvcRequestHandler(socketserver.BaseRequestHandler):
+    """ Speaks the JVC protocol to a single client on behalf of the simulator """
+
+    def setup(self):
+        self.sim: JvcSimulator = self.server.simulator
+        self.buffer = bytearray()
+        # the ack and response are separate writes, don't let Nagle hold the response back
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sim.connected(self.request)
+
+    def finish(self):
+        self.sim.disconnected(self.request)
+
+    def handle(self):
+        try:
+            self.request.sendall(PJ_OK)
+            expected = PJ_REQ + self.sim.auth_suffix
+            if self.__read(len(expected)) != expected:
+                logger.warning('Handshake failed, closing connection')
+                return
+            self.request.sendall(PJ_ACK)
+            while True:
+                line = self.__readline()
+                if line is None:
+                    return
+                if not self.__handle_command(line):
+                    return
+        except (ConnectionError, OSError):
+            logger.debug('Connection closed')
+
+    def __handle_command(self, line: bytes) -> bool:
+        header, unit, payload = line[:1], line[1:3], line[3:]
+        if unit != UNIT_ID or header not in (Header.operation.value, Header.reference.value):
+            logger.warning(f'Ignoring malformed command {line}')
+            return True
+        cmd, code = self.__lookup(payload)
+        self.sim.count(cmd.name if cmd else 'unknown')
+        self.sim.delay()
+        if self.sim.should_drop():
+            logger.info(f'Dropping connection on {line}')
+            return False
+        if cmd is None:
+            logger.warning(f'Unknown command {line}')
+            return True
+        ack = Header.ack.value + UNIT_ID + code[:2] + END
+        valtype = cmd.value[1] if isinstance(cmd.value, tuple) else None
+        if header == Header.operation.value:
+            if valtype is not None and issubclass(valtype, ReadOnly):
+                return True
+            self.request.sendall(ack)
+            if valtype is not None and issubclass(valtype, BinaryData):
+                data = self.__read(valtype.SIZE)
+                if data is None:
+                    return False
+                self.sim.projector.set(cmd, data)
+                self.request.sendall(ack)
+            elif valtype is not None:
+                self.sim.projector.set(cmd, payload[len(code):])
+        else:
+            value = self.sim.projector.get(cmd)
+            if value is None:
+                return True
+            self.request.sendall(ack)
+            if issubclass(valtype, BinaryData):
+                self.request.sendall(value)
+            else:
+                self.request.sendall(Header.response.value + UNIT_ID + code[:2] + value + END)
+        return True
+
+    @staticmethod
+    def __lookup(payload: bytes) -> Tuple[Optional[Command], bytes]:
+        for length in (4, 2):
+            cmd = CODES.get(payload[:length], None)
+            if cmd is not None:
+                return cmd, payload[:length]
+        return None, payload
+
+    def __readline(self) -> Optional[bytes]:
+        while True:
+            idx = self.buffer.find(END)
+            if idx != -1:
+                line = bytes(self.buffer[:idx])
+                del self.buffer[:idx + 1]
+                return line
+            if not self.__fill():
+                return None
+
+    def __read(self, length: int) -> Optional[bytes]:
+        while len(self.buffer) < length:
+            if not self.__fill():
+                return None
+        data = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        return data
+
+    def __fill(self) -> bool:
+        data = self.request.recv(4096)
+        if not data:
+            return False
+        self.buffer.extend(data)
+        return True
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class JvcSimulator:
+    """
+    A local TCP server which behaves like a JVC projector: it performs the handshake, acknowledges commands, answers
+    reference commands (including binary data) from a SimulatedProjector and can add latency or drop connections.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, password: Optional[str] = None,
+                 latency: float = 0.0, jitter: float = 0.0, drop_rate: float = 0.0, seed: Optional[int] = None,
+                 projector: Optional[SimulatedProjector] = None):
+        """
+        :param port: the port to listen on, 0 picks a free port.
+        :param latency: seconds to wait before responding to each command.
+        :param jitter: a random extra delay of up to this many seconds.
+        :param drop_rate: the probability that the connection is dropped instead of responding to a command.
+        :param seed: seeds the random source used for jitter and drops.
+        """
+        self.projector = projector if projector else SimulatedProjector()
+        self.auth_suffix = auth_suffix(password)
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.commands = Counter()
+        self.connections = 0
+        self.dropped = 0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__clients = set()
+        self.__server = _Server((host, port), JvcRequestHandler, bind_and_activate=True)
+        self.__server.simulator = self
+        self.__thread = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.__server.server_address[:2]
+
+    @property
+    def port(self) -> int:
+        return self.address[1]
+
+    @property
+    def active_connections(self) -> int:
+        with self.__lock:
+            return len(self.__clients)
+
+    def start(self) -> 'JvcSimulator':
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__server.serve_forever, name='jvc-simulator', daemon=True)
+            self.__thread.start()
+            logger.info(f'JVC simulator listening on {self.address[0]}:{self.port}')
+        return self
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__server.shutdown()
+            self.__thread = None
+        self.drop_connections()
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exception, value, traceback):
+        self.stop()
+
+    def drop_connections(self):
+        """ closes every open connection, as happens when the projector restarts its network stack """
+        with self.__lock:
+            clients = list(self.__clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def connected(self, client: socket.socket):
+        with self.__lock:
+            self.__clients.add(client)
+            self.connections += 1
+
+    def disconnected(self, client: socket.socket):
+        with self.__lock:
+            self.__clients.discard(client)
+
+    def count(self, name: str):
+        with self.__lock:
+            self.commands[name] += 1
+
+    def delay(self):
+        wait = self.latency + (self.__random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def should_drop(self) -> bool:
+        if self.drop_rate and self.__random.random() < self.drop_rate:
+            with self.__lock:
+                self.dropped += 1
+            return True
+        return False
+
+
+def main(args=None):
+    """ Runs the simulator on the standard JVC port so cmdserver can be pointed at it """
+    import argparse
+    parser = argparse.ArgumentParser(description='Simulates a JVC projector')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parsed = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    sim = JvcSimulator(host=parsed.host, port=parsed.port, password=parsed.password, latency=parsed.latency,
+                       jitter=parsed.jitter, drop_rate=parsed.drop_rate)
+    sim.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,22 @@
 import faulthandler
+import json
 import os
+import time
 from os import path
+from typing import Optional
 
-from flask import Flask
+from flask import Flask, g, request
 from flask_restx import Api
 
 from cmdserver.pjcontroller import PJController
-from cmdserver.apis import command, commands, pj, info, version
+from cmdserver.apis import command, commands, pj, info, version, metrics
 from cmdserver.commandcontroller import CommandController
 from cmdserver.config import Config
+from cmdserver.hass import HomeAssistantDiscovery
+from cmdserver.metrics import HTTP_REQUEST, MetricsPublisher
 from cmdserver.mqtt import MQTT
+from cmdserver.mqttcommands import MQTTCommandChannel
+from cmdserver.ws import WsServer
 
 API_PREFIX = '/api/1'
 
@@ -20,17 +27,28 @@ if hasattr(faulthandler, 'register'):
     faulthandler.register(signal.SIGUSR2, all_threads=True)
 
 
-def create_app(cfg: Config) -> Flask:
+def create_app(cfg: Config, ws: Optional[WsServer] = None) -> Flask:
     mqtt = None
     if cfg.mqtt:
-        mqtt = MQTT(cfg.mqtt['ip'], cfg.mqtt.get('port', 1883), cfg.mqtt.get('user', None), cfg.mqtt.get('cred', None))
+        mqtt = MQTT(cfg.mqtt['ip'], cfg.mqtt.get('port', 1883), cfg.mqtt.get('user', None), cfg.mqtt.get('cred', None),
+                    heartbeat=cfg.mqtt.get('heartbeat', 0), queue_limit=cfg.mqtt.get('queueLimit', 256))
+    command_controller = CommandController(cfg)
+    if mqtt:
+        command_controller.add_listener(lambda job: mqtt.event('command', json.dumps(job.to_json())))
+    if ws:
+        command_controller.add_listener(lambda job: ws.event('command', job.to_json()))
     resource_args = {
-        'command_controller': CommandController(cfg),
-        'pj_controller': PJController(cfg, mqtt),
+        'command_controller': command_controller,
+        'pj_controller': PJController(cfg, mqtt, ws),
         'mqtt': mqtt,
         'config': cfg,
         'version': cfg.version
     }
+    if mqtt:
+        MQTTCommandChannel(mqtt, resource_args['pj_controller'], command_controller)
+        if cfg.mqtt.get('discovery', False):
+            HomeAssistantDiscovery(mqtt, command_controller.commands, cfg.version,
+                                   prefix=cfg.mqtt.get('discoveryPrefix', 'homeassistant')).publish()
     app = Flask('cmdserver')
     api = Api(app, prefix='/api', doc='/api/doc/', version=resource_args['version'], title='cmdserver',
               description='Backend api for cmdserver')
@@ -45,50 +63,48 @@ def create_app(cfg: Config) -> Flask:
     decorate_ns(info.api)
     decorate_ns(pj.api)
     decorate_ns(version.api)
+    decorate_ns(metrics.api)
+    instrument(app)
+    publish_interval = cfg.metrics.get('mqttInterval', 0) if cfg.metrics else 0
+    if mqtt and publish_interval:
+        from twisted.internet import reactor
+        reactor.callWhenRunning(MetricsPublisher(mqtt, publish_interval).start)
     return app
 
 
+def instrument(app: Flask):
+    """ records how long each API request takes, keyed by the route rather than the url to bound the label values """
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_time(response):
+        started = g.get('request_started', None)
+        if started is not None:
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            HTTP_REQUEST.observe(time.perf_counter() - started, method=request.method, endpoint=endpoint,
+                                 status=response.status_code)
+        return response
+
+
 def main(args=None):
     """ The main routine. """
     cfg = Config('cmdserver')
     logger = cfg.configure_logger()
-    app = create_app(cfg)
+    ws_server = WsServer(queue_limit=cfg.ws_queue_limit)
+    app = create_app(cfg, ws_server)
 
     import logging
     logger = logging.getLogger('twisted')
     from twisted.internet import reactor
     from twisted.web.resource import Resource
     from twisted.web import static, server
+    from cmdserver.assets import AssetStore, AssetResource
     from twisted.web.wsgi import WSGIResource
     from twisted.application import service
     from twisted.internet import endpoints
-
-    class ReactApp:
-        """
-        Handles the react app (excluding the static dir).
-        """
-
-        def __init__(self, path):
-            # TODO allow this to load when in debug mode even if the files don't exist
-            self.publicFiles = {f: static.File(os.path.join(path, f)) for f in os.listdir(path) if
-                                os.path.exists(os.path.join(path, f))} if os.path.exists(path) else {}
-            self.indexHtml = ReactIndex(os.path.join(path, 'index.html'))
-
-        def get_file(self, path):
-            """
-            overrides getChild so it always just serves index.html unless the file does actually exist (i.e. is an
-            icon or something like that)
-            """
-            return self.publicFiles.get(path.decode('utf-8'), self.indexHtml)
-
-    class ReactIndex(static.File):
-        """
-        a twisted File which overrides getChild so it always just serves index.html (NB: this is a bit of a hack,
-        there is probably a more correct way to do this but...)
-        """
-
-        def getChild(self, path, request):
-            return self
+    from autobahn.twisted.resource import WebSocketResource
 
     class FlaskAppWrapper(Resource):
         """
@@ -113,15 +129,20 @@ def main(args=None):
                 logger.info(f'Serving ui from {uiRoot}')
             else:
                 logger.info('No UI, API only')
-            self.react = ReactApp(uiRoot)
-            self.static = static.File(os.path.join(uiRoot, 'static'))
+            self.assets = AssetStore(uiRoot)
+            self.ui = AssetResource(self.assets)
+            if cfg.run_in_debug:
+                from twisted.internet import task
+                logger.info(f'Watching {uiRoot} for changes')
+                task.LoopingCall(self.assets.reload_if_changed).start(2.0, now=False)
             self.icons = static.File(cfg.iconPath)
+            self.ws = WebSocketResource(ws_server.factory)
 
         def getChild(self, path, request):
             """
             Overrides getChild to allow the request to be routed to the wsgi app (i.e. flask for the rest api
-            calls), the static dir (i.e. for the packaged css/js etc), the various concrete files (i.e. the public
-            dir from react-app), the command icons or to index.html (i.e. the react app) for everything else.
+            calls), the command icons, the websocket or the in memory ui assets (i.e. the packaged css/js etc, the
+            public dir from react-app and index.html for everything else).
             :param path:
             :param request:
             :return:
@@ -136,12 +157,12 @@ def main(args=None):
                 request.prepath.pop()
                 request.postpath.insert(0, path)
                 return self.wsgi
-            elif path == b'static':
-                return self.static
             elif path == b'icons':
                 return self.icons
+            elif path == b'ws':
+                return self.ws
             else:
-                return self.react.get_file(path)
+                return self.ui
 
         def render(self, request):
             return self.wsgi.render(request)
@@ -0,0 +1,289 @@
+import bisect
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from cmdserver.debounce import COUNTERS as DEBOUNCE_COUNTERS
+
+logger = logging.getLogger('metrics')
+
+# upper bounds (in seconds) of the latency buckets, tuned for a LAN connected projector and locally launched commands
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    """ Common behaviour of a named metric whose values are keyed by a fixed set of label names """
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        if set(labels.keys()) != set(self.labels):
+            raise ValueError(f'{self.name} expects labels {self.labels}, got {tuple(labels.keys())}')
+        return tuple(str(labels[n]) for n in self.labels)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def snapshot(self):
+        raise NotImplementedError()
+
+
+class _Value(_Metric):
+    """ A single value per label set, either recorded directly or read from a callback when the metrics are collected """
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self.__callbacks: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set_function(self, fn: Callable[[], float], **labels):
+        """ reads the value from fn whenever the metrics are collected """
+        key = self._key(labels)
+        with self._lock:
+            self.__callbacks[key] = fn
+
+    def _items(self) -> List[Tuple[LabelValues, float]]:
+        with self._lock:
+            values = dict(self._values)
+            callbacks = list(self.__callbacks.items())
+        for k, fn in callbacks:
+            try:
+                values[k] = fn()
+            except:
+                logger.exception(f'Unable to collect {self.name}')
+        return list(values.items())
+
+    def _render_samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, k)} {_format_value(v)}' for k, v in self._items()]
+
+    def snapshot(self):
+        return {','.join(k): v for k, v in self._items()}
+
+
+class Counter(_Value):
+    """ A value which only goes up """
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Value):
+    """ A value which can go up and down """
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """ Counts observations into cumulative buckets, also tracks their sum so the mean can be derived """
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: a count per bucket (plus one for +Inf) and the sum
+        self.__values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self.__values.get(key, (None, None))
+            if counts is None:
+                counts, total = self.__values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts[idx] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ observes the time taken by the body of the with block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def __items(self):
+        with self._lock:
+            return [(k, list(counts), total[0]) for k, (counts, total) in self.__values.items()]
+
+    def _render_samples(self) -> List[str]:
+        lines = []
+        for k, counts, total in self.__items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, k, ("le", _format_value(bound)))} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, k)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, k)} {cumulative}')
+        return lines
+
+    def __quantile(self, counts: List[int], q: float) -> float:
+        """ estimates the quantile by interpolating within the bucket it falls in, as Prometheus does """
+        total = sum(counts)
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return 0.0
+
+    def snapshot(self):
+        return {
+            ','.join(k): {
+                'count': sum(counts),
+                'sum': total,
+                'p50': self.__quantile(counts, 0.5),
+                'p95': self.__quantile(counts, 0.95),
+                'p99': self.__quantile(counts, 0.99)
+            } for k, counts, total in self.__items() if sum(counts)
+        }
+
+
+class Registry:
+    """ Holds every metric so they can be rendered together, metrics are created on first use and then shared """
+
+    def __init__(self):
+        self.__metrics: Dict[str, _Metric] = {}
+        self.__lock = threading.Lock()
+
+    def __get_or_create(self, clazz, name: str, description: str, labels: Sequence[str], **kwargs):
+        with self.__lock:
+            metric = self.__metrics.get(name, None)
+            if metric is None:
+                metric = self.__metrics[name] = clazz(name, description, labels, **kwargs)
+            elif not isinstance(metric, clazz) or metric.labels != tuple(labels):
+                raise ValueError(f'{name} is already registered as a {metric.kind} with labels {metric.labels}')
+            return metric
+
+    def counter(self, name: str, description: str, labels: Sequence[str] = ()) -> Counter:
+        return self.__get_or_create(Counter, name, description, labels)
+
+    def gauge(self, name: str, description: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.__get_or_create(Gauge, name, description, labels)
+
+    def histogram(self, name: str, description: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.__get_or_create(Histogram, name, description, labels, buckets=buckets)
+
+    def __all(self) -> List[_Metric]:
+        with self.__lock:
+            return list(self.__metrics.values())
+
+    def render(self) -> str:
+        """ :return: every metric in the Prometheus text exposition format. """
+        return '\n'.join(line for m in self.__all() for line in m.render()) + '\n'
+
+    def snapshot(self) -> Dict[str, object]:
+        """ :return: a json friendly summary of every metric, histograms are reduced to counts and quantiles. """
+        return {m.name: m.snapshot() for m in self.__all()}
+
+
+REGISTRY = Registry()
+
+PJ_CONNECT = REGISTRY.histogram('cmdserver_pj_connect_seconds',
+                                'Time taken to open a TCP connection to the projector', ['client'])
+PJ_CONNECT_WAIT = REGISTRY.histogram('cmdserver_pj_connect_wait_seconds',
+                                     'Time spent waiting for the projector to accept a new connection', ['client'])
+PJ_HANDSHAKE = REGISTRY.histogram('cmdserver_pj_handshake_seconds',
+                                  'Time taken to complete the PJ_OK/PJREQ/PJACK handshake', ['client'])
+PJ_ACK_TIME = REGISTRY.histogram('cmdserver_pj_ack_seconds',
+                                 'Time from sending a command to receiving its ack', ['command'])
+PJ_RESPONSE = REGISTRY.histogram('cmdserver_pj_response_seconds',
+                                 'Time from receiving the ack of a reference command to receiving its response',
+                                 ['command'])
+PJ_ERRORS = REGISTRY.counter('cmdserver_pj_errors_total', 'Commands which failed', ['command', 'error'])
+PJ_LOCK_WAIT = REGISTRY.histogram('cmdserver_pj_lock_wait_seconds',
+                                  'Time a task waited for exclusive use of the projector', ['priority'])
+PJ_QUEUE_DEPTH = REGISTRY.gauge('cmdserver_pj_queue_depth',
+                                'Tasks waiting for exclusive use of the projector', ['priority'])
+COMMAND_LAUNCH = REGISTRY.histogram('cmdserver_command_launch_seconds',
+                                    'Time taken to run a configured command', ['command'])
+COMMAND_COALESCED = REGISTRY.counter('cmdserver_command_coalesced_total',
+                                     'Launches coalesced onto a recent launch of the same command', ['command'])
+HTTP_REQUEST = REGISTRY.histogram('cmdserver_http_request_seconds',
+                                  'Time taken to handle an API request', ['method', 'endpoint', 'status'])
+WS_CLIENTS = REGISTRY.gauge('cmdserver_ws_clients', 'Connected websocket clients')
+WS_DROPPED = REGISTRY.counter('cmdserver_ws_dropped_total',
+                              'Messages dropped for websocket clients which fell behind, they are sent a snapshot instead')
+MQTT_QUEUE_DEPTH = REGISTRY.gauge('cmdserver_mqtt_queue_depth', 'Messages waiting to be handed to the MQTT client')
+MQTT_PUBLISH = REGISTRY.histogram('cmdserver_mqtt_publish_seconds',
+                                  'Time from queueing a message to receiving its PUBACK')
+MQTT_DROPPED = REGISTRY.counter('cmdserver_mqtt_dropped_total', 'Messages dropped because the publish queue was full')
+PJ_POLLS_SKIPPED = REGISTRY.counter('cmdserver_pj_polls_skipped_total',
+                                    'Polls postponed because an interactive command was in flight')
+DEBOUNCE = REGISTRY.counter('cmdserver_debounce_total', 'Debounced calls by outcome', ['event'])
+for _event in ('scheduled', 'cancelled', 'fired'):
+    DEBOUNCE.set_function(lambda e=_event: DEBOUNCE_COUNTERS[e], event=_event)
+
+
+class MetricsPublisher:
+    """ Periodically publishes a json snapshot of the metrics over MQTT """
+
+    def __init__(self, mqtt, interval: float, registry: Registry = REGISTRY):
+        self.__mqtt = mqtt
+        self.__interval = interval
+        self.__registry = registry
+        self.__loop = None
+
+    def start(self):
+        from twisted.internet import task
+        if self.__loop is None:
+            logger.info(f'Publishing metrics every {self.__interval}s')
+            self.__loop = task.LoopingCall(self.publish)
+            self.__loop.start(self.__interval, now=False)
+
+    def stop(self):
+        if self.__loop is not None and self.__loop.running:
+            self.__loop.stop()
+        self.__loop = None
+
+    def publish(self):
+        try:
+            self.__mqtt.metrics(json.dumps(self.__registry.snapshot()))
+        except:
+            logger.exception('Unable to publish metrics')
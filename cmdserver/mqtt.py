@@ -1,45 +1,214 @@
 import atexit
+import itertools
 import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Set, Tuple, Union
 
 import paho.mqtt.client as mqtt
 
+from cmdserver.metrics import MQTT_QUEUE_DEPTH, MQTT_PUBLISH, MQTT_DROPPED
+
 logger = logging.getLogger('mqtt')
 
 
 class MQTT:
-    def __init__(self, ip: str, port: int = 1883, user: str = None, cred: str = None):
+    """
+    Publishes to topics under cmdserver/. Retained values are only published when they change, the last value of each
+    is republished every heartbeat seconds (if set) in case the broker has lost it. Handlers may be registered for
+    topics under cmdserver/, they are (re)subscribed whenever the client connects.
+
+    Publishing never blocks the caller. Messages are handed to the client only while it is connected and has fewer
+    than max_in_flight messages awaiting a PUBACK, the rest wait in a bounded queue which is flushed in order as acks
+    arrive or the client reconnects. The queue holds only the latest payload of each retained topic while other
+    messages, i.e. events and results, are each delivered. Once full, the oldest non retained message is dropped in
+    preference to the oldest retained one.
+    """
+
+    def __init__(self, ip: str, port: int = 1883, user: str = None, cred: str = None, heartbeat: float = 0,
+                 queue_limit: int = 256, max_in_flight: int = 20):
         import socket
         hostname = socket.gethostname()
         client_id = f'cmdserver-{hostname}'
+        self.client_id = client_id
         logger.info(f'Initialising MQTT client {client_id} to {ip}:{port}')
         self.__client = mqtt.Client(client_id=client_id)
         self.__client.on_connect = self.__on_connect
         self.__client.on_message = self.__on_message
         self.__client.on_disconnect = self.__on_disconnect
+        self.__client.on_publish = self.__on_publish
+        self.__client.max_inflight_messages_set(max_in_flight)
         if user and cred:
             self.__client.username_pw_set(user, password=cred)
         self.__client.enable_logger(logger)
+        self.__retained: Dict[str, Any] = {}
+        self.__handlers: Dict[str, Callable[[str, bytes], None]] = {}
+        self.__lock = threading.Lock()
+        self.__heartbeat = None
+        self.__connected = False
+        self.__queue_limit = queue_limit
+        self.__max_in_flight = max_in_flight
+        # retained messages are keyed by topic so they coalesce, the rest by (topic, seq) so each one is kept
+        # key -> topic, payload, retain, time queued
+        self.__outbox: OrderedDict[Union[str, Tuple[str, int]], Tuple[str, Any, bool, float]] = OrderedDict()
+        self.__seq = itertools.count()
+        # mid -> topic, time queued
+        self.__in_flight: Dict[int, Tuple[str, float]] = {}
+        self.__acked: Set[int] = set()
+        self.__flushing = False
+        MQTT_QUEUE_DEPTH.set_function(lambda: len(self.__outbox))
         self.__client.connect_async(ip, port, 60)
         self.__client.loop_start()
+        if heartbeat:
+            from twisted.internet import reactor
+            reactor.callWhenRunning(self.__start_heartbeat, heartbeat)
         import atexit
         atexit.register(self.shutdown)
 
     def shutdown(self):
         logger.info('Shutting down MQTT client')
+        if self.__heartbeat is not None and self.__heartbeat.running:
+            self.__heartbeat.stop()
         self.__client.loop_stop(force=True)
 
+    def __start_heartbeat(self, interval: float):
+        from twisted.internet import task
+        logger.info(f'Republishing retained values every {interval}s')
+        self.__heartbeat = task.LoopingCall(self.__republish)
+        self.__heartbeat.start(interval, now=False)
+
+    def __republish(self):
+        with self.__lock:
+            retained = list(self.__retained.items())
+        for topic, payload in retained:
+            self.__enqueue(topic, payload, True)
+
     def __on_connect(self, client, userdata, flags, rc):
         logger.info(f'Connected to MQTT [result: {rc}]')
+        if rc == 0:
+            if self.__handlers:
+                self.__client.subscribe([(topic, 1) for topic in self.__handlers.keys()])
+            with self.__lock:
+                self.__connected = True
+            self.__flush()
 
     def __on_message(self, client, userdata, msg):
         logger.info(f'Received from {msg.topic} {msg.payload}')
+        for sub, handler in list(self.__handlers.items()):
+            if mqtt.topic_matches_sub(sub, msg.topic):
+                try:
+                    handler(msg.topic[len('cmdserver/'):], msg.payload)
+                except:
+                    logger.exception(f'Unable to handle message from {msg.topic}')
+
+    def subscribe(self, source: str, handler: Callable[[str, bytes], None]):
+        """
+        Passes messages received on cmdserver/<source> to the handler, called on the MQTT network thread so it must
+        not block.
+        :param source: the topic below cmdserver/, may contain wildcards.
+        :param handler: receives the topic below cmdserver/ and the payload.
+        """
+        topic = f'cmdserver/{source}'
+        self.__handlers[topic] = handler
+        if self.__client.is_connected():
+            self.__client.subscribe(topic, qos=1)
 
     def __on_disconnect(self, client, userdata, rc):
         logger.warning(f'Disconnected from MQTT [result: {rc}]')
+        with self.__lock:
+            # messages in flight stay that way, the client resends them on reconnect and they are acked as usual
+            self.__connected = False
+
+    def __on_publish(self, client, userdata, mid):
+        with self.__lock:
+            sent = self.__in_flight.pop(mid, None)
+            if sent is None:
+                # acked before publish returned the mid
+                self.__acked.add(mid)
+        if sent is not None:
+            MQTT_PUBLISH.observe(time.perf_counter() - sent[1])
+        self.__flush()
+
+    def __publish(self, source: str, payload, retain: bool = True):
+        self.__publish_to(f'cmdserver/{source}', payload, retain=retain)
+
+    def __publish_to(self, topic: str, payload, retain: bool = True):
+        if retain:
+            with self.__lock:
+                if topic in self.__retained and self.__retained[topic] == payload:
+                    logger.debug(f'Unchanged {topic} -- {payload}')
+                    return
+                self.__retained[topic] = payload
+        logger.debug(f'Publishing {topic} -- {payload}')
+        self.__enqueue(topic, payload, retain)
 
-    def __publish(self, source: str, payload):
-        logger.info(f'Publishing {source} -- {payload}')
-        self.__client.publish(f'cmdserver/{source}', qos=1, payload=payload, retain=True)
+    def __enqueue(self, topic: str, payload, retain: bool):
+        with self.__lock:
+            if retain:
+                key = topic
+                self.__outbox.pop(key, None)
+            else:
+                key = (topic, next(self.__seq))
+            self.__outbox[key] = (topic, payload, retain, time.perf_counter())
+            while len(self.__outbox) > self.__queue_limit:
+                self.__drop()
+        self.__flush()
+
+    def __drop(self):
+        """ discards the oldest non retained message, or the oldest retained one if there are none """
+        key = next((k for k, v in self.__outbox.items() if not v[2]), None)
+        if key is None:
+            key = next(iter(self.__outbox))
+        topic, _, retain, _ = self.__outbox.pop(key)
+        if retain:
+            # so the next publish of the same value is not mistaken for one the broker already has
+            self.__retained.pop(topic, None)
+        logger.warning(f'Publish queue is full, dropping {topic}')
+        MQTT_DROPPED.inc()
+
+    def __flush(self):
+        """
+        hands queued messages to the client while it is connected and below the in flight limit. Called on both the
+        publishing and the network thread so only one thread drains the queue at a time, keeping the messages in
+        order, any other caller returns immediately as whatever it queued is picked up by the draining thread.
+        """
+        with self.__lock:
+            if self.__flushing:
+                return
+            self.__flushing = True
+        try:
+            while True:
+                with self.__lock:
+                    if not self.__connected or not self.__outbox or len(self.__in_flight) >= self.__max_in_flight:
+                        # cleared while still holding the lock so a message queued from now on starts a new drain
+                        self.__flushing = False
+                        return
+                    _, (topic, payload, retain, queued_at) = self.__outbox.popitem(last=False)
+                self.__send(topic, payload, retain, queued_at)
+        except:
+            with self.__lock:
+                self.__flushing = False
+            raise
+
+    def __send(self, topic: str, payload, retain: bool, queued_at: float):
+        info = self.__client.publish(topic, qos=1, payload=payload, retain=retain)
+        if info.rc == mqtt.MQTT_ERR_NO_CONN:
+            # the client has kept the message and sends it on reconnect, so it is in flight rather than lost
+            with self.__lock:
+                self.__connected = False
+        elif info.rc != mqtt.MQTT_ERR_SUCCESS:
+            logger.warning(f'Unable to publish to {topic} [result: {info.rc}]')
+            return
+        with self.__lock:
+            if info.mid in self.__acked:
+                self.__acked.remove(info.mid)
+                acked = True
+            else:
+                self.__in_flight[info.mid] = (topic, queued_at)
+                acked = False
+        if acked:
+            MQTT_PUBLISH.observe(time.perf_counter() - queued_at)
 
     def state(self, source: str, payload):
         self.__publish(f'{source}/state', payload)
@@ -47,6 +216,22 @@ class MQTT:
     def attributes(self, source: str, payload):
         self.__publish(f'{source}/attributes', payload)
 
+    def attribute(self, source: str, name: str, value):
+        self.__publish(f'{source}/attributes/{name}', value)
+
+    def event(self, source: str, payload):
+        self.__publish(f'{source}/event', payload, retain=False)
+
+    def result(self, source: str, payload):
+        self.__publish(f'{source}/result', payload, retain=False)
+
+    def metrics(self, payload):
+        self.__publish('metrics', payload, retain=False)
+
+    def discovery(self, prefix: str, component: str, object_id: str, payload):
+        """ publishes a Home Assistant discovery config for an entity belonging to this client """
+        self.__publish_to(f'{prefix}/{component}/{self.client_id}/{object_id}/config', payload)
+
     def online(self, source: str):
         self.__publish(f'{source}/available', 'online')
 
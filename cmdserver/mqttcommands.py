@@ -0,0 +1,87 @@
+import json
+import logging
+import threading
+from typing import Set
+
+from cmdserver.commandcontroller import CommandController, CommandJob, TooBusy
+from cmdserver.mqtt import MQTT
+from cmdserver.pjcontroller import PJController
+from cmdserver.pjmacro import Execution, InvalidCommand
+from cmdserver.pjverify import Verify
+
+logger = logging.getLogger('mqttcommands')
+
+
+class MQTTCommandChannel:
+    """
+    Lets commands be sent over MQTT rather than HTTP.
+
+    * cmdserver/pj/set accepts the same json list of commands as PUT /api/1/pj, or {"commands": [...], "verify": ...},
+      the execution is published to cmdserver/pj/result once it completes.
+    * cmdserver/command/<id>/run launches the command, the payload is ignored unless it is {"idempotencyKey": ...},
+      the job is published to cmdserver/command/<id>/result once it completes.
+    """
+
+    def __init__(self, mqtt: MQTT, pj_controller: PJController, command_controller: CommandController):
+        self.__mqtt = mqtt
+        self.__pj_controller = pj_controller
+        self.__command_controller = command_controller
+        self.__jobs: Set[str] = set()
+        self.__lock = threading.Lock()
+        command_controller.add_listener(self.__on_job)
+        mqtt.subscribe('pj/set', self.__set_pj)
+        mqtt.subscribe('command/+/run', self.__run_command)
+
+    def __set_pj(self, topic: str, payload: bytes):
+        if not self.__pj_controller.enabled:
+            self.__mqtt.result('pj', json.dumps({'error': 'PJ is not configured'}))
+            return
+        try:
+            request = json.loads(payload)
+            verify = None
+            if isinstance(request, dict):
+                verify = Verify(request['verify']) if 'verify' in request else None
+                request = request.get('commands', None)
+            execution = self.__pj_controller.execute(request, verify=verify)
+        except (ValueError, InvalidCommand) as e:
+            logger.info(f"Rejecting {payload} - {e}")
+            self.__mqtt.result('pj', json.dumps({'error': str(e)}))
+            return
+        from twisted.internet import reactor
+        reactor.callFromThread(self.__when_complete, execution)
+
+    def __when_complete(self, execution: Execution):
+        def publish(result):
+            self.__mqtt.result('pj', json.dumps(execution.to_json()))
+            return result
+
+        execution.deferred.addBoth(publish)
+
+    def __run_command(self, topic: str, payload: bytes):
+        command_id = topic.split('/')[1]
+        try:
+            request = json.loads(payload) if payload else None
+        except ValueError:
+            request = None
+        key = request.get('idempotencyKey', None) if isinstance(request, dict) else None
+        try:
+            job = self.__command_controller.submit(command_id, idempotency_key=key)
+        except TooBusy as e:
+            self.__mqtt.result(f'command/{command_id}', json.dumps({'error': str(e)}))
+            return
+        if job is None:
+            self.__mqtt.result(f'command/{command_id}', json.dumps({'error': f'Unknown command {command_id}'}))
+            return
+        with self.__lock:
+            self.__jobs.add(job.id)
+        if job.done:
+            self.__on_job(job)
+
+    def __on_job(self, job: CommandJob):
+        if not job.done:
+            return
+        with self.__lock:
+            if job.id not in self.__jobs:
+                return
+            self.__jobs.remove(job.id)
+        self.__mqtt.result(f'command/{job.command_id}', json.dumps(job.to_json()))
@@ -1,118 +1,184 @@
 import json
 import logging
-import threading
-import time
-from dataclasses import dataclass, field
 from enum import Enum
-from queue import Empty, Queue
-from threading import Lock
-from time import sleep
-from typing import Optional, Tuple, Union, Any, Callable
+from typing import Optional, Tuple, Union, Dict, List
+
+from twisted.internet import defer, task, threads
 
 from cmdserver.debounce import debounce
-from cmdserver.jvc import CommandExecutor, CommandNack
+from cmdserver.jvc import CommandNack
+from cmdserver.jvcasync import AsyncCommandExecutor
 from cmdserver.jvccommands import Command, load_all_commands, Numeric, PowerState, \
-    READ_ONLY_RC, Model, InstallationMode
+    READ_ONLY_RC, Model, InstallationMode, CustomGammaTable
+from cmdserver.metrics import PJ_POLLS_SKIPPED
 from cmdserver.mqtt import MQTT
+from cmdserver.pjmacro import Execution, MacroPlanner, Step, InvalidCommand
+from cmdserver.pjpoller import PollScheduler
+from cmdserver.pjscheduler import CommandScheduler, INTERACTIVE, BACKGROUND, Preempted
+from cmdserver.pjstate import PJStateCache
+from cmdserver.pjverify import Verify, VerifyPolicy
+from cmdserver.progress import Recent
+from cmdserver.ws import WsServer
 
 logger = logging.getLogger('pjcontroller')
 
+POLLED_ATTRIBUTES = {
+    'anamorphicMode': Command.Anamorphic,
+    'pictureMode': Command.PictureMode,
+    'installationMode': Command.InstallationMode,
+    'model': Command.Model,
+    'sourceInfo': Command.InfoSource,
+}
+
+GAMMA_CHANNELS = {
+    'red': Command.GammaRed,
+    'green': Command.GammaGreen,
+    'blue': Command.GammaBlue,
+}
+
 
 class PJController:
 
-    def __init__(self, config, mqtt: Optional[MQTT]):
-        self.__pj_macros = config.pj_macros
+    def __init__(self, config, mqtt: Optional[MQTT], ws: Optional[WsServer] = None):
+        from twisted.internet import reactor
+        self.__planner = MacroPlanner(config.pj_macros)
+        self.__verify = VerifyPolicy(config.pj_verify)
         self.__mqtt = mqtt
-        self.__executor = CommandExecutor(host=config.pj_ip, password=config.pj_password) if config.pj_ip else None
+        self.__ws = ws
+        self.__executor = AsyncCommandExecutor(host=config.pj_ip, port=config.pj_port,
+                                               password=config.pj_password) if config.pj_ip else None
+        self.__publishing = self.__executor is not None and (mqtt is not None or ws is not None)
         self.__commands = load_all_commands()
-        self.__queue = Queue()
-        self.__lock = Lock()
+        self.__scheduler = CommandScheduler()
+        self.__cache = PJStateCache()
+        self.__in_flight: Dict[Command, List[defer.Deferred]] = {}
+        self.__executions: Recent[Execution] = Recent()
         self.__attributes = {
             'anamorphicMode': '',
             'installationMode': '',
             'pictureMode': ''
         }
-        self.__last_updated_at = time.time()
-        if self.__mqtt:
-            logger.info("MQTT is enabled, refreshing PJ state in 20s")
-            self.__running = threading.Event()
-            self.__running.set()
-            self.__worker = threading.Thread(target=self.__do_work, daemon=True).start()
-            from twisted.internet import reactor
-            reactor.callLater(20.0, lambda: self.__queue.put_nowait(self.__update_state))
-
-    def __do_work(self):
-        logger.info(f'Entering PJ executor thread')
-        while self.__running.is_set():
-            try:
-                payload = self.__queue.get(timeout=5)
-                if isinstance(payload, Callable):
-                    payload()
-                else:
-                    logger.warning(f'Ignoring unknown item, should be Callable {payload}')
-                self.__queue.task_done()
-            except Empty:
-                pass
-        logger.info(f'Exiting PJ executor thread')
-
-    def __update_state(self):
-        last = self.__last_updated_at
-        now = time.time()
-        self.__last_updated_at = now
-        if now - last < 0.5:
-            logger.warning(f'Suppressing request, too soon since last update')
-            return
+        self.__interactive = 0
+        self.__poller = PollScheduler(self.__poll, lambda: self.__busy, intervals=config.pj_polling)
+        PJ_POLLS_SKIPPED.set_function(lambda: self.__poller.skipped)
+        if self.__executor:
+            reactor.callWhenRunning(self.__executor.start)
+        if self.__publishing:
+            if ws is not None:
+                ws.add_client_listener(self.__on_ws_clients)
+            if self.__has_consumer:
+                logger.info("State publishing is enabled, refreshing PJ state in 20s")
+                self.__poller.schedule(20.0, reason='startup')
+            else:
+                logger.info("State publishing is enabled, PJ state will be refreshed once a websocket client connects")
 
-        update_in = 1
-        with self.__lock:
-            logger.info('Refreshing PJ State')
-            cmd = Command.Power
-            try:
-                self.__connect()
-                self.__mqtt.online('pj')
-                power = self.__executor.get(cmd)
-                if power == PowerState.LampOn:
-                    cmd = Command.Anamorphic
-                    ana = self.__executor.get(cmd)
-                    cmd = Command.PictureMode
-                    pic = self.__executor.get(cmd)
-                    cmd = Command.Model
-                    md = self.__executor.get(cmd)
-                    if md != Model.DLA_NZ700:
-                        cmd = Command.InstallationMode
-                        install = self.__executor.get(cmd)
+    @property
+    def __has_consumer(self) -> bool:
+        """ the PJ is only polled while something is listening for the state, i.e. mqtt or a websocket client """
+        return self.__mqtt is not None or (self.__ws is not None and self.__ws.clients > 0)
+
+    def __on_ws_clients(self, count: int):
+        if self.__mqtt is None:
+            if count == 0:
+                logger.info('No websocket clients remain, pausing PJ state refresh')
+                self.__poller.stop()
+            elif not self.__poller.pending:
+                self.__poller.schedule(0, reason='websocket client connected')
+
+    @defer.inlineCallbacks
+    def __refresh_state(self, due: List[str]):
+        logger.info('Refreshing PJ State')
+        cmd = Command.Power
+        try:
+            power = yield self.__executor.get(cmd)
+            self.__cache.put(cmd, power)
+            self.__publish_available(True)
+            if power == PowerState.LampOn:
+                self.__scheduler.check_preempted(BACKGROUND)
+                attributes = dict(self.__attributes)
+                if 'model' not in attributes and 'model' not in due:
+                    due.append('model')
+                # the NZ700 does not support InstallationMode so only read it in the same batch once the model is known
+                model = attributes.get('model', Model.DLA_NZ700.name)
+                names = [a for a in due if a != 'installationMode' or model != Model.DLA_NZ700.name]
+                cmd = [POLLED_ATTRIBUTES[a] for a in names]
+                vals = yield self.__executor.get_many(cmd)
+                for a, c, v in zip(names, cmd, vals):
+                    self.__cache.put(c, v)
+                    attributes[a] = self.__format(v)
+                if 'installationMode' in due and 'installationMode' not in names:
+                    if attributes['model'] == Model.DLA_NZ700.name:
+                        attributes['installationMode'] = InstallationMode.ONE.name
                     else:
-                        install = InstallationMode.ONE.name
-                    self.__attributes = {
-                        'anamorphicMode': ana.name,
-                        'installationMode': install,
-                        'pictureMode': pic.name,
-                        'model': md.name,
-                    }
-                    update_in = 10
-                else:
-                    update_in = 1 if power == PowerState.Starting or power == PowerState.Cooling else 20
-                self.__mqtt.state('pj', power.name)
-                self.__mqtt.attributes('pj', json.dumps(self.__attributes))
-                self.__update_state_in(update_in=update_in)
-                self.__disconnect()
-                logger.info('Refreshed PJ State')
-            except CommandNack:
-                # self.__update_state_in(update_in=10)
-                # self.__hard_disconnect()
-                self.__update_state_in(update_in=update_in)
-                self.__disconnect()
-                logger.exception(f"Command NACKed - GET {cmd}")
-            except:
+                        cmd = Command.InstallationMode
+                        install = yield self.__executor.get(cmd)
+                        self.__cache.put(cmd, install)
+                        attributes['installationMode'] = install.name
+                self.__attributes = attributes
+                self.__poller.polled(due)
+            self.__publish_power(power)
+            self.__publish_attributes()
+            self.__poller.succeeded(power)
+            logger.info('Refreshed PJ State')
+        except Preempted:
+            self.__poller.schedule(self.__poller.interval('busy'), reason='preempted by interactive command')
+        except CommandNack:
+            self.__poller.failed(unreachable=False)
+            logger.exception(f"Command NACKed - GET {cmd}")
+        except:
+            self.__publish_available(False)
+            self.__poller.failed()
+            logger.exception(f"Unexpected failure while executing cmd: {cmd}")
+
+    def __publish_available(self, online: bool):
+        if self.__mqtt:
+            if online:
+                self.__mqtt.online('pj')
+            else:
                 self.__mqtt.offline('pj')
-                self.__update_state_in(update_in=10)
-                self.__hard_disconnect()
-                logger.exception(f"Unexpected failure while executing cmd: {cmd}")
+        if self.__ws:
+            self.__ws.update('pj', available=online)
+
+    def __publish_power(self, power: PowerState):
+        if self.__mqtt:
+            self.__mqtt.state('pj', power.name)
+        if self.__ws:
+            self.__ws.update('pj', power=power.name)
+
+    def __publish_attributes(self):
+        if self.__mqtt:
+            self.__mqtt.attributes('pj', json.dumps(self.__attributes))
+            for name, value in self.__attributes.items():
+                self.__mqtt.attribute('pj', name, value)
+        if self.__ws:
+            self.__ws.update('pj', **self.__attributes)
+
+    def __poll(self, due: List[str]) -> defer.Deferred:
+        if not self.__has_consumer:
+            logger.debug('Nothing is listening for PJ state, skipping refresh')
+            return defer.succeed(None)
+        return self.__refresh(due)
 
-    def __update_state_in(self, update_in: float = 20, reason: str = None):
-        logger.debug(f'Scheduling update in {update_in}s {"due to " if reason else ""}{reason}')
+    def __refresh(self, due: List[str]) -> defer.Deferred:
+        return self.__scheduler.run(BACKGROUND, self.__refresh_state, due)
+
+    def refresh(self):
+        """ Polls the PJ state now, blocks the calling (non reactor) thread until the poll completes """
         from twisted.internet import reactor
-        reactor.callLater(update_in, lambda: self.__queue.put_nowait(self.__update_state))
+        threads.blockingCallFromThread(reactor, self.__refresh, list(POLLED_ATTRIBUTES.keys()))
+
+    @property
+    def __busy(self) -> bool:
+        return self.__interactive > 0 or self.__scheduler.locked
+
+    def __run_interactive(self, fn, *args) -> defer.Deferred:
+        """ runs the command ahead of any background work, the poller holds off while any of these are in flight """
+        self.__interactive += 1
+        return self.__scheduler.run(INTERACTIVE, fn, *args).addBoth(self.__interactive_complete)
+
+    def __interactive_complete(self, result):
+        self.__interactive -= 1
+        return result
 
     @property
     def state(self):
@@ -122,66 +188,198 @@ class PJController:
     def enabled(self):
         return self.__executor is not None
 
-    def __connect(self):
-        self.__executor.connect()
+    def get(self, command, fresh=False):
+        """
+        Reads the value of the command, values are served from the state cache unless fresh is set or the value has
+        expired in which case the calling (non reactor) thread blocks until the PJ responds.
+        :return: the value, None if the command is unknown.
+        :raises: whatever caused the read to fail if the PJ could not be read.
+        """
+        try:
+            cmd = Command[command]
+        except KeyError:
+            logger.warning(f"Ignoring unknown command {command}")
+            return None
+        if not fresh:
+            cached = self.__cache.get(cmd)
+            if cached is not None:
+                return self.__format(cached)
+        from twisted.internet import reactor
+        return threads.blockingCallFromThread(reactor, self.__read, cmd)
+
+    def __read(self, cmd: Command) -> defer.Deferred:
+        """ coalesces concurrent reads of the same command onto a single round trip to the PJ """
+        waiters = self.__in_flight.get(cmd, None)
+        if waiters is None:
+            waiters = self.__in_flight[cmd] = []
+            self.__run_interactive(self.__get, cmd).addBoth(self.__on_read, cmd)
+        else:
+            logger.debug(f'Joining in flight read of {cmd.name}')
+        d = defer.Deferred()
+        waiters.append(d)
+        return d
+
+    def __on_read(self, result, cmd: Command):
+        for d in self.__in_flight.pop(cmd, []):
+            d.callback(result)
+
+    @staticmethod
+    def __format(val):
+        if isinstance(val, Enum):
+            return val.name
+        if isinstance(val, int):
+            return int(val)
+        if isinstance(val, list):
+            return list(val)
+        return val.replace('"', '').strip()
+
+    @defer.inlineCallbacks
+    def __get(self, cmd: Command):
+        command = cmd.name
+        try:
+            val = yield self.__executor.get(cmd)
+            self.__cache.put(cmd, val)
+            self.__merge_read(cmd, val)
+            if val is not None:
+                return self.__format(val)
+            return val
+        except CommandNack:
+            logger.exception(f"Command NACKed - GET {command}")
+            raise
+        except:
+            logger.exception(f"Unexpected failure while executing cmd: {command}")
+            raise
+
+    def __merge_read(self, cmd: Command, val):
+        """
+        Folds a value read on behalf of a user into the polled state so the poller need not read it again, a power
+        read stands in for the pending poll of power.
+        """
+        if not self.__publishing or val is None:
+            return
+        if cmd == Command.Power:
+            self.__publish_power(val)
+            self.__poller.succeeded(val)
+        else:
+            attr = next((a for a, c in POLLED_ATTRIBUTES.items() if c == cmd), None)
+            if attr is not None:
+                self.__poller.polled([attr])
+                if self.__attributes.get(attr, None) != self.__format(val):
+                    self.__attributes = {**self.__attributes, attr: self.__format(val)}
+                    self.__publish_attributes()
+
+    def send(self, commands, verify: Optional[Verify] = None) -> Execution:
+        """
+        Sends the commands to the PJ, blocks the calling (non reactor) thread until they complete.
+        :return: the finished execution.
+        """
+        from twisted.internet import reactor
+        execution = self.__create_execution(commands)
+        threads.blockingCallFromThread(reactor, self.__start_execution, execution, verify)
+        return execution
+
+    def execute(self, commands, verify: Optional[Verify] = None) -> Execution:
+        """
+        Schedules the commands to be sent to the PJ without waiting for them to complete.
+        :param commands: the commands.
+        :param verify: overrides the configured verification mode for every command.
+        :return: the execution.
+        """
+        from twisted.internet import reactor
+        execution = self.__create_execution(commands)
+        reactor.callFromThread(self.__start_execution, execution, verify)
+        return execution
 
-    @debounce(4)
-    def __disconnect(self):
-        self.__executor.disconnect(fail=False)
+    def get_gamma(self) -> Dict[str, List[int]]:
+        """ Reads the custom gamma table of every channel, blocks the calling (non reactor) thread until complete """
+        from twisted.internet import reactor
+        return threads.blockingCallFromThread(reactor, self.__run_interactive, self.__read_gamma)
 
-    @debounce(0.001)
-    def __hard_disconnect(self):
-        self.__executor.disconnect(fail=False)
+    @defer.inlineCallbacks
+    def __read_gamma(self):
+        tables = {}
+        for channel, cmd in GAMMA_CHANNELS.items():
+            table = yield self.__executor.get(cmd)
+            self.__cache.put(cmd, table)
+            tables[channel] = list(table)
+        return tables
 
-    def get(self, command):
-        with self.__lock:
+    def set_gamma(self, tables: Dict[str, List[int]], verify: Optional[Verify] = None) -> Execution:
+        """
+        Schedules an upload of the custom gamma table of each supplied channel.
+        :param tables: 256 16bit values keyed by channel (red, green or blue).
+        :param verify: overrides the configured verification mode.
+        :return: the execution.
+        :raises InvalidCommand: if a channel is unknown or a table is invalid, i.e. before anything is sent to the PJ.
+        """
+        from twisted.internet import reactor
+        if not isinstance(tables, dict) or not tables:
+            raise InvalidCommand(f'{tables} is not a dict of gamma tables')
+        steps = []
+        for channel, table in tables.items():
+            cmd = GAMMA_CHANNELS.get(channel, None)
+            if cmd is None:
+                raise InvalidCommand(f'Unknown gamma channel {channel}')
             try:
-                cmd = Command[command]
-                self.__connect()
-                val = self.__executor.get(cmd)
-                self.__disconnect()
-                if val is not None:
-                    return val.name if isinstance(val, Enum) else val.replace('"', '').strip()
-                return val
-            except KeyError:
-                logger.warning(f"Ignoring unknown command {command}")
-                return None
-            except CommandNack:
-                logger.exception(f"Command NACKed - GET {command}")
-                return -1
-            except:
-                logger.exception(f"Unexpected failure while executing cmd: {command}")
-                return -1
-
-    def send(self, commands):
-        """ Sends the commands to the PJ """
-        with self.__lock:
-            sent = []
-            vals = []
-            self.__connect()
-            for command in commands:
-                if command[0:5] == 'PAUSE':
-                    sleep_secs = float(command[5:])
-                    logger.info(f"Sleeping for {sleep_secs:.3f}")
-                    sleep(sleep_secs)
+                steps.append(Step(cmd.name, command=cmd, value=CustomGammaTable(table)))
+            except (AssertionError, TypeError, OverflowError):
+                raise InvalidCommand(f'{channel} must be {CustomGammaTable.SIZE // 2} values between 0 and 65535')
+        execution = Execution([s.token for s in steps], steps)
+        self.__executions.add(execution)
+        reactor.callFromThread(self.__start_execution, execution, verify)
+        return execution
+
+    def get_execution(self, execution_id: str) -> Optional[Execution]:
+        return self.__executions.get(execution_id)
+
+    def __create_execution(self, commands) -> Execution:
+        """ :raises InvalidCommand: if the commands cannot be compiled, i.e. before anything is sent to the PJ. """
+        execution = Execution(commands, self.__planner.plan(commands))
+        self.__executions.add(execution)
+        return execution
+
+    def __start_execution(self, execution: Execution, verify: Optional[Verify]) -> defer.Deferred:
+        self.__run_execution(execution, verify)
+        return execution.deferred
+
+    @defer.inlineCallbacks
+    def __run_execution(self, execution: Execution, verify: Optional[Verify]):
+        """
+        Runs each step on the scheduler in turn, pauses are timers so the projector is free for other commands while
+        a macro is paused.
+        """
+        from twisted.internet import reactor
+        sent = []
+        to_verify = []
+        execution.running()
+        try:
+            for step in execution.steps:
+                if step.pause is not None:
+                    logger.info(f"Pausing {execution.id} for {step.pause:.3f}")
+                    yield task.deferLater(reactor, step.pause)
+                    execution.step_completed()
                 else:
-                    if command in self.__pj_macros:
-                        for cmd in self.__pj_macros[command]:
-                            c, e, v = self.__execute(cmd)
-                        if c and e:
-                            sent.append((c, e))
-                        if v:
-                            vals.append(v)
-                    else:
-                        c, e, v = self.__execute(command)
-                        if c and e:
-                            sent.append((c, e))
-                        if v:
-                            vals.append(v)
-            self.__disconnect()
-            if self.__mqtt:
-                self.__update_state_if_necessary(sent)
-            return vals
+                    try:
+                        c, e, v = yield self.__run_interactive(self.__execute, step, verify, to_verify)
+                    except Exception as ex:
+                        execution.step_failed(step.token, str(ex) or ex.__class__.__name__)
+                        continue
+                    sent.append((c, e))
+                    if v:
+                        execution.values.append(v)
+                    execution.step_completed()
+            execution.finish()
+        except Exception as e:
+            logger.exception(f"Unexpected failure while executing {execution.id}")
+            execution.failed(str(e))
+        for step in to_verify:
+            self.__scheduler.run(BACKGROUND, self.__verify_set, step)
+        if self.__publishing:
+            self.__update_state_if_necessary(sent)
+
+    @debounce(1)
+    def __update_state_after_change(self, reason: str):
+        self.__poller.boost(reason=reason)
 
     def __update_state_if_necessary(self, sent):
         mutate_cmd = None
@@ -194,31 +392,55 @@ class PJController:
                     mutate_cmd = f'{c} - {e}'
                     break
         if mutate_cmd:
-            self.__update_state_in(update_in=1, reason=f'{mutate_cmd}')
+            self.__update_state_after_change(mutate_cmd)
         else:
             logger.info(f'Info only, PJ state will not be updated')
 
-    def __execute(self, cmd) -> Tuple[Optional[Command], Optional[Union[Enum, Numeric]], any]:
-        tokens = cmd.split('.')
-        if len(tokens) > 1:
-            try:
-                cmd_enum = Command[tokens[0]]
-                if isinstance(cmd_enum.value, tuple):
-                    cmd_arg_enum = cmd_enum.value[1]
-                    if cmd_arg_enum.__name__ == tokens[1]:
-                        logger.info(f"Executing {cmd}")
-                        if issubclass(cmd_arg_enum, Enum):
-                            tok = cmd_arg_enum[tokens[2]]
-                            return cmd_enum, tok, self.__executor.set(cmd_enum, tok)
-                        elif issubclass(cmd_arg_enum, Numeric):
-                            tok = Numeric(int(tokens[2]))
-                            return cmd_enum, tok, self.__executor.set(cmd_enum, tok)
-                        else:
-                            logger.warning(f"Unsupported value type for {cmd} - {cmd_arg_enum.__name__}")
-            except (AttributeError, KeyError):
-                logger.exception(f"Ignoring unknown command {cmd}")
-            except:
-                logger.exception(f"Unexpected exception while processing {cmd}")
-        else:
-            logger.error(f"Ignoring unknown command {cmd}")
-        return None, None, None
+    def __invalidate(self, cmd: Command, val):
+        """
+        discards cached state which may be changed by the command, a set can change other values too (e.g. an Input
+        change alters the source info while a PictureMode change alters the picture settings) so only remote codes
+        which merely display information leave the cache intact.
+        """
+        if cmd != Command.Remote or val not in READ_ONLY_RC:
+            self.__cache.invalidate()
+
+    @defer.inlineCallbacks
+    def __execute(self, step: Step, verify: Optional[Verify],
+                  to_verify: List[Step]) -> Tuple[Command, Union[Enum, Numeric], any]:
+        """
+        sends the step, steps to be verified in the background once the execution completes are added to to_verify
+        :raises: whatever caused the step to fail.
+        """
+        logger.info(f"Executing {step.token}")
+        try:
+            self.__invalidate(step.command, step.value)
+            mode = self.__verify.resolve(step.command, verify)
+            result = yield self.__executor.set(step.command, step.value, verify=mode == Verify.ALWAYS)
+            if mode == Verify.DEFERRED:
+                to_verify.append(step)
+            return step.command, step.value, result
+        except:
+            logger.exception(f"Unexpected exception while processing {step.token}")
+            raise
+
+    @defer.inlineCallbacks
+    def __verify_set(self, step: Step):
+        """ reads back the value written by the step, filling the cache and reporting any mismatch """
+        try:
+            actual = yield self.__executor.get(step.command)
+            self.__cache.put(step.command, actual)
+            if actual != step.value:
+                logger.warning(f"Verify error: {step.token} read back {actual}")
+                event = {
+                    'type': 'verifyFailed',
+                    'command': step.command.name,
+                    'expected': self.__format(step.value),
+                    'actual': self.__format(actual)
+                }
+                if self.__mqtt:
+                    self.__mqtt.event('pj', json.dumps(event))
+                if self.__ws:
+                    self.__ws.event('pj', event)
+        except:
+            logger.exception(f"Unable to verify {step.token}")
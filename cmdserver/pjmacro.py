@@ -0,0 +1,162 @@
+import logging
+import time
+from dataclasses import dataclass
+from enum import Enum
+from functools import lru_cache
+from typing import List, Dict, Optional, Any, Union
+
+from twisted.internet import defer
+
+from cmdserver.jvccommands import Command, Numeric, ReadOnly
+from cmdserver.progress import RUNNING, COMPLETE, FAILED, Tracked
+
+logger = logging.getLogger('pjmacro')
+
+
+class InvalidCommand(ValueError):
+    """Raised when a command token cannot be compiled into a step"""
+    pass
+
+
+@dataclass(frozen=True)
+class Step:
+    """A single pre-resolved step, either a command and its value or a pause"""
+    token: str
+    command: Optional[Command] = None
+    value: Optional[Union[Enum, Numeric]] = None
+    pause: Optional[float] = None
+
+
+@lru_cache(maxsize=256)
+def compile_step(token: str) -> Step:
+    """
+    Resolves a command token, i.e. PAUSEn.n or <Command>.<value type>.<value>, into a step.
+    :param token: the token.
+    :return: the step.
+    :raises InvalidCommand: if the token does not describe a command that can be sent.
+    """
+    if token[0:5] == 'PAUSE':
+        try:
+            return Step(token, pause=float(token[5:]))
+        except ValueError:
+            raise InvalidCommand(f'{token} is not a valid pause')
+    tokens = token.split('.')
+    if len(tokens) != 3:
+        raise InvalidCommand(f'{token} is not of the form <command>.<type>.<value>')
+    try:
+        cmd = Command[tokens[0]]
+    except KeyError:
+        raise InvalidCommand(f'{token} refers to unknown command {tokens[0]}')
+    if not isinstance(cmd.value, tuple):
+        raise InvalidCommand(f'{token} refers to unsupported command {tokens[0]}')
+    valtype = cmd.value[1]
+    if valtype.__name__ != tokens[1]:
+        raise InvalidCommand(f'{token} has the wrong type, expected {valtype.__name__}')
+    if issubclass(valtype, ReadOnly):
+        raise InvalidCommand(f'{token} is a read only command')
+    try:
+        if issubclass(valtype, Enum):
+            return Step(token, command=cmd, value=valtype[tokens[2]])
+        elif issubclass(valtype, Numeric):
+            return Step(token, command=cmd, value=Numeric(int(tokens[2])))
+    except (KeyError, ValueError, AssertionError):
+        raise InvalidCommand(f'{token} has an invalid value {tokens[2]}')
+    raise InvalidCommand(f'Unsupported value type for {token} - {valtype.__name__}')
+
+
+class MacroPlanner:
+    """
+    Compiles the configured macros once, reporting any invalid steps, and turns payloads into lists of steps.
+    """
+
+    def __init__(self, macros: Dict[str, List[str]]):
+        self.__macros: Dict[str, List[Step]] = {}
+        for name, tokens in (macros if macros else {}).items():
+            steps = []
+            for token in tokens:
+                try:
+                    steps.append(compile_step(token))
+                except InvalidCommand as e:
+                    logger.error(f'Ignoring invalid step in macro {name}: {e}')
+            self.__macros[name] = steps
+
+    def plan(self, commands: List[str]) -> List[Step]:
+        """
+        Expands any macros in the payload into the individual steps to execute.
+        :param commands: the commands, macro names or PAUSEn.n steps.
+        :return: the steps.
+        :raises InvalidCommand: if the payload is not a list or contains a token which is not valid.
+        """
+        if not isinstance(commands, list):
+            raise InvalidCommand(f'{commands} is not a list of commands')
+        steps = []
+        for command in commands:
+            if not isinstance(command, str):
+                raise InvalidCommand(f'{command} is not a command')
+            if command in self.__macros:
+                steps.extend(self.__macros[command])
+            else:
+                steps.append(compile_step(command))
+        return steps
+
+
+class Execution(Tracked):
+    """
+    Tracks the progress of a sequence of steps sent to the projector. Progress is updated on the reactor thread and
+    may be observed from any thread.
+    """
+
+    def __init__(self, commands: List[str], steps: List[Step]):
+        super().__init__()
+        self.commands = commands
+        self.steps = steps
+        self.completed = 0
+        self.failed_steps: List[str] = []
+        self.values = []
+        self.deferred = defer.Deferred()
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'commands': self.commands,
+            'state': self.state,
+            'steps': len(self.steps),
+            'completed': self.completed,
+            'failedSteps': len(self.failed_steps),
+            'error': self.error,
+            'createdAt': self.created_at,
+            'finishedAt': self.finished_at
+        }
+
+    def running(self):
+        self.state = RUNNING
+        self._notify()
+
+    def step_completed(self):
+        self.completed += 1
+        self._notify()
+
+    def step_failed(self, token: str, error: str):
+        """ records a step which could not be sent, later steps are still sent """
+        self.failed_steps.append(f'{token} - {error}')
+        self.step_completed()
+
+    def finish(self):
+        """ completes the execution or, if any step failed, fails it with the reason for each failure """
+        if self.failed_steps:
+            self.failed(f'{len(self.failed_steps)} of {len(self.steps)} steps failed: {"; ".join(self.failed_steps)}')
+        else:
+            self.complete()
+
+    def complete(self):
+        self.state = COMPLETE
+        self.finished_at = time.time()
+        self._notify()
+        self.deferred.callback(self.values)
+
+    def failed(self, error: str):
+        self.state = FAILED
+        self.error = error
+        self.finished_at = time.time()
+        self._notify()
+        self.deferred.callback(self.values)
@@ -0,0 +1,134 @@
+import logging
+from typing import Callable, Dict, List, Optional
+
+from cmdserver.jvccommands import PowerState
+
+logger = logging.getLogger('pjpoller')
+
+# intervals (in seconds) used by the PollScheduler, any of which can be overridden via the pjPolling config item
+DEFAULT_INTERVALS: Dict[str, float] = {
+    # how often to read the power state while the lamp is on, in standby or when starting/cooling
+    'lampOn': 10.0,
+    'standby': 20.0,
+    'transition': 1.0,
+    # how often to read each attribute while the lamp is on
+    'anamorphicMode': 10.0,
+    'pictureMode': 10.0,
+    'installationMode': 30.0,
+    'model': 3600.0,
+    'sourceInfo': 10.0,
+    # after a change, poll everything this often for boostFor seconds
+    'boost': 1.0,
+    'boostFor': 6.0,
+    # while the projector is unreachable, back off exponentially from unreachable up to maxBackoff
+    'unreachable': 10.0,
+    'maxBackoff': 120.0,
+    # how long to wait before trying again if a poll is due while an interactive command is in flight
+    'busy': 0.5,
+}
+
+ATTRIBUTES = ['anamorphicMode', 'pictureMode', 'installationMode', 'model', 'sourceInfo']
+
+
+class PollScheduler:
+    """
+    Decides when the projector state should next be polled and which attributes are due. A single poll is pending at
+    any one time, the interval adapts to the power state, is boosted after a change and backs off while the projector
+    is unreachable.
+    """
+
+    def __init__(self, poll: Callable[[List[str]], None], is_busy: Callable[[], bool],
+                 intervals: Optional[Dict[str, float]] = None, clock=None):
+        self.__poll = poll
+        self.__is_busy = is_busy
+        self.__intervals = {**DEFAULT_INTERVALS, **(intervals if intervals else {})}
+        self.__clock = clock
+        self.__call = None
+        self.__last_polled: Dict[str, float] = {}
+        self.__boost_until = 0.0
+        self.__failures = 0
+        self.__skipped = 0
+
+    @property
+    def __reactor(self):
+        if self.__clock is None:
+            from twisted.internet import reactor
+            self.__clock = reactor
+        return self.__clock
+
+    @property
+    def skipped(self) -> int:
+        return self.__skipped
+
+    def interval(self, name: str) -> float:
+        return self.__intervals[name]
+
+    def schedule(self, delay: float, reason: str = None):
+        """ schedules the next poll in delay seconds, replacing any poll which is already pending """
+        logger.debug(f'Scheduling update in {delay:.3f}s {"due to " if reason else ""}{reason}')
+        if self.__call is not None and self.__call.active():
+            self.__call.reset(delay)
+        else:
+            self.__call = self.__reactor.callLater(delay, self.__fire)
+
+    @property
+    def pending(self) -> bool:
+        return self.__call is not None and self.__call.active()
+
+    def stop(self):
+        if self.__call is not None and self.__call.active():
+            self.__call.cancel()
+        self.__call = None
+
+    def boost(self, reason: str = None):
+        """ polls everything now and then at the boost interval for a short while """
+        self.__boost_until = self.__reactor.seconds() + self.interval('boostFor')
+        self.schedule(0, reason=reason)
+
+    @property
+    def boosting(self) -> bool:
+        return self.__reactor.seconds() < self.__boost_until
+
+    def due(self) -> List[str]:
+        """ :return: the attributes which should be read in this poll. """
+        if self.boosting:
+            return list(ATTRIBUTES)
+        now = self.__reactor.seconds()
+        return [a for a in ATTRIBUTES if now - self.__last_polled.get(a, -1e9) >= self.interval(a)]
+
+    def polled(self, attributes: List[str]):
+        now = self.__reactor.seconds()
+        for a in attributes:
+            self.__last_polled[a] = now
+
+    def succeeded(self, power: PowerState):
+        """ schedules the next poll according to the power state just read """
+        self.__failures = 0
+        if power == PowerState.LampOn:
+            now = self.__reactor.seconds()
+            delay = min([self.interval('lampOn')] +
+                        [self.__last_polled.get(a, now) + self.interval(a) - now for a in ATTRIBUTES])
+        elif power == PowerState.Starting or power == PowerState.Cooling:
+            delay = self.interval('transition')
+        else:
+            delay = self.interval('standby')
+        if self.boosting:
+            delay = min(delay, self.interval('boost'))
+        self.schedule(max(delay, 0.1), reason=power.name)
+
+    def failed(self, unreachable: bool = True):
+        """ schedules a retry, backing off exponentially while the projector is unreachable """
+        if unreachable:
+            self.__failures += 1
+            delay = min(self.interval('maxBackoff'), self.interval('unreachable') * 2 ** (self.__failures - 1))
+        else:
+            delay = self.interval('unreachable')
+        self.schedule(delay, reason='failure' if unreachable else 'command failure')
+
+    def __fire(self):
+        self.__call = None
+        if self.__is_busy():
+            self.__skipped += 1
+            self.schedule(self.interval('busy'), reason='interactive command in flight')
+        else:
+            self.__poll(self.due())
@@ -0,0 +1,94 @@
+import heapq
+import itertools
+import time
+from typing import Callable, List, Tuple
+
+from twisted.internet import defer
+
+from cmdserver.metrics import PJ_LOCK_WAIT, PJ_QUEUE_DEPTH
+
+# lower values run first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+PRIORITY_NAMES = {
+    INTERACTIVE: 'interactive',
+    BACKGROUND: 'background',
+}
+
+
+class Preempted(Exception):
+    """Raised by a task which has given way to a higher priority one"""
+    pass
+
+
+class CommandScheduler:
+    """
+    Gives one task at a time exclusive use of the projector. Unlike a DeferredLock, waiting tasks are run in priority
+    order (then in the order they arrived) and a running task can check whether it should give way.
+    """
+
+    def __init__(self):
+        self.__locked = False
+        self.__waiting: List[Tuple[int, int, defer.Deferred]] = []
+        self.__seq = itertools.count()
+        for priority, name in PRIORITY_NAMES.items():
+            PJ_QUEUE_DEPTH.set_function(lambda p=priority: self.waiting(p), priority=name)
+
+    @property
+    def locked(self) -> bool:
+        return self.__locked
+
+    def waiting(self, priority: int = None) -> int:
+        """ :return: the number of tasks waiting at the given priority, or any priority if none is supplied. """
+        return sum(1 for p, _, d in self.__waiting if (priority is None or p == priority) and not d.called)
+
+    def check_preempted(self, priority: int):
+        """ raises Preempted if any task with a higher priority than the caller is waiting to run """
+        if any(p < priority and not d.called for p, _, d in self.__waiting):
+            raise Preempted()
+
+    def acquire(self, priority: int) -> defer.Deferred:
+        d = defer.Deferred(canceller=self.__cancel)
+        if self.__locked:
+            heapq.heappush(self.__waiting, (priority, next(self.__seq), d))
+            d.addCallback(self.__acquired, priority, time.perf_counter())
+        else:
+            self.__locked = True
+            self.__acquired(self, priority, None)
+            d.callback(self)
+        return d
+
+    @staticmethod
+    def __acquired(result, priority: int, queued_at):
+        waited = time.perf_counter() - queued_at if queued_at is not None else 0.0
+        PJ_LOCK_WAIT.observe(waited, priority=PRIORITY_NAMES.get(priority, str(priority)))
+        return result
+
+    def __cancel(self, d: defer.Deferred):
+        self.__waiting = [w for w in self.__waiting if w[2] is not d]
+        heapq.heapify(self.__waiting)
+
+    def release(self):
+        assert self.__locked, 'Tried to release an unlocked scheduler'
+        self.__locked = False
+        while self.__waiting:
+            _, _, d = heapq.heappop(self.__waiting)
+            if not d.called:
+                self.__locked = True
+                d.callback(self)
+                return
+
+    def run(self, priority: int, f: Callable, *args, **kwargs) -> defer.Deferred:
+        """ acquires the scheduler at the given priority, runs f and releases it once the result of f is available """
+        def execute(ignored):
+            d = defer.maybeDeferred(f, *args, **kwargs)
+
+            def release(result):
+                self.release()
+                return result
+
+            d.addBoth(release)
+            return d
+
+        return self.acquire(priority).addCallback(execute)
@@ -0,0 +1,70 @@
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Any, Callable
+
+from cmdserver.jvccommands import Command
+
+DEFAULT_TTL = 2.0
+
+# how long (in seconds) a value read from the projector can be served from memory
+TTLS: Dict[Command, float] = {
+    Command.Model: math.inf,
+    Command.InfoSoftVersion: math.inf,
+    Command.InfoLampTime: 300.0,
+    Command.Power: 5.0,
+    Command.PictureMode: 10.0,
+    Command.Anamorphic: 10.0,
+    Command.InstallationMode: 10.0,
+    Command.Input: 5.0,
+    Command.InfoInput: 5.0,
+    Command.InfoSource: 5.0,
+    Command.InfoHDR: 5.0,
+}
+
+
+@dataclass
+class CachedValue:
+    value: Any
+    expires_at: float
+
+
+class PJStateCache:
+    """
+    Holds the last value read from the projector for each command, each entry expires after a per command ttl.
+    """
+
+    def __init__(self, ttls: Optional[Dict[Command, float]] = None, default_ttl: float = DEFAULT_TTL,
+                 clock: Callable[[], float] = time.monotonic):
+        self.__ttls = TTLS if ttls is None else ttls
+        self.__default_ttl = default_ttl
+        self.__clock = clock
+        self.__values: Dict[Command, CachedValue] = {}
+
+    def ttl(self, cmd: Command) -> float:
+        return self.__ttls.get(cmd, self.__default_ttl)
+
+    def get(self, cmd: Command) -> Optional[Any]:
+        """
+        :param cmd: the command.
+        :return: the cached value if it has not expired, None otherwise.
+        """
+        cached = self.__values.get(cmd, None)
+        if cached is not None and cached.expires_at > self.__clock():
+            return cached.value
+        return None
+
+    def put(self, cmd: Command, value: Any):
+        if value is not None:
+            self.__values[cmd] = CachedValue(value, self.__clock() + self.ttl(cmd))
+
+    def invalidate(self, cmd: Optional[Command] = None):
+        """
+        Discards the cached value for the command, if no command is supplied then all values which can change at
+        runtime are discarded.
+        """
+        if cmd is not None:
+            self.__values.pop(cmd, None)
+        else:
+            for c in [c for c in self.__values.keys() if self.ttl(c) != math.inf]:
+                self.__values.pop(c, None)
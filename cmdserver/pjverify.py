@@ -0,0 +1,42 @@
+import logging
+from enum import Enum
+from typing import Dict, Optional
+
+from cmdserver.jvccommands import Command, NoVerify
+
+logger = logging.getLogger('pjverify')
+
+
+class Verify(Enum):
+    """How a set is confirmed by reading the value back"""
+    ALWAYS = 'always'  # read back before the set completes
+    NEVER = 'never'  # never read back
+    DEFERRED = 'deferred'  # read back in the background once the projector is free
+
+
+class VerifyPolicy:
+    """
+    Resolves the verification mode for a command, a per request override beats a per command setting which beats the
+    default. Configured via the pjVerify item, e.g.
+
+        pjVerify:
+          default: deferred
+          PictureMode: always
+    """
+
+    def __init__(self, config: Optional[Dict[str, str]] = None, default: Verify = Verify.DEFERRED):
+        config = dict(config) if config else {}
+        self.__default = Verify(config.pop('default', default.value))
+        self.__commands: Dict[Command, Verify] = {}
+        for name, mode in config.items():
+            try:
+                self.__commands[Command[name]] = Verify(mode)
+            except (KeyError, ValueError):
+                logger.error(f'Ignoring invalid verify mode {name}: {mode}')
+
+    def resolve(self, cmd: Command, override: Optional[Verify] = None) -> Verify:
+        if isinstance(cmd.value, tuple) and issubclass(cmd.value[1], NoVerify):
+            return Verify.NEVER
+        if override is not None:
+            return override
+        return self.__commands.get(cmd, self.__default)
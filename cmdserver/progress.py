@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Generic, Iterator, Optional, Tuple, TypeVar
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+
+class Tracked:
+    """
+    Work, e.g. a command job or a PJ execution, whose progress is updated on one thread and may be observed from any
+    thread. Subclasses describe themselves via to_json and call _notify whenever they change.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.state = PENDING
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.__version = 0
+        self.__changed = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.state == COMPLETE or self.state == FAILED
+
+    def to_json(self) -> Dict[str, Any]:
+        raise NotImplementedError()
+
+    def _notify(self):
+        with self.__changed:
+            self.__version += 1
+            self.__changed.notify_all()
+
+    def wait_for_update(self, seen: int, timeout: float = 30) -> Tuple[int, Dict[str, Any]]:
+        """
+        Blocks until the work has changed since the seen version (or the timeout expires).
+        :return: the current version and a snapshot of the work.
+        """
+        with self.__changed:
+            self.__changed.wait_for(lambda: self.__version > seen, timeout=timeout)
+            return self.__version, self.to_json()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ Blocks until the work is done, :return: true if it finished within the timeout. """
+        with self.__changed:
+            return self.__changed.wait_for(lambda: self.done, timeout=timeout)
+
+
+T = TypeVar('T', bound=Tracked)
+
+
+class Recent(Generic[T]):
+    """ Holds the most recently tracked work so its progress can be retrieved by id """
+
+    def __init__(self, limit: int = 50):
+        self.__limit = limit
+        self.__items: OrderedDict[str, T] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def add(self, item: T):
+        with self.__lock:
+            self.__items[item.id] = item
+            while len(self.__items) > self.__limit:
+                self.__items.popitem(last=False)
+
+    def get(self, item_id: str) -> Optional[T]:
+        with self.__lock:
+            return self.__items.get(item_id, None)
+
+
+def stream_progress(tracked: Tracked) -> Iterator[str]:
+    """ :return: a snapshot of the work as a line of json each time it changes, until it is done. """
+    seen = -1
+    while True:
+        seen, snapshot = tracked.wait_for_update(seen)
+        yield json.dumps(snapshot) + '\n'
+        if snapshot['state'] == COMPLETE or snapshot['state'] == FAILED:
+            return
@@ -1,36 +1,108 @@
+import json
 import logging
-from typing import Callable, Optional, List
+from collections import deque
+from typing import Callable, Optional, Dict, Any, Set, Deque, List
 
 from autobahn.exception import Disconnected
 from autobahn.twisted import WebSocketServerProtocol, WebSocketServerFactory
+from autobahn.websocket.protocol import PreparedMessage
+from twisted.python import threadable
+
+from cmdserver.metrics import WS_CLIENTS, WS_DROPPED
 
 logger = logging.getLogger('ws')
 
 
 class WsServer:
+    """
+    Pushes state to websocket clients. Each source has a state which is sent in full to a client when it connects,
+    changes are sent as deltas containing only the keys which changed, e.g. {"type": "pj", "pictureMode": "User1"}.
+    May be called from any thread.
+    """
 
-    def __init__(self):
-        self.__factory = WsServerFactory()
+    def __init__(self, queue_limit: int = 64):
+        self.__factory = WsServerFactory(queue_limit=queue_limit)
+        self.__factory.init(self.snapshot)
+        self.__state: Dict[str, Dict[str, Any]] = {}
 
     @property
     def factory(self) -> 'WsServerFactory':
         return self.__factory
 
+    @property
+    def clients(self) -> int:
+        return self.__factory.clients
+
+    def add_client_listener(self, listener: Callable[[int], None]):
+        """ registers a callback which is passed the number of clients whenever one connects or disconnects """
+        self.__factory.add_client_listener(listener)
+
+    def snapshot(self) -> Optional[str]:
+        """ :return: the current state of every source as a single message. """
+        if self.__state:
+            return json.dumps({'type': 'snapshot', **{k: dict(v) for k, v in self.__state.items()}},
+                              separators=(',', ':'))
+        return None
+
+    def update(self, source: str, **values):
+        """ merges the values into the state of the source, broadcasting any which have changed """
+        self.__on_reactor(self.__update, source, values)
+
+    def __update(self, source: str, values: Dict[str, Any]):
+        current = self.__state.setdefault(source, {})
+        delta = {k: v for k, v in values.items() if k not in current or current[k] != v}
+        if delta:
+            current.update(delta)
+            self.__broadcast(json.dumps({'type': source, **delta}, separators=(',', ':')))
+
+    def event(self, source: str, payload: Dict[str, Any]):
+        """ broadcasts a one off message which is not part of the state, e.g. {"type": "command", "event": {...}} """
+        self.__on_reactor(self.__broadcast, json.dumps({'type': source, 'event': payload}, separators=(',', ':')))
+
     def broadcast(self, msg: str):
+        self.__on_reactor(self.__broadcast, msg)
+
+    def __broadcast(self, msg: str):
         self.__factory.broadcast(msg)
 
+    @staticmethod
+    def __on_reactor(fn, *args):
+        if threadable.isInIOThread():
+            fn(*args)
+        else:
+            from twisted.internet import reactor
+            reactor.callFromThread(fn, *args)
+
 
 class WsProtocol(WebSocketServerProtocol):
+    """
+    A client which is sent prepared (i.e. encoded and framed once for every client) messages. The protocol is the
+    producer for its transport so it knows when the client has stopped reading, messages sent while it is paused are
+    queued up to the factory's queue limit. Once that overflows the backlog is dropped in favour of sending the
+    latest snapshot when the client catches up.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.__paused = False
+        self.__pending: Deque[PreparedMessage] = deque()
+        self.__stale = False
 
     def onConnect(self, request):
         logger.info(f"Client connecting: {request.peer}")
 
     def onOpen(self):
         logger.info("WebSocket connection open")
+        if self.transport.producer is not None:
+            # the http channel which accepted the upgrade is no longer involved in this connection
+            self.transport.unregisterProducer()
+        self.registerProducer(self, True)
         self.factory.register(self)
 
     def onClose(self, was_clean, code, reason):
         logger.info(f"WebSocket connection closed: clean? {was_clean}, code: {code}, reason: {reason}")
+        self.__pending.clear()
+        self.factory.unregister(self)
 
     def onMessage(self, payload, is_binary):
         try:
@@ -39,26 +111,84 @@ class WsProtocol(WebSocketServerProtocol):
         except:
             logger.exception('Message received failure')
 
+    @property
+    def backlog(self) -> int:
+        return len(self.__pending)
+
+    def send(self, msg: PreparedMessage):
+        if self.__stale:
+            return
+        if not self.__paused and not self.__pending:
+            self.sendPreparedMessage(msg)
+        elif len(self.__pending) < self.factory.queue_limit:
+            self.__pending.append(msg)
+        else:
+            logger.info(f"{self.peer} is not keeping up, dropping {len(self.__pending)} messages")
+            WS_DROPPED.inc(len(self.__pending) + 1)
+            self.__pending.clear()
+            self.__stale = True
+
+    def pauseProducing(self):
+        self.__paused = True
+
+    def resumeProducing(self):
+        self.__paused = False
+        if self.__stale:
+            self.__stale = False
+            snapshot = self.factory.prepared_snapshot()
+            if snapshot is not None:
+                self.sendPreparedMessage(snapshot)
+        while self.__pending and not self.__paused:
+            self.sendPreparedMessage(self.__pending.popleft())
+
+    def stopProducing(self):
+        self.__paused = True
+        self.__pending.clear()
+
 
 class WsServerFactory(WebSocketServerFactory):
     protocol = WsProtocol
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, queue_limit: int = 64, **kwargs):
         super(WsServerFactory, self).__init__(*args, **kwargs)
-        self.__clients: List[WsProtocol] = []
+        self.queue_limit = queue_limit
+        self.__clients: Set[WsProtocol] = set()
         self.__state_provider: Optional[Callable[[], str]] = None
+        self.__client_listeners: List[Callable[[int], None]] = []
+        WS_CLIENTS.set_function(lambda: len(self.__clients))
 
     def init(self, state_provider: Callable[[], str]):
         self.__state_provider = state_provider
 
+    @property
+    def clients(self) -> int:
+        return len(self.__clients)
+
+    def add_client_listener(self, listener: Callable[[int], None]):
+        self.__client_listeners.append(listener)
+
+    def __clients_changed(self):
+        for listener in self.__client_listeners:
+            try:
+                listener(len(self.__clients))
+            except:
+                logger.exception('Client listener failed')
+
+    def prepared_snapshot(self) -> Optional[PreparedMessage]:
+        if self.__state_provider:
+            state = self.__state_provider()
+            if state:
+                return self.prepareMessage(state.encode('utf8'))
+        return None
+
     def register(self, client: WsProtocol):
         if client not in self.__clients:
             logger.info(f"Registered client {client.peer}")
-            self.__clients.append(client)
-            if self.__state_provider:
-                state = self.__state_provider()
-                if state:
-                    client.sendMessage(state.encode('utf8'), isBinary=False)
+            self.__clients.add(client)
+            snapshot = self.prepared_snapshot()
+            if snapshot is not None:
+                client.send(snapshot)
+            self.__clients_changed()
         else:
             logger.info(f"Ignoring duplicate client {client.peer}")
 
@@ -66,22 +196,21 @@ class WsServerFactory(WebSocketServerFactory):
         if client in self.__clients:
             logger.info(f"Unregistering client {client.peer}")
             self.__clients.remove(client)
+            self.__clients_changed()
         else:
             logger.info(f"Ignoring unregistered client {client.peer}")
-    
-    def broadcast(self, msg: str):
-        sent_to = False
-        if self.__clients:
-            disconnected_clients = []
-            for c in self.__clients:
-                try:
-                    c.sendMessage(msg.encode('utf8'), isBinary=False)
-                    sent_to = True
-                except Disconnected as e:
-                    logger.exception(f"Failed to send to {c.peer}, discarding")
-                    disconnected_clients.append(c)
-            for c in disconnected_clients:
-                self.unregister(c)
-        if sent_to:
-            logger.debug(f"Broadcast {msg}")
 
+    def broadcast(self, msg: str):
+        if not self.__clients:
+            return
+        prepared = self.prepareMessage(msg.encode('utf8'))
+        disconnected_clients = []
+        for c in self.__clients:
+            try:
+                c.send(prepared)
+            except Disconnected:
+                logger.exception(f"Failed to send to {c.peer}, discarding")
+                disconnected_clients.append(c)
+        for c in disconnected_clients:
+            self.unregister(c)
+        logger.debug(f"Broadcast {msg}")
@@ -0,0 +1,69 @@
+import pytest
+from twisted.internet import task
+
+import cmdserver.debounce
+from cmdserver.debounce import Debouncer, debounce
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ runs every debouncer, including those created by the decorator, on a fake clock """
+    clock = task.Clock()
+
+    class ClockedDebouncer(Debouncer):
+        def __init__(self, fn, wait, clock=clock):
+            super().__init__(fn, wait, clock=clock)
+
+    monkeypatch.setattr(cmdserver.debounce, 'Debouncer', ClockedDebouncer)
+    # calls are marshalled onto the reactor thread, here the test drives the clock directly
+    monkeypatch.setattr(cmdserver.debounce.threadable, 'isInIOThread', lambda: True)
+    return clock
+
+
+def test_calls_are_postponed_until_quiet_with_the_latest_args(clock):
+    calls = []
+    d = cmdserver.debounce.Debouncer(lambda *args, **kwargs: calls.append((args, kwargs)), 1.0)
+    d(1)
+    clock.advance(0.5)
+    d(2, x=3)
+    clock.advance(0.9)
+    assert calls == []
+    clock.advance(0.1)
+    assert calls == [((2,), {'x': 3})]
+    assert d.counters == {'scheduled': 2, 'cancelled': 1, 'fired': 1}
+    assert not d.pending
+
+
+def test_cancel(clock):
+    calls = []
+    d = cmdserver.debounce.Debouncer(calls.append, 1.0)
+    d(1)
+    d.cancel()
+    clock.advance(5)
+    assert calls == []
+    assert not d.pending
+
+
+class Target:
+    def __init__(self):
+        self.calls = []
+
+    @debounce(1.0)
+    def update(self, value):
+        self.calls.append(value)
+
+
+def test_each_instance_has_its_own_debouncer(clock):
+    a = Target()
+    b = Target()
+    assert a.update is a.update
+    assert a.update is not b.update
+    a.update(1)
+    clock.advance(0.5)
+    b.update(2)
+    clock.advance(0.5)
+    # a call on one instance neither delays nor replaces a call on another
+    assert a.calls == [1]
+    assert b.calls == []
+    clock.advance(0.5)
+    assert b.calls == [2]
@@ -0,0 +1,42 @@
+import pytest
+
+from cmdserver.jvccommands import Command, PictureMode, Numeric
+from cmdserver.pjmacro import compile_step, MacroPlanner, InvalidCommand, Step
+
+
+def test_tokens_are_resolved_into_steps():
+    step = compile_step('PictureMode.PictureMode.User1')
+    assert step.command == Command.PictureMode
+    assert step.value == PictureMode.User1
+    assert compile_step('Contrast.Numeric.-1').value == Numeric(-1)
+    assert compile_step('PAUSE0.5') == Step('PAUSE0.5', pause=0.5)
+
+
+@pytest.mark.parametrize('token', [
+    'PictureMode.User1',
+    'PictureMode.PictureMode.User1.Extra',
+    'Nonsense.PictureMode.User1',
+    'NameEditofPictureModeUser1.bytes.x',
+    'PictureMode.Numeric.1',
+    'Model.Model.DLA_N7',
+    'PictureMode.PictureMode.Nonsense',
+    'Contrast.Numeric.abc',
+    'Contrast.Numeric.40000',
+    'PAUSEabc',
+])
+def test_invalid_tokens_are_rejected(token):
+    with pytest.raises(InvalidCommand):
+        compile_step(token)
+
+
+def test_macros_are_expanded_without_their_invalid_steps():
+    planner = MacroPlanner({'film': ['PictureMode.PictureMode.Film', 'Nonsense.X.Y', 'PAUSE1']})
+    steps = planner.plan(['film', 'Contrast.Numeric.2'])
+    assert [s.token for s in steps] == ['PictureMode.PictureMode.Film', 'PAUSE1', 'Contrast.Numeric.2']
+
+
+@pytest.mark.parametrize('payload', ['PictureMode.PictureMode.Film', {'a': 1}, [1], ['film', 'Nonsense.X.Y']])
+def test_invalid_payloads_are_rejected(payload):
+    planner = MacroPlanner({'film': ['PictureMode.PictureMode.Film']})
+    with pytest.raises(InvalidCommand):
+        planner.plan(payload)
@@ -0,0 +1,105 @@
+from typing import List
+
+from twisted.internet import task
+
+from cmdserver.jvccommands import PowerState
+from cmdserver.pjpoller import PollScheduler, ATTRIBUTES
+
+
+class Poller:
+    """ records the time and attributes of each poll made by a PollScheduler driven by a fake clock """
+
+    def __init__(self, **intervals):
+        self.clock = task.Clock()
+        self.busy = False
+        self.polls: List[tuple] = []
+        self.scheduler = PollScheduler(self.poll, lambda: self.busy, intervals=intervals, clock=self.clock)
+
+    def poll(self, due: List[str]):
+        self.polls.append((self.clock.seconds(), due))
+
+    def advance_to(self, t: float):
+        self.clock.advance(t - self.clock.seconds())
+
+
+def test_failures_back_off_exponentially_up_to_the_limit():
+    p = Poller(unreachable=10.0, maxBackoff=60.0)
+
+    def next_delay():
+        return p.clock.getDelayedCalls()[0].getTime() - p.clock.seconds()
+
+    delays = []
+    for _ in range(5):
+        p.scheduler.failed()
+        delays.append(next_delay())
+        p.clock.advance(delays[-1])
+    assert delays == [10.0, 20.0, 40.0, 60.0, 60.0]
+    assert len(p.polls) == 5
+    # a success resets the backoff while a failed command does not count as unreachable
+    p.scheduler.succeeded(PowerState.Standby)
+    p.scheduler.failed()
+    assert next_delay() == 10.0
+    p.scheduler.failed(unreachable=False)
+    p.scheduler.failed(unreachable=False)
+    assert next_delay() == 10.0
+
+
+def test_interval_follows_the_power_state():
+    p = Poller(standby=20.0, transition=1.0, lampOn=10.0)
+    p.scheduler.succeeded(PowerState.Standby)
+    assert p.clock.getDelayedCalls()[0].getTime() == 20.0
+    p.scheduler.succeeded(PowerState.Starting)
+    assert p.clock.getDelayedCalls()[0].getTime() == 1.0
+    p.scheduler.polled(ATTRIBUTES)
+    p.scheduler.succeeded(PowerState.LampOn)
+    assert p.clock.getDelayedCalls()[0].getTime() == 10.0
+    # only one poll is ever pending
+    assert len(p.clock.getDelayedCalls()) == 1
+
+
+def test_only_due_attributes_are_polled():
+    p = Poller(pictureMode=10.0, model=3600.0)
+    assert p.scheduler.due() == ATTRIBUTES
+    p.scheduler.polled(ATTRIBUTES)
+    assert p.scheduler.due() == []
+    p.clock.advance(10)
+    assert 'pictureMode' in p.scheduler.due()
+    assert 'model' not in p.scheduler.due()
+
+
+def test_boost_polls_everything_now_then_often():
+    p = Poller(boost=1.0, boostFor=6.0, standby=20.0)
+    p.scheduler.polled(ATTRIBUTES)
+    p.scheduler.succeeded(PowerState.Standby)
+    p.scheduler.boost(reason='test')
+    p.clock.advance(0)
+    assert p.polls == [(0, ATTRIBUTES)]
+    p.scheduler.succeeded(PowerState.Standby)
+    assert p.clock.getDelayedCalls()[0].getTime() == 1.0
+    p.advance_to(6)
+    assert not p.scheduler.boosting
+    p.scheduler.succeeded(PowerState.Standby)
+    assert p.clock.getDelayedCalls()[0].getTime() == 26.0
+
+
+def test_polls_are_skipped_while_busy():
+    p = Poller(busy=0.5)
+    p.busy = True
+    p.scheduler.schedule(1.0)
+    p.advance_to(1.0)
+    p.advance_to(1.5)
+    assert p.polls == []
+    assert p.scheduler.skipped == 2
+    p.busy = False
+    p.advance_to(2.0)
+    assert [t for t, _ in p.polls] == [2.0]
+    assert not p.scheduler.pending
+
+
+def test_stop_cancels_the_pending_poll():
+    p = Poller()
+    p.scheduler.schedule(1.0)
+    assert p.scheduler.pending
+    p.scheduler.stop()
+    p.advance_to(100)
+    assert p.polls == []
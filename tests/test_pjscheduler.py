@@ -0,0 +1,64 @@
+import pytest
+from twisted.internet import defer
+
+from cmdserver.pjscheduler import CommandScheduler, INTERACTIVE, BACKGROUND, Preempted
+
+
+def test_waiting_tasks_run_in_priority_then_arrival_order():
+    scheduler = CommandScheduler()
+    order = []
+    blocker = defer.Deferred()
+    scheduler.run(BACKGROUND, lambda: blocker)
+    for name, priority in [('bg1', BACKGROUND), ('int1', INTERACTIVE), ('bg2', BACKGROUND), ('int2', INTERACTIVE)]:
+        scheduler.run(priority, order.append, name)
+    assert scheduler.waiting() == 4
+    assert scheduler.waiting(INTERACTIVE) == 2
+    blocker.callback(None)
+    assert order == ['int1', 'int2', 'bg1', 'bg2']
+    assert not scheduler.locked
+
+
+def test_cancelled_tasks_are_skipped():
+    scheduler = CommandScheduler()
+    order = []
+    blocker = defer.Deferred()
+    scheduler.run(INTERACTIVE, lambda: blocker)
+    cancelled = scheduler.run(INTERACTIVE, order.append, 'cancelled')
+    scheduler.run(BACKGROUND, order.append, 'kept')
+    cancelled.addErrback(lambda f: f.trap(defer.CancelledError))
+    cancelled.cancel()
+    assert scheduler.waiting() == 1
+    blocker.callback(None)
+    assert order == ['kept']
+
+
+def test_background_work_is_preempted_by_waiting_interactive_work():
+    scheduler = CommandScheduler()
+    checks = []
+    blocker = defer.Deferred()
+
+    @defer.inlineCallbacks
+    def background():
+        yield blocker
+        scheduler.check_preempted(BACKGROUND)
+
+    d = scheduler.run(BACKGROUND, background)
+    d.addErrback(lambda f: checks.append(f.trap(Preempted)))
+    scheduler.run(BACKGROUND, lambda: None)
+    # other background work does not preempt, nor does anything preempt interactive work
+    scheduler.check_preempted(BACKGROUND)
+    scheduler.check_preempted(INTERACTIVE)
+    scheduler.run(INTERACTIVE, lambda: None)
+    with pytest.raises(Preempted):
+        scheduler.check_preempted(BACKGROUND)
+    blocker.callback(None)
+    assert checks == [Preempted]
+    assert not scheduler.locked
+
+
+def test_failures_release_the_scheduler():
+    scheduler = CommandScheduler()
+    failures = []
+    scheduler.run(INTERACTIVE, lambda: 1 / 0).addErrback(lambda f: failures.append(f.trap(ZeroDivisionError)))
+    assert failures == [ZeroDivisionError]
+    assert not scheduler.locked
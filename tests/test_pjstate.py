@@ -0,0 +1,58 @@
+import pytest
+
+from cmdserver.jvccommands import Command, Model, PictureMode, PowerState
+from cmdserver.pjstate import PJStateCache, DEFAULT_TTL
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_values_expire_after_their_ttl(clock):
+    cache = PJStateCache(clock=clock)
+    cache.put(Command.Power, PowerState.LampOn)
+    cache.put(Command.Contrast, 1)
+    clock.now += DEFAULT_TTL - 0.1
+    assert cache.get(Command.Contrast) == 1
+    clock.now += 0.1
+    assert cache.get(Command.Contrast) is None
+    assert cache.get(Command.Power) == PowerState.LampOn
+    clock.now += cache.ttl(Command.Power)
+    assert cache.get(Command.Power) is None
+
+
+def test_ttls_can_be_configured(clock):
+    cache = PJStateCache(ttls={Command.PictureMode: 1.0}, default_ttl=0.5, clock=clock)
+    assert cache.ttl(Command.PictureMode) == 1.0
+    assert cache.ttl(Command.Power) == 0.5
+
+
+def test_missing_values_are_not_cached(clock):
+    cache = PJStateCache(clock=clock)
+    cache.put(Command.PictureMode, PictureMode.User1)
+    cache.put(Command.PictureMode, None)
+    assert cache.get(Command.PictureMode) == PictureMode.User1
+
+
+def test_invalidation_keeps_values_which_never_change(clock):
+    cache = PJStateCache(clock=clock)
+    cache.put(Command.Model, Model.DLA_N7)
+    cache.put(Command.Power, PowerState.LampOn)
+    cache.put(Command.PictureMode, PictureMode.User1)
+    cache.invalidate(Command.PictureMode)
+    assert cache.get(Command.PictureMode) is None
+    assert cache.get(Command.Power) == PowerState.LampOn
+    cache.invalidate()
+    assert cache.get(Command.Power) is None
+    assert cache.get(Command.Model) == Model.DLA_N7
+    cache.invalidate(Command.Model)
+    assert cache.get(Command.Model) is None
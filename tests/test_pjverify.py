@@ -0,0 +1,26 @@
+from cmdserver.jvccommands import Command
+from cmdserver.pjverify import Verify, VerifyPolicy
+
+
+def test_the_default_is_deferred():
+    assert VerifyPolicy().resolve(Command.PictureMode) == Verify.DEFERRED
+    assert VerifyPolicy(default=Verify.NEVER).resolve(Command.PictureMode) == Verify.NEVER
+
+
+def test_an_override_beats_the_command_which_beats_the_default():
+    policy = VerifyPolicy({'default': 'never', 'PictureMode': 'always'})
+    assert policy.resolve(Command.Contrast) == Verify.NEVER
+    assert policy.resolve(Command.PictureMode) == Verify.ALWAYS
+    assert policy.resolve(Command.PictureMode, Verify.DEFERRED) == Verify.DEFERRED
+
+
+def test_commands_which_cannot_be_read_back_are_never_verified():
+    policy = VerifyPolicy({'default': 'always', 'Remote': 'always', 'Power': 'always'})
+    assert policy.resolve(Command.Remote) == Verify.NEVER
+    assert policy.resolve(Command.Power, Verify.ALWAYS) == Verify.NEVER
+
+
+def test_invalid_entries_are_ignored():
+    policy = VerifyPolicy({'Nonsense': 'always', 'PictureMode': 'sometimes', 'Contrast': 'never'})
+    assert policy.resolve(Command.PictureMode) == Verify.DEFERRED
+    assert policy.resolve(Command.Contrast) == Verify.NEVER
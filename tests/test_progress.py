@@ -0,0 +1,35 @@
+import json
+import threading
+
+from cmdserver.progress import Tracked, Recent, stream_progress, RUNNING, COMPLETE
+
+
+class Work(Tracked):
+
+    def to_json(self):
+        return {'id': self.id, 'state': self.state}
+
+    def update(self, state: str):
+        self.state = state
+        self._notify()
+
+
+def test_only_the_most_recent_work_is_kept():
+    recent = Recent(limit=2)
+    work = [Work() for _ in range(3)]
+    for w in work:
+        recent.add(w)
+    assert recent.get(work[0].id) is None
+    assert [recent.get(w.id) for w in work[1:]] == work[1:]
+
+
+def test_progress_is_streamed_until_the_work_is_done():
+    work = Work()
+    lines = stream_progress(work)
+    assert json.loads(next(lines))['state'] == 'pending'
+    threading.Timer(0.05, work.update, args=(RUNNING,)).start()
+    assert json.loads(next(lines))['state'] == RUNNING
+    work.update(COMPLETE)
+    assert json.loads(next(lines))['state'] == COMPLETE
+    assert next(lines, None) is None
+    assert work.wait(timeout=0)